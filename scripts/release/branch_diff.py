@@ -2,9 +2,10 @@
 import sys
 
 import os
+from concurrent.futures import ProcessPoolExecutor
 from os.path import join
 
-from git_helpers import get_submodule_version, get_past_submodule_version
+from git_helpers import get_submodule_version, get_past_submodule_versions
 from helpers import run
 
 
@@ -27,58 +28,94 @@ class Branch:
 
 
 class Difference:
-    def __init__(self, past_version):
+    def __init__(self, past_version, workers=8):
         """We store the difference as a dictionary, where the keys are branches,
         and each branch maps to a list of repos where that branch was found"""
         self.diff = {}
-        self.add_main_diff(past_version)
-        for submodule in os.listdir("submodules"):
-            self.add_submodule_diff(submodule, past_version)
+        jobs = [("main", None, None, past_version)]
+        past_versions = get_past_submodule_versions(past_version)
+        for submodule in sorted(os.listdir("submodules")):
+            previous_version = past_versions.get(submodule)
+            if not previous_version:
+                print("Warning: Unable to find past version for submodule "
+                      "'{}'".format(submodule))
+                continue
+            jobs.append((submodule, join("submodules", submodule),
+                         get_submodule_version(submodule), previous_version))
+        for (repo, branches) in get_repo_diffs(jobs, workers):
+            self.add(branches, repo)
 
     @property
     def branches(self):
         return self.diff.keys()
 
     def add(self, branches, submodule):
-        for b in branches:
+        for b in sorted(branches):
             if b not in self.diff:
                 self.diff[b] = []
             self.diff[b].append(submodule)
 
-    def add_main_diff(self, past_version):
-        self.add(Difference.get_branch_diff(past=past_version), "main")
-
-    def add_submodule_diff(self, submodule, past_main_repo_version):
-        print("Checking {}".format(submodule))
-        full_path = join("submodules", submodule)
-        current_version = get_submodule_version(submodule)
-        previous_version = get_past_submodule_version(submodule,
-                                                      past_main_repo_version)
-        if previous_version:
-            d = Difference.get_branch_diff(current_version, previous_version,
-                                           working_dir=full_path)
-        else:
-            d = []
-        self.add(d, submodule)
 
-    @classmethod
-    def get_branches_at(cls, revision, working_dir=None):
-        raw = run("git branch -r --merged {}".format(revision),
-                  working_dir=working_dir)
+# (working_dir, current, past): branch names
+cache = {}
+# past_version: Difference
+differences = {}
+
+
+def get_difference(past_version):
+    """The Difference since past_version, computed once per process, so
+    that the ticket check and the release itself share it"""
+    if past_version not in differences:
+        differences[past_version] = Difference(past_version)
+    return differences[past_version]
+
+
+def get_repo_diffs(jobs, workers):
+    """jobs is a list of (repo, working_dir, current, past); repos are
+    looked at in parallel, each in its own process"""
+    todo = [j for j in jobs if (j[1], j[2], j[3]) not in cache]
+    if todo:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            found = pool.map(get_branch_diff, *zip(*todo))
+            for (repo, working_dir, current, past), branches in \
+                    zip(todo, found):
+                print("Checked {}".format(repo))
+                cache[(working_dir, current, past)] = branches
+    return [(repo, cache[(working_dir, current, past)])
+            for (repo, working_dir, current, past) in jobs]
+
+
+def get_remote_branches(working_dir=None):
+    """Map of commit to the names of the remote branches that point at it"""
+    raw = run("git for-each-ref --format=%(objectname)%09%(symref)%09"
+              "%(refname:short) refs/remotes", working_dir=working_dir)
+    tips = {}
+    for line in raw.splitlines():
+        sha, symref, name = line.split("\t")
+        if symref:
+            continue
         try:
-            parsed = [Branch.parse(b) for b in raw.split('\n')]
-            branches = set(b.name for b in parsed if b)
+            branch = Branch.parse(name)
         except Exception as e:
             ex_template = "For repository {}, this error occurred: {}"
             raise Exception(ex_template.format(working_dir, e))
-        return branches
+        tips.setdefault(sha, set()).add(branch.name)
+    return tips
 
-    @classmethod
-    def get_branch_diff(cls, current=None, past=None, working_dir=None):
-        current = current or run("git rev-parse --short=7 HEAD")
-        branches_now = cls.get_branches_at(current, working_dir=working_dir)
-        branches_then = cls.get_branches_at(past, working_dir=working_dir)
-        return (branches_now - branches_then) - set(["master"])
+
+def get_branch_diff(repo, working_dir=None, current=None, past=None):
+    """Branches merged into current but not into past: those whose tip
+    is reachable from current and not from past, which one walk of the
+    history between the two finds for every branch at once"""
+    current = current or run("git rev-parse --short=7 HEAD",
+                             working_dir=working_dir)
+    tips = get_remote_branches(working_dir)
+    walk = run("git rev-list {} --not {}".format(current, past),
+               working_dir=working_dir)
+    branches = set()
+    for sha in walk.splitlines():
+        branches.update(tips.get(sha, []))
+    return branches - set(["master"])
 
 
 def get_args():
@@ -98,7 +135,7 @@ e.g. branch-diff v0.4.0""")
 
 if __name__ == "__main__":
     compare_to = get_args()
-    diff = Difference(compare_to)
+    diff = get_difference(compare_to)
 
     template = "Branches merged into the current commit " \
                "but not into {compare_to}:"
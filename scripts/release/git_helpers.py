@@ -11,6 +11,20 @@ def get_submodule_version(path):
     return result.stdout.strip()
 
 
+def get_past_submodule_versions(master_repo_version):
+    """The version of every submodule at a past revision of the main
+    repo, from a single ls-tree"""
+    result = run(["git", "ls-tree", master_repo_version, "submodules/"],
+                 stdout=PIPE, check=True, universal_newlines=True).stdout
+    versions = {}
+    for line in result.splitlines():
+        info, full_path = line.split("\t", 1)
+        parts = info.split()
+        if parts[1] == "commit":
+            versions[full_path[len("submodules/"):]] = parts[2][:7]
+    return versions
+
+
 def get_past_submodule_version(path, master_repo_version):
     full_path = join("submodules", path)
     result = run(["git", "ls-tree", master_repo_version, full_path],
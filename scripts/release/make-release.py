@@ -99,7 +99,7 @@ if __name__ == "__main__":
         latest_tag = get_latest_release_tag()
         print("The latest release was " + latest_tag)
 
-        branches_and_tickets = check_tickets(latest_tag)
+        branches_and_tickets = check_tickets(latest_tag, test_run)
         new_tag = get_new_tag(latest_tag)
 
         print("* Writing release log")
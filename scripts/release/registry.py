@@ -0,0 +1,231 @@
+import base64
+import json
+import os
+import re
+import subprocess
+from os.path import expanduser, isfile, join
+from threading import Lock
+
+import requests
+
+# A small client for the Docker Registry HTTP API v2, so that we can
+# tag and publish images by moving manifests around, rather than by
+# pulling and pushing every layer through the docker daemon.
+#
+#     local = Registry("https://docker.montagu.dide.ic.ac.uk:5000")
+#     body, media_type, digest = local.get_manifest("montagu-api", sha)
+#     local.put_manifest("montagu-api", "v1.2.3", body, media_type)
+#
+# Registries that use token authentication (such as Docker Hub) or
+# basic authentication are supported using the credentials that
+# 'docker login' stored (in ~/.docker/config.json, or with a credential
+# helper), or DOCKER_USERNAME/DOCKER_PASSWORD.  Like the docker daemon, we trust
+# the CA in /etc/docker/certs.d/<host:port>/ca.crt for a registry with a
+# private certificate.
+
+certs_dir = "/etc/docker/certs.d"
+
+manifest_types = [
+    "application/vnd.docker.distribution.manifest.v2+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.oci.image.manifest.v1+json",
+    "application/vnd.oci.image.index.v1+json"
+]
+list_types = [
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.oci.image.index.v1+json"
+]
+
+
+class RegistryException(Exception):
+    pass
+
+
+class Registry:
+    def __init__(self, url, auth_key=None):
+        """url is the base url of the registry API; auth_key is the
+        registry's key in ~/.docker/config.json (if different)"""
+        self.url = url.rstrip("/")
+        self.auth_key = auth_key or re.sub("^https?://", "", self.url)
+        self.session = requests.Session()
+        self.tokens = {}
+        # For a registry that asks for basic authentication
+        self.basic_auth = None
+        self.lock = Lock()
+
+    def get_manifest(self, name, reference):
+        r = self._request("GET", name, "manifests/" + reference,
+                          headers={"Accept": ", ".join(manifest_types)})
+        self._check(r, "get manifest {}:{}".format(name, reference))
+        return r.content, r.headers["Content-Type"], \
+            r.headers.get("Docker-Content-Digest")
+
+    def has_manifest(self, name, reference):
+        r = self._request("HEAD", name, "manifests/" + reference,
+                          headers={"Accept": ", ".join(manifest_types)})
+        return r.status_code == 200
+
+    def put_manifest(self, name, reference, body, media_type):
+        r = self._request("PUT", name, "manifests/" + reference, data=body,
+                          headers={"Content-Type": media_type})
+        self._check(r, "put manifest {}:{}".format(name, reference))
+
+    def has_blob(self, name, digest):
+        r = self._request("HEAD", name, "blobs/" + digest)
+        return r.status_code == 200
+
+    def mount_blob(self, name, digest, from_name):
+        """Ask the registry to link a blob that it already holds for
+        another repository; returns False if it would not"""
+        location = self.start_upload(name, digest, from_name)
+        if location is None:
+            return True
+        # Not mounted: the registry started an upload instead
+        self._request_url("DELETE", location, name)
+        return False
+
+    def start_upload(self, name, digest=None, from_name=None):
+        """Start uploading a blob, returning the location to upload it
+        to.  With from_name, the registry is first asked to mount the
+        blob from that repository instead, which costs no more than
+        starting an upload, as a registry that can't mount it starts
+        the upload anyway; None if it was mounted"""
+        if from_name:
+            r = self._request("POST", name, "blobs/uploads/",
+                              params={"mount": digest, "from": from_name},
+                              scope_from=from_name)
+            if r.status_code == 201:
+                return None
+        else:
+            r = self._request("POST", name, "blobs/uploads/")
+        self._check(r, "start upload of {} to {}".format(digest, name))
+        return r.headers["Location"]
+
+    def upload_blob(self, name, digest, data, location=None):
+        """data can be bytes, or a function that returns an iterator of
+        bytes, which is called again if the upload has to be retried.
+        location is where start_upload said to upload it, if that has
+        been called"""
+        location = location or self.start_upload(name, digest)
+        r = self._request_url("PUT", location, name,
+                              params={"digest": digest}, data=data,
+                              headers={"Content-Type":
+                                       "application/octet-stream"})
+        self._check(r, "upload {} to {}".format(digest, name))
+
+    def stream_blob(self, name, digest, chunk_size=1024 * 1024):
+        r = self._request("GET", name, "blobs/" + digest, stream=True)
+        self._check(r, "get blob {} from {}".format(digest, name))
+        return r.iter_content(chunk_size)
+
+    def _request(self, method, name, path, scope_from=None, **kwargs):
+        url = "{}/v2/{}/{}".format(self.url, name, path)
+        return self._request_url(method, url, name, scope_from, **kwargs)
+
+    def _request_url(self, method, url, name, scope_from=None, **kwargs):
+        if url.startswith("/"):
+            url = self.url + url
+        headers = kwargs.pop("headers", {})
+        data = kwargs.pop("data", None)
+        for attempt in range(2):
+            token = self.tokens.get((name, scope_from))
+            if token:
+                headers["Authorization"] = "Bearer " + token
+            # A stream can only be read once, so it is opened afresh
+            r = self.session.request(method, url, headers=headers,
+                                     auth=None if token else self.basic_auth,
+                                     data=data() if callable(data) else data,
+                                     verify=ca_certificate(url),
+                                     timeout=(10, 300), **kwargs)
+            if r.status_code != 401 or attempt > 0 or \
+                    "WWW-Authenticate" not in r.headers:
+                return r
+            self._authenticate(r.headers["WWW-Authenticate"], name,
+                               scope_from)
+        return r
+
+    def _authenticate(self, challenge, name, scope_from):
+        if challenge.startswith("Basic "):
+            credentials = self._credentials()
+            if credentials is None:
+                raise RegistryException(
+                    "{} needs a username and password; run 'docker login "
+                    "{}'".format(self.url, self.auth_key))
+            self.basic_auth = credentials
+            return
+        if not challenge.startswith("Bearer "):
+            raise RegistryException("Unsupported registry authentication: " +
+                                    challenge)
+        params = dict(re.findall(r'(\w+)="([^"]*)"', challenge))
+        realm = params.pop("realm")
+        scope = ["repository:{}:pull,push".format(name)]
+        if scope_from:
+            scope.append("repository:{}:pull".format(scope_from))
+        params["scope"] = scope
+        r = requests.get(realm, params=params, auth=self._credentials(),
+                         verify=ca_certificate(realm), timeout=30)
+        self._check(r, "authenticate with " + realm)
+        data = r.json()
+        with self.lock:
+            self.tokens[(name, scope_from)] = data.get("token") or \
+                data["access_token"]
+
+    def _credentials(self):
+        if "DOCKER_USERNAME" in os.environ:
+            return os.environ["DOCKER_USERNAME"], \
+                os.environ["DOCKER_PASSWORD"]
+        path = expanduser("~/.docker/config.json")
+        if not isfile(path):
+            return None
+        with open(path) as f:
+            config = json.load(f)
+        helper = config.get("credHelpers", {}).get(self.auth_key) or \
+            config.get("credsStore")
+        if helper:
+            credentials = helper_credentials(helper, self.auth_key)
+            if credentials:
+                return credentials
+        entry = config.get("auths", {}).get(self.auth_key)
+        if entry and "auth" in entry:
+            user, password = base64.b64decode(
+                entry["auth"]).decode("utf-8").split(":", 1)
+            return user, password
+        return None
+
+    def _check(self, r, action):
+        if r.status_code >= 300:
+            raise RegistryException("Failed to {}: {} {}".format(
+                action, r.status_code, r.text.strip()))
+
+
+def helper_credentials(helper, server):
+    """Credentials from a docker credential helper (see 'credsStore' and
+    'credHelpers' in the docker config), or None if it has none"""
+    try:
+        r = subprocess.run(["docker-credential-" + helper, "get"],
+                           input=server.encode("utf-8"),
+                           stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except FileNotFoundError:
+        raise RegistryException(
+            "Docker credential helper docker-credential-{} is not "
+            "installed".format(helper))
+    if r.returncode != 0:
+        return None
+    data = json.loads(r.stdout.decode("utf-8"))
+    return data["Username"], data["Secret"]
+
+
+def ca_certificate(url):
+    """What requests should verify the server at url against: the CA
+    that docker trusts for it, if there is one"""
+    host = re.sub("^https?://", "", url).split("/")[0]
+    path = join(certs_dir, host, "ca.crt")
+    return path if isfile(path) else True
+
+
+def referenced_blobs(manifest):
+    """Digests of the config and layers of an image manifest"""
+    blobs = [x["digest"] for x in manifest.get("layers", [])]
+    if "config" in manifest:
+        blobs.insert(0, manifest["config"]["digest"])
+    return blobs
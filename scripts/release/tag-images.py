@@ -6,17 +6,30 @@ not set things to be the docker 'latest' tag though).  If run with the
 "publish" option it will also publish images to
 https://hub.docker.com/u/vimc
 
-Usage:
-  tag-images.py tag [--publish] <version>
-  tag-images.py publish <version>
+Tagging and publishing work directly on the registries' manifests, so
+no image data passes through the local docker daemon: a tag is just the
+manifest of the sha tag stored again under the release tag, and
+publishing copies only the layers that Docker Hub does not have yet.
 
+Usage:
+  tag-images.py tag [--publish] [options] <version>
+  tag-images.py publish [options] <version>
+
+Options:
+  --local-registry=<url>  Registry API to tag in
+                          [default: https://docker.montagu.dide.ic.ac.uk:5000]
+  --hub-registry=<url>    Registry API to publish to
+                          [default: https://registry-1.docker.io]
+  --workers=<n>           Number of images to publish at once [default: 4]
 """
-import docker
+import json
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
 import docopt
-from subprocess import run
 import os
-import re
 import git_helpers
+from registry import Registry, list_types, referenced_blobs
 from release_tag import get_latest_release_tag, validate_release_tag
 
 # This feels like something we should have elsewhere; it's a map of
@@ -41,6 +54,8 @@ container_repo_map = {
 
 registry_local = "docker.montagu.dide.ic.ac.uk:5000"
 registry_hub = "vimc"
+# The key that 'docker login' stores Docker Hub credentials under
+registry_hub_auth = "https://index.docker.io/v1/"
 
 
 class DockerTag:
@@ -66,43 +81,103 @@ class DockerTag:
         return DockerTag(registry, name, version)
 
 
-def set_image_tag(name, version):
+def set_image_tag(local, name, version):
     repo_name = container_repo_map[name]
     sha = git_helpers.get_past_submodule_version(repo_name, version)
-    d = docker.client.from_env()
-    img = d.images.pull(str(DockerTag(registry_local, name, sha)))
-    tag_and_push(img, registry_local, name, version)
+    body, media_type, _ = local.get_manifest(name, sha)
+    local.put_manifest(name, version, body, media_type)
+    return sha
 
 
-def set_image_tags(version):
+def set_image_tags(local, version):
     print("Setting image tags")
     for name in container_repo_map.keys():
         print("  - " + name)
-        set_image_tag(name, version)
-
-
-def publish_images(version):
-    d = docker.client.from_env()
+        set_image_tag(local, name, version)
+
+
+class Publisher:
+    """Copies images from the local registry to Docker Hub.  A blob that
+    Docker Hub doesn't have for an image is mounted, if it can be, from
+    the repository it most likely came from, rather than uploaded
+    again: one that the blob was copied to earlier in this run (e.g. a
+    shared base image layer) or, failing that, the repository of an
+    image built from the same source (see source_repository)."""
+
+    def __init__(self, local, hub):
+        self.local = local
+        self.hub = hub
+        self.lock = Lock()
+        # digest: hub repository known to hold it
+        self.blob_repos = {}
+        # digest: lock held while that blob is being copied
+        self.blob_locks = {}
+
+    def publish_image(self, name, tags):
+        hub_name = "{}/{}".format(registry_hub, name)
+        body, media_type, _ = self.local.get_manifest(name, tags[0])
+        self.copy_manifest_contents(name, hub_name, body, media_type)
+        for tag in tags:
+            if self.hub.has_manifest(hub_name, tag):
+                continue
+            print("  - {}:{}".format(hub_name, tag))
+            self.hub.put_manifest(hub_name, tag, body, media_type)
+
+    def copy_manifest_contents(self, name, hub_name, body, media_type):
+        manifest = json.loads(body.decode("utf-8"))
+        if media_type in list_types:
+            # A multi-platform image: each platform's manifest (and its
+            # blobs) must be present before the list can be stored
+            for entry in manifest["manifests"]:
+                digest = entry["digest"]
+                child, child_type, _ = self.local.get_manifest(name, digest)
+                self.copy_manifest_contents(name, hub_name, child,
+                                            child_type)
+                self.hub.put_manifest(hub_name, digest, child, child_type)
+        else:
+            for digest in referenced_blobs(manifest):
+                self.copy_blob(name, hub_name, digest)
+
+    def copy_blob(self, name, hub_name, digest):
+        with self.lock:
+            blob_lock = self.blob_locks.setdefault(digest, Lock())
+        with blob_lock:
+            if not self.hub.has_blob(hub_name, digest):
+                source = self.blob_repos.get(digest) or \
+                    source_repository(name)
+                location = self.hub.start_upload(hub_name, digest, source)
+                if location is not None:
+                    self.hub.upload_blob(
+                        hub_name, digest,
+                        lambda: self.local.stream_blob(name, digest),
+                        location)
+            with self.lock:
+                self.blob_repos[digest] = hub_name
+
+
+def source_repository(name):
+    """The Docker Hub repository of another image built from the same
+    source as name, which is where a blob that name's image doesn't
+    have yet is most likely to be (e.g. montagu-cli's layers are mostly
+    montagu-api's); None if there is no such image"""
+    siblings = sorted(k for k, v in container_repo_map.items()
+                      if v == container_repo_map[name] and k != name)
+    if not siblings:
+        return None
+    return "{}/{}".format(registry_hub, siblings[0])
+
+
+def publish_images(local, hub, version, workers=4):
     print("Pushing release to docker hub")
-    for name in container_repo_map.keys():
-        img = d.images.get(str(DockerTag(registry_local, name, version)))
-        publish_image(img, name)
-
-
-def publish_image(img, name):
-    tags = [DockerTag.parse(x) for x in img.tags]
-    published = [t.version for t in tags if t.registry == registry_hub]
-    existing = [t.version for t in tags if t.registry == registry_local]
-    for tag in set(existing) - set(published):
-        tag_and_push(img, registry_hub, name, tag)
+    publisher = Publisher(local, hub)
 
+    def publish(name):
+        sha = git_helpers.get_past_submodule_version(
+            container_repo_map[name], version)
+        publisher.publish_image(name, [version, sha])
 
-# NOTE: Using subprocess here and not the python docker module because
-# the latter does not support streaming as nicely as the CLI
-def tag_and_push(img, registry_local, name, tag):
-    t = DockerTag(registry_local, name, tag)
-    img.tag(t.repository, t.version)
-    run(["docker", "push", str(t)], check=True)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(publish, container_repo_map.keys()))
 
 
 def get_past_submodule_versions(master_repo_version):
@@ -117,9 +192,12 @@ if __name__ == "__main__":
         version = get_latest_release_tag()
     else:
         validate_release_tag(version)
+    local = Registry(args["--local-registry"])
+    hub = Registry(args["--hub-registry"], registry_hub_auth)
+    workers = int(args["--workers"])
     if args["tag"]:
-        set_image_tags(version)
+        set_image_tags(local, version)
         if args["--publish"]:
-            publish_images(version)
+            publish_images(local, hub, version, workers)
     elif args["publish"]:
-        publish_images(version)
+        publish_images(local, hub, version, workers)
@@ -1,13 +1,25 @@
+import json
 import os
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os.path import dirname, expanduser, isfile, join
+
 import requests
+from requests.adapters import HTTPAdapter
 
-from branch_diff import Difference
+from branch_diff import get_difference
 
 old_branch_pattern = re.compile(r"^i(\d+)($|[_-])")
 new_branch_pattern = re.compile(r"^(.+-\d+)($|[_-])")
 NOT_FOUND = "NOT FOUND"
 
+# Ticket data is remembered here for a little while, so that repeated
+# --test-run invocations don't look every ticket up again
+path_cache = join(expanduser("~"), ".cache", "montagu", "youtrack_tickets.json")
+cache_lifetime = 600
+max_workers = 8
+
 
 def get_token():
     token = os.environ.get('YOUTRACK_TOKEN')
@@ -43,28 +55,79 @@ class Ticket:
 class YouTrackHelper:
     base_url = "https://mrc-ide.myjetbrains.com/youtrack/rest/"
 
-    def __init__(self):
+    def __init__(self, base_url=None, use_cache=False):
+        """use_cache allows ticket data looked up in the last
+        cache_lifetime seconds to be used again"""
         self.token = get_token()
+        if base_url:
+            self.base_url = base_url
+        self.use_cache = use_cache
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({
+            "Authorization": "Bearer " + self.token,
+            "Accept": "application/json"
+        })
 
     def get_tickets(self, branch_names):
         branch_names = sorted(branch_names)
+        ids = {}
         for branch in branch_names:
             match_old = old_branch_pattern.match(branch)
             match_new = new_branch_pattern.match(branch)
             if match_old:
-                full_id = "VIMC-" + match_old.group(1)
-                yield self.get_ticket(branch, full_id)
+                ids[branch] = "VIMC-" + match_old.group(1)
             elif match_new:
-                yield self.get_ticket(branch, match_new.group(1))
-            else:
-                yield branch, NOT_FOUND
+                ids[branch] = match_new.group(1)
+        found = self.get_ticket_data(set(ids.values()))
+        for branch in branch_names:
+            data = found.get(ids.get(branch))
+            yield branch, Ticket(data) if data else NOT_FOUND
 
     def get_ticket(self, branch, full_id):
+        data = self.get_ticket_data([full_id]).get(full_id)
+        return branch, Ticket(data) if data else NOT_FOUND
+
+    def get_ticket_data(self, ids):
+        """Map of id to the issue data of each ticket that exists"""
+        cache = read_cache() if self.use_cache else {}
+        found = dict((i, cache[i]["data"]) for i in ids if i in cache)
+        todo = sorted(set(ids) - set(found))
+        if todo:
+            fetched = self.query_tickets(todo)
+            # Anything that the query didn't return is looked up on its
+            # own, in case the query couldn't find it
+            missing = [i for i in todo if i not in fetched]
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                for full_id, data in zip(missing,
+                                         pool.map(self.fetch_ticket, missing)):
+                    if data:
+                        fetched[full_id] = data
+            found.update(fetched)
+            write_cache(fetched)
+        return found
+
+    def query_tickets(self, ids):
+        """Fetch many tickets with one search; returns an empty map if
+        the server won't do it.  Results are keyed by the requested id,
+        which may differ in case from the one that YouTrack reports
+        (e.g. mrc-1234 for MRC-1234)."""
+        query = "issue id: " + ", ".join(ids)
+        r = self.request("issue", params={"filter": query, "max": len(ids)})
+        if r.status_code != 200:
+            return {}
+        data = r.json()
+        if isinstance(data, dict):
+            data = data.get("issue", [])
+        requested = dict((i.upper(), i) for i in ids)
+        return dict((requested[x["id"].upper()], x) for x in data
+                    if x["id"].upper() in requested)
+
+    def fetch_ticket(self, full_id):
         r = self.request("issue/" + full_id)
-        if r.status_code == 200:
-            return branch, Ticket(r.json())
-        else:
-            return branch, NOT_FOUND
+        return r.json() if r.status_code == 200 else None
 
     def add_build_tag(self, tag):
         template = "admin/customfield/buildBundle/vimc: Fixed in builds1/{tag}"
@@ -78,18 +141,51 @@ class YouTrackHelper:
         r = self.request(fragment, method="post")
         return r.status_code == 200, r
 
-    def request(self, url_fragment, method="get"):
-        headers = {
-            "Authorization": "Bearer " + self.token,
-            "Accept": "application/json"
-        }
+    def modify_tickets(self, full_ids, command):
+        """Run command on each ticket, several at once; returns a list
+        of (id, success, response)"""
+        def modify(full_id):
+            return (full_id,) + self.modify_ticket(full_id, command)
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            return list(pool.map(modify, full_ids))
+
+    def request(self, url_fragment, method="get", params=None):
         url = self.base_url + url_fragment
-        response = requests.request(method, url, headers=headers)
+        response = self.session.request(method, url, params=params,
+                                        timeout=(10, 60))
         if response.status_code == 401:
             raise Exception("Failed to authorize against YouTrack")
         return response
 
 
+def read_cache():
+    """Map of id to {"time": when it was fetched, "data": issue data}
+    for each ticket fetched in the last cache_lifetime seconds"""
+    if not isfile(path_cache):
+        return {}
+    try:
+        with open(path_cache, 'r') as f:
+            cache = json.load(f)
+    except ValueError:
+        return {}
+    now = time.time()
+    return dict((k, v) for k, v in cache.items()
+                if now - v["time"] < cache_lifetime)
+
+
+def write_cache(tickets):
+    if not tickets:
+        return
+    os.makedirs(dirname(path_cache), exist_ok=True)
+    now = time.time()
+    cache = read_cache()
+    cache.update((k, {"time": now, "data": v}) for k, v in tickets.items())
+    tmp = path_cache + ".tmp"
+    with open(tmp, 'w') as f:
+        json.dump(cache, f)
+    os.replace(tmp, path_cache)
+
+
 def check_ticket(branch, ticket):
     problem = False
     print("* " + branch, end="")
@@ -109,9 +205,9 @@ def check_ticket(branch, ticket):
     return problem
 
 
-def check_tickets(latest_tag):
-    diff = Difference(latest_tag)
-    yt = YouTrackHelper()
+def check_tickets(latest_tag, use_cache=False):
+    diff = get_difference(latest_tag)
+    yt = YouTrackHelper(use_cache=use_cache)
     pairs = list(yt.get_tickets(diff.branches))
     problems = False
 
@@ -141,13 +237,12 @@ def tag_tickets(tickets, tag):
                                         text=response.text))
         return problems
 
-    for ticket in tickets:
-        if ticket == NOT_FOUND:
-            continue
-        success, response = yt.modify_ticket(ticket.id, "Fixed in build " + tag)
+    ids = [ticket.id for ticket in tickets if ticket != NOT_FOUND]
+    for (id, success, response) in yt.modify_tickets(ids,
+                                                     "Fixed in build " + tag):
         if not success:
             template = "Failed to tag {id}. {status}: {text}"
-            problems.append(template.format(id=ticket.id,
+            problems.append(template.format(id=id,
                                             status=response.status_code,
                                             text=response.text))
     return problems
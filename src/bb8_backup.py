@@ -1,6 +1,8 @@
 from os.path import abspath
 from subprocess import run
 
+import events
+
 targets = ["orderly", "main_db_restore"]
 finished_setup = False
 bb8_dir = "../montagu-bb8/bb8"
@@ -20,7 +22,7 @@ def setup():
     global finished_setup
     template = "- Configuring and installing bb8 backup service with these " \
                "targets: {}"
-    print(template.format(targets))
+    events.info(template.format(targets))
     config_path = abspath("../montagu-bb8/config.json")
     args = ["./setup", config_path] + targets
     run(args, cwd=bb8_dir, check=True)
@@ -29,17 +31,17 @@ def setup():
 
 @requires_bb8_setup
 def backup():
-    print("Performing bb8 backup")
+    events.info("Performing bb8 backup")
     run(["bb8", "backup"], check=True)
 
 
 @requires_bb8_setup
 def schedule():
-    print("Scheduling bb8 backup")
+    events.info("Scheduling bb8 backup")
     run("./schedule", cwd=bb8_dir, check=True)
 
 
 @requires_bb8_setup
 def restore():
-    print("Restoring from remote bb8 backup")
+    events.info("Restoring from remote bb8 backup")
     run(["bb8", "restore"], check=True)
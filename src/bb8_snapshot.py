@@ -0,0 +1,229 @@
+import hashlib
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from os.path import abspath, isfile, join
+from subprocess import run, PIPE, DEVNULL
+
+import bb8_backup
+import events
+import paths
+import versions
+from docker_helpers import image_name, pull
+
+# A local snapshot of the volumes that a bb8 restore writes, so that
+# restoring the same backup again (as UAT and science do on every
+# deploy) doesn't mean pulling everything from the remote target.
+#
+# After a remote restore each volume is archived into paths.snapshots
+# as a few gzipped tars (the top level entries of the volume are dealt
+# out between them by size), which are written, checksummed and later
+# extracted in parallel.  The snapshot is tagged with the generation of
+# the remote backup, which is the time of each target's latest backup
+# as reported by 'bb8 status', so any new backup invalidates it.  If
+# the generation can't be worked out we always restore from the remote.
+#
+# The volumes are archived with the db image, for GNU tar; ownership is
+# kept by number, as the postgres user only exists in that image.
+
+# Logical volume names (see service.components)
+snapshot_volumes = ["db", "orderly"]
+parts_per_volume = 4
+path_manifest = join(paths.snapshots, "snapshot.json")
+
+create_script = r"""
+set -e
+cd /from
+rm -f /snap/"$1".*
+stat -c '%u %g %a' . > /snap/"$1".root
+if [ -n "$(ls -A)" ]; then
+  du -s -k $(ls -A) | sort -rn | awk -v n="$2" '
+    { best = 0
+      for (i = 1; i < n; i++) if (size[i] < size[best]) best = i
+      size[best] += $1
+      print $2 > ("/tmp/part." best) }'
+  pids=""
+  for list in /tmp/part.*; do
+    tar --numeric-owner -czf /snap/"$1".part"${list##*.}".tar.gz \
+      $(cat "$list") &
+    pids="$pids $!"
+  done
+  for pid in $pids; do
+    wait "$pid"
+  done
+fi
+"""
+
+restore_script = r"""
+set -e
+cd /to
+find . -mindepth 1 -maxdepth 1 -exec rm -rf {} +
+read uid gid mode < /snap/"$1".root
+chown "$uid:$gid" .
+chmod "$mode" .
+pids=""
+for part in /snap/"$1".part*.tar.gz; do
+  [ -e "$part" ] || continue
+  tar --numeric-owner -xzf "$part" &
+  pids="$pids $!"
+done
+for pid in $pids; do
+  wait "$pid"
+done
+"""
+
+
+def restore(service):
+    """Restore the bb8 targets, from the local snapshot if it matches
+    the current remote backup, and otherwise from bb8 (and then snapshot
+    the result).  Containers using the volumes are stopped while they
+    are written or archived."""
+    generation = remote_generation()
+    manifest = read_manifest()
+    if generation is not None and manifest is not None and \
+            manifest["generation"] == generation:
+        if verify(manifest):
+            events.info("Restoring bb8 backup from local snapshot of {}".format(
+                manifest["created"]))
+            with db_stopped(service):
+                restore_snapshot(service, manifest)
+            return
+        events.info("Local snapshot is damaged; discarding it")
+    if manifest is not None:
+        discard()
+    bb8_backup.restore()
+    if generation is not None:
+        with db_stopped(service):
+            create_snapshot(service, generation)
+
+
+@bb8_backup.requires_bb8_setup
+def remote_generation():
+    result = run(["bb8", "status"], stdout=PIPE, stderr=DEVNULL,
+                 universal_newlines=True)
+    if result.returncode != 0:
+        return None
+    return parse_generation(result.stdout)
+
+
+def parse_generation(status):
+    """The times of the backups that 'bb8 status' lists, for each of
+    our targets, e.g. "main_db_restore=2019-03-01T02:00:05,orderly=...".
+    Each is the latest timestamp on the lines from the target's name
+    up to the next target; None unless every target has one."""
+    found = {}
+    target = None
+    for line in status.splitlines():
+        for t in bb8_backup.targets:
+            if re.search(r"\b{}\b".format(re.escape(t)), line):
+                target = t
+        if target is not None:
+            for stamp in timestamp_pattern.findall(line):
+                stamp = stamp.replace(" ", "T")
+                found[target] = max(found.get(target, stamp), stamp)
+    if set(found) != set(bb8_backup.targets):
+        return None
+    return ",".join("{}={}".format(t, found[t]) for t in sorted(found))
+
+
+timestamp_pattern = re.compile(
+    r"\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(?:\.\d+)?")
+
+
+def read_manifest():
+    if not isfile(path_manifest):
+        return None
+    with open(path_manifest, 'r') as f:
+        return json.load(f)
+
+
+def discard():
+    paths.delete_safely(paths.snapshots)
+
+
+@contextmanager
+def db_stopped(service):
+    db = service.db
+    running = db is not None and db.status == "running"
+    if running:
+        events.info("- Stopping database while its volume is copied")
+        db.stop()
+    try:
+        yield
+    finally:
+        if running:
+            db.start()
+
+
+def snapshot_image():
+    image = image_name("montagu-db", versions.db)
+    pull(image)
+    return image
+
+
+def run_in_helper(image, volume, mount, script, *args):
+    run(["docker", "run", "--rm",
+         "-v", "{}:{}".format(volume, mount),
+         "-v", "{}:/snap".format(abspath(paths.snapshots)),
+         "--entrypoint", "sh",
+         image, "-c", script, "snapshot"] + list(args), check=True)
+
+
+def create_snapshot(service, generation):
+    events.info("Saving local snapshot of the bb8 backup")
+    os.makedirs(paths.snapshots, exist_ok=True)
+    image = snapshot_image()
+
+    def archive(name):
+        run_in_helper(image, service.volume_name(name), "/from:ro",
+                      create_script, name, str(parts_per_volume))
+
+    with ThreadPoolExecutor(max_workers=len(snapshot_volumes)) as pool:
+        list(pool.map(archive, snapshot_volumes))
+    files = sorted(f for f in os.listdir(paths.snapshots)
+                   if f.split(".")[0] in snapshot_volumes)
+    manifest = {
+        "generation": generation,
+        "created": str(datetime.now()),
+        "checksums": dict(zip(files, checksums(files)))
+    }
+    # Written last, so that a half-made snapshot is never used
+    tmp = path_manifest + ".tmp"
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(tmp, path_manifest)
+
+
+def restore_snapshot(service, manifest):
+    image = snapshot_image()
+
+    def extract(name):
+        run_in_helper(image, service.volume_name(name), "/to",
+                      restore_script, name)
+
+    with ThreadPoolExecutor(max_workers=len(snapshot_volumes)) as pool:
+        list(pool.map(extract, snapshot_volumes))
+
+
+def verify(manifest):
+    files = sorted(manifest["checksums"].keys())
+    if not all(isfile(join(paths.snapshots, f)) for f in files):
+        return False
+    return checksums(files) == [manifest["checksums"][f] for f in files]
+
+
+def checksums(files):
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        return list(pool.map(lambda f: sha256_file(join(paths.snapshots, f)),
+                             files))
+
+
+def sha256_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
@@ -0,0 +1,71 @@
+import events
+import timing
+from docker_helpers import exec_safely
+
+# Blue/green deploys (the 'blue_green' setting).  Rather than stopping a
+# running Montagu, a full deploy brings the new version up as the other
+# colour (see service.shared_components), alongside the live one:
+#
+# 1. start the other colour's containers, on a network of their own,
+#    with the shared database and message queue attached to it;
+# 2. configure them (deploy.configure_montagu) and wait until they are
+#    ready, talking to the new API directly rather than through the
+#    proxy, which still serves the live colour;
+# 3. switch the proxy over to the new colour;
+# 4. remove the old colour's containers.
+#
+# Both colours use the one database, so the old colour carries on
+# serving while migrations run: as in any rolling deploy, migrations
+# have to be compatible with the API that is live.  The shared
+# components are only recreated if their own images have changed, and
+# that is the only part of the deploy that interrupts service.
+
+
+def can_deploy(settings, status, data_exists, restore_due):
+    """Whether a full deploy can be done blue/green.  Anything that has
+    to replace the data (a first deploy, persist_data off, or a bb8
+    restore) needs Montagu stopped."""
+    return settings["blue_green"] and status == "running" and \
+        data_exists and not restore_due
+
+
+def deploy(live, configure, journal):
+    """Bring up, configure and switch to the colour that isn't live;
+    configure is called with that colour's MontaguService"""
+    target = live.other_colour()
+    target.live = False
+    events.info("Blue/green deploy: starting {} alongside {}".format(
+        target.colour, live.colour))
+    with timing.span("start"):
+        target.start()
+    configure(target)
+    with timing.span("switch"):
+        journal.run("switch", lambda: switch(live, target))
+    target.live = True
+    with timing.span("remove_old"):
+        journal.run("remove_old", live.remove_colour)
+    return target
+
+
+def switch(live, target):
+    """Point the proxy at target's containers rather than live's.  The
+    proxy finds them by name, so live's containers are taken out of its
+    sight before it is reloaded."""
+    proxy = live.proxy
+    events.info("Switching the proxy from {} to {}".format(
+        live.colour, target.colour))
+    proxy.reload()
+    attached = proxy.attrs["NetworkSettings"]["Networks"]
+    if target.colour == "green":
+        # Blue's containers are on the proxy's own network
+        if target.network_name not in attached:
+            target.client.networks.get(target.network_name).connect(proxy)
+        network = live.client.networks.get(live.network_name)
+        for container in live.own_containers():
+            container.reload()
+            if live.network_name in \
+                    container.attrs["NetworkSettings"]["Networks"]:
+                network.disconnect(container)
+    elif live.network_name in attached:
+        live.client.networks.get(live.network_name).disconnect(proxy)
+    exec_safely(proxy, ["nginx", "-s", "reload"], check=True)
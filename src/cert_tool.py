@@ -2,7 +2,11 @@ from os.path import abspath
 from subprocess import PIPE, run
 
 import versions
-from docker_helpers import get_image_name
+from docker_helpers import get_image_name, image_name
+
+
+def cert_tool_image():
+    return image_name("montagu-cert-tool", versions.cert_tool)
 
 
 def run_cert_tool(mode, volume_path, args=[], stdout=PIPE):
@@ -3,6 +3,7 @@ from os.path import join, isfile, abspath
 from shutil import copy
 from subprocess import run, PIPE
 
+import events
 import paths
 import versions
 from cert_tool import run_cert_tool
@@ -11,7 +12,7 @@ from settings import save_secret_to_file
 
 
 def get_ssl_certificate(certificate_type: str):
-    print("Obtaining SSL certificate")
+    events.info("Obtaining SSL certificate")
     makedirs(paths.ssl, exist_ok=True)
 
     if certificate_type == "production":
@@ -35,7 +36,7 @@ def cert_path(type, file):
 
 
 def self_signed_fresh():
-    print("- Generating self-signed certificate")
+    events.info("- Generating self-signed certificate")
     run_cert_tool("gen-self-signed", paths.ssl, args=["/working"])
     return {
         "certificate": join(paths.ssl, "certificate.pem"),
@@ -45,7 +46,7 @@ def self_signed_fresh():
 
 
 def self_signed():
-    print("- Using self-signed certificate from repository")
+    events.info("- Using self-signed certificate from repository")
     copy(cert_path("self_signed", "certificate.pem"), paths.ssl)
     copy(cert_path("self_signed", "ssl_key.pem"), paths.ssl)
     copy(cert_path("self_signed", "dhparam.pem"), paths.ssl)
@@ -57,12 +58,12 @@ def self_signed():
 
 
 def production():
-    print("- Using production certificate (montagu.vaccineimpact.org)")
+    events.info("- Using production certificate (montagu.vaccineimpact.org)")
     return real_certificate("production", "montagu.vaccineimpact.org.crt", "ssl/v2/production/")
 
 
 def support():
-    print("- Using support certificate (support.montagu.dide.ic.ac.uk)")
+    events.info("- Using support certificate (support.montagu.dide.ic.ac.uk)")
     return real_certificate("support", "support.montagu.crt", "ssl/v2/support/")
 
 
@@ -2,13 +2,13 @@
 import sys
 from os import chdir, makedirs
 
-from subprocess import run, PIPE
+from subprocess import run
 from os.path import abspath, dirname, join
 
 import paths
 import versions
 from database import user_configs
-from docker_helpers import get_image_name
+from docker_helpers import get_image_name, image_name
 from settings import get_settings
 from service import MontaguService
 
@@ -17,6 +17,11 @@ from service_config import api_db_user
 
 montagu_cli = "montagu-cli"
 
+
+def montagu_cli_image():
+    return image_name(montagu_cli, versions.api)
+
+
 def add_secure_config(password_group):
     makedirs(paths.config, exist_ok=True)
     path = join(paths.config, "cli.config.properties")
@@ -32,7 +37,8 @@ def add_secure_config(password_group):
 def cli():
     settings = get_settings(quiet=True)
 
-    command = get_docker_run_cmd("montagu_default")
+    service = MontaguService(settings)
+    command = get_docker_run_cmd(service.network_name)
 
     password_group = settings['password_group']
     if password_group is not None:
@@ -44,55 +50,11 @@ def cli():
     run(command + [name] + args)
 
 
-def add_test_users():
-    network = get_network()
-    settings = get_settings(quiet=True)
-
-    command = get_docker_run_cmd(network)
-
-    password_group = settings['password_group']
-    if password_group is not None:
-        command += add_secure_config(password_group)
-
-    name = get_image_name(montagu_cli, versions.api)
-
-    run_cmd(command, name, ["add", "Test Admin", "test.admin", "test.admin@imperial.ac.uk", "password", "--if-not-exists"])
-    run_cmd(command, name, ["addRole", "test.admin", "user"])
-    run_cmd(command, name, ["addRole", "test.admin", "touchstone-reviewer"])
-    run_cmd(command, name, ["addRole", "test.admin", "admin"])
-
-    run_cmd(command, name, ["add", "Test Modeller", "test.modeller", "test.modeller@imperial.ac.uk", "password", "--if-not-exists"])
-    run_cmd(command, name, ["addRole", "test.modeller", "user"])
-    run_cmd(command, name, ["addUserToGroup", "test.modeller", "IC-Garske"])
-    run_cmd(command, name, ["addUserToGroup", "test.modeller", "Harvard-Sweet"])
-
-
-def add_user(name, id, email, password):
-    network = get_network()
-    command = get_docker_run_cmd(network)
-    image = get_image_name(montagu_cli, versions.api)
-
-    run_cmd(command, image, ["add", name, id, email, password, "--if-not-exists"])
-    run_cmd(command, image, ["addRole", name, "user"])
-
-
-def get_network():
-    settings = get_settings(quiet=True)
-    service = MontaguService(settings)
-    return service.network_name
-
 def get_docker_run_cmd(network):
     return [
         "docker", "run", "--rm", "--network", network
     ]
 
-def run_cmd(command, name, args):
-    result = run(command + [name] + args, stderr=PIPE, stdout=PIPE)
-    print(result.stderr)
-    print(result.stdout)
-    if result.returncode > 0:
-        raise Exception("Command returned non-zero exit code")
-
 
 if __name__ == "__main__":
     try:
@@ -4,23 +4,45 @@ from docker_helpers import montagu_registry
 import versions
 
 
-def start(settings):
-    run("up -d", settings)
+def start(settings, services=None, project=None):
+    # With a list of services, only those containers are (re)created
+    run(" ".join(["up -d --no-deps"] + services) if services else "up -d",
+        settings, project)
 
 
-def stop(settings):
-    run("stop", settings)
-    run("rm -f", settings)
+def create(settings, services, project=None):
+    """Create the containers (and the project's network) without
+    starting them"""
+    run(" ".join(["up --no-start --no-deps"] + services), settings, project)
+
+
+def stop(settings, project=None):
+    run("stop", settings, project)
+    run("rm -f", settings, project)
+
+
+def remove(settings, services, project=None):
+    run(" ".join(["rm -s -f"] + services), settings, project)
+
+
+def down(settings, project=None):
+    run("down", settings, project)
 
 
 def pull(settings):
     run("pull", settings)
 
 
-def run(args, settings):
+def run(args, settings, project=None):
     docker_prefix = settings["docker_prefix"]
+    project = project or docker_prefix
     staging_file =  "-f ../docker-compose.staging.yml" if settings["fake_smtp"] else ""
-    prefix = 'docker-compose -f ../docker-compose.yml {} --project-name {} '.format(staging_file, docker_prefix)
+    # The second colour of a blue/green deploy uses the main project's
+    # volumes (see blue_green)
+    colour_file = "-f ../docker-compose.colour.yml" \
+        if project != docker_prefix else ""
+    prefix = 'docker-compose -f ../docker-compose.yml {} {} --project-name {} '.format(
+        staging_file, colour_file, project)
     cmd = prefix + args
     p = Popen(cmd, env=get_env(settings), shell=True)
     p.wait()
@@ -40,6 +62,8 @@ def get_env(settings):
         'MONTAGU_REGISTRY': montagu_registry,
         'VIMC_REGISTRY': "vimc",
 
+        'MONTAGU_DATA_PREFIX': settings["docker_prefix"],
+
         'MONTAGU_PORT': str(port),
         'MONTAGU_HOSTNAME': hostname,
 
@@ -0,0 +1,87 @@
+import tarfile
+import time
+from io import BytesIO
+from os.path import basename
+
+import events
+from docker_helpers import exec_safely
+
+
+# Configuring a container used to mean one `docker cp` process per
+# file plus one exec per `mkdir`/`touch`.  A ContainerSession instead
+# collects the files and shell commands for a container and sends them
+# when it is flushed (or when the `with` block ends): every file goes
+# in with a single `put_archive` call (docker creates any missing
+# parent directories), and then all the commands run, in order, in a
+# single exec.
+#
+#     with ContainerSession(service.api) as session:
+#         session.add_file("/etc/montagu/api/config.properties", text)
+#         session.run("touch /etc/montagu/api/go_signal")
+class ContainerSession:
+    def __init__(self, container):
+        self.container = container
+        self.files = {}
+        self.commands = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def add_file(self, path, contents, mode=0o644):
+        """Queue a file for writing into the container; contents can be
+        str or bytes and path must be absolute"""
+        if not path.startswith("/"):
+            raise Exception("Container paths must be absolute: " + path)
+        if isinstance(contents, str):
+            contents = contents.encode("utf-8")
+        self.files[path] = (contents, mode)
+
+    def add_local_file(self, local_path, path, mode=0o644):
+        with open(local_path, "rb") as f:
+            self.add_file(path, f.read(), mode)
+
+    def run(self, command):
+        """Queue a shell command; these are run after all files are
+        written, and stop at the first that fails"""
+        self.commands.append(command)
+
+    def read_file(self, path):
+        stream, _ = self.container.get_archive(path)
+        data = BytesIO(b"".join(stream))
+        with tarfile.open(fileobj=data) as tar:
+            member = tar.getmember(basename(path.rstrip("/")))
+            return tar.extractfile(member).read()
+
+    def flush(self):
+        files = sorted(self.files.keys())
+        commands = len(self.commands)
+        if self.files:
+            ok = self.container.put_archive("/", self._archive())
+            if not ok:
+                raise Exception("Failed to copy files into {}".format(
+                    self.container.name))
+            self.files = {}
+        if self.commands:
+            cmd = ["sh", "-c", " && ".join(self.commands)]
+            self.commands = []
+            exec_safely(self.container, cmd, check=True)
+        if files or commands:
+            events.emit("container_configured",
+                        container=self.container.name, files=files,
+                        commands=commands)
+
+    def _archive(self):
+        data = BytesIO()
+        now = time.time()
+        with tarfile.open(fileobj=data, mode="w") as tar:
+            for path, (contents, mode) in sorted(self.files.items()):
+                info = tarfile.TarInfo(path.lstrip("/"))
+                info.size = len(contents)
+                info.mode = mode
+                info.mtime = now
+                tar.addfile(info, BytesIO(contents))
+        return data.getvalue()
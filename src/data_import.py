@@ -1,37 +1,52 @@
-from subprocess import check_output
-
-import bb8_backup
+import events
 import versions
-from docker_helpers import docker_cp
+from docker_helpers import exec_with_stdin
+from readiness import wait_until_ready, database_probe
 from teamcity import save_artifact
 
+def get_dump(settings):
+    """Download the dump that the initial data import will use, if any;
+    this doesn't need Montagu, so can be done before it is stopped"""
+    source = settings["initial_data_source"]
+    if source == "test_data":
+        return get_artifact("montagu_api_generate_test_data", "test-data.bin", commit_hash=versions.api)
+    elif source == "legacy":
+        return get_artifact("montagu_MontaguLegacyData_Build", "montagu.dump", "legacy-data.dump")
+    elif source in ["minimal", "bb8_restore"]:
+        return None
+    else:
+        raise Exception("Unknown mode '{}'".format(source))
+
 
-def do(service):
+def do(service, dump_path=None):
+    """dump_path is the result of get_dump, if that has already been
+    called"""
     source = service.settings["initial_data_source"]
-    print("Running initial data import with mode: {}".format(source))
+    events.info("Running initial data import with mode: {}".format(source))
     if source == "minimal":
-        print("- Nothing to do (migrations will insert minimal data)")
-    elif source == "test_data":
-        local_path = get_artifact("montagu_api_generate_test_data", "test-data.bin", commit_hash=versions.api)
-        import_dump(service.db, local_path)
-    elif source == "legacy":
-        local_path = get_artifact("montagu_MontaguLegacyData_Build", "montagu.dump", "legacy-data.dump")
-        import_dump(service.db, local_path)
+        events.info("- Nothing to do (migrations will insert minimal data)")
+    elif source in ["test_data", "legacy"]:
+        import_dump(service, dump_path or get_dump(service.settings))
     elif source == "bb8_restore":
-        print("Nothing to do: Already ran bb8 before starting services")
+        events.info("Nothing to do: Already ran bb8 before starting services")
     else:
         raise Exception("Unknown mode '{}'".format(source))
 
 
-def import_dump(db, dump_path):
-    print("- Copying {} to DB container and importing into database".format(dump_path))
-    target_path = "/tmp/import.dump"
-    docker_cp(dump_path, db.name, target_path)
-    check_output(["docker", "exec", db.name, "/montagu-bin/restore-dump.sh", target_path])
+def import_dump(service, dump_path):
+    """The dump is streamed into the database image's restore-dump.sh,
+    which recreates the database and restores into it exactly as it
+    always has, but reads the dump from stdin rather than from a copy
+    inside the container."""
+    wait_until_ready(database_probe(service))
+    events.info("- Streaming {} into the database's restore-dump.sh".format(
+        dump_path))
+    exec_with_stdin(service.db, ["/montagu-bin/restore-dump.sh", "/dev/stdin"],
+                    dump_path, check=True)
 
 
 def get_artifact(build_type, remote_path, local_name=None, commit_hash=None):
     local_name = local_name or remote_path
-    print("- Downloading {remote_path} from TeamCity (build type ID: {build_type}) and saving as {local_name}".format(
+    events.info("- Downloading {remote_path} from TeamCity (build type ID: {build_type}) and saving as {local_name}".format(
         remote_path=remote_path, build_type=build_type, local_name=local_name))
     return save_artifact(build_type, remote_path, local_name, commit_hash)
@@ -5,8 +5,11 @@ from types import SimpleNamespace
 
 import psycopg2
 
+import events
+import timing
 import versions
-from docker_helpers import get_image_name, pull, exec_safely
+from docker_helpers import image_name, pull, exec_safely
+from readiness import wait_until_ready, database_probe
 from service_config import api_db_user
 from settings import get_secret
 
@@ -17,7 +20,6 @@ protected_tables = ["gavi_support_level", "activity_type",
                     "gender",
                     "responsibility_set_status",
                     "impact_outcome",
-                    "gavi_support_level",
                     "support_type",
                     "touchstone_status",
                     "permission",
@@ -37,6 +39,16 @@ def user_configs(password_group):
     ]
 
 
+def vault_paths(password_group, enable_db_replication):
+    """The vault paths of every database password that setup will need"""
+    if password_group is None:
+        return []
+    users = [u.name for u in user_configs(password_group)]
+    if enable_db_replication:
+        users += ["barman", "streaming_barman"]
+    return [VaultPassword(password_group, u)._path() for u in users]
+
+
 class GeneratePassword:
     def get(self):
         return ''.join(random.SystemRandom().choice(
@@ -131,75 +143,136 @@ def set_password(db, user):
                                                               password=user.password))
 
 
-def revoke_all(db, user):
-    def revoke_all_on(what):
-        db.execute(
-            "REVOKE ALL PRIVILEGES ON ALL {what} IN SCHEMA public FROM {name}".format(
-                name=user.name, what=what))
-
-    revoke_all_on("tables")
-    revoke_all_on("sequences")
-    revoke_all_on("functions")
-
-
-def revoke_write_on_protected_tables(db, user):
-    def revoke_specific_on(what):
-        db.execute(
-            "REVOKE INSERT, UPDATE, DELETE ON {what} FROM {name}".format(
-                name=user.name, what=what))
-
-    for table in protected_tables:
-        revoke_specific_on(table)
-
-
-def grant_all(db, user):
-    def grant_all_on(what):
-        db.execute(
-            "GRANT ALL PRIVILEGES ON ALL {what} IN SCHEMA public TO {name}".format(
-                name=user.name, what=what))
-
-    print("  - Granting all permissions to {name}".format(name=user.name))
-    grant_all_on("tables")
-    grant_all_on("sequences")
-    grant_all_on("functions")
-
-
-def grant_readonly(db, user):
-    print("  - Granting readonly permissions to {name}".format(name=user.name))
-    db.execute("GRANT SELECT ON ALL TABLES IN SCHEMA public TO {name}".format(
-        name=user.name))
-
-
-def set_permissions(db, user):
-    revoke_all(db, user)
+# What 'GRANT ALL PRIVILEGES ON ALL {tables,sequences,functions}'
+# amounts to, as reported by aclexplode
+all_privileges = {
+    "table": {"SELECT", "INSERT", "UPDATE", "DELETE", "TRUNCATE",
+              "REFERENCES", "TRIGGER"},
+    "sequence": {"USAGE", "SELECT", "UPDATE"},
+    "function": {"EXECUTE"}
+}
+# These are never granted on the protected tables
+protected_privileges = {"INSERT", "UPDATE", "DELETE"}
+
+# Every privilege held on every table, view, sequence and function in
+# the public schema, in one go.  Objects with no explicit ACL get the
+# defaults, so that privileges everyone has via PUBLIC are visible.
+privileges_query = """SELECT x.kind, x.name, coalesce(r.rolname, 'PUBLIC'),
+       (x.acl).privilege_type
+FROM (
+  SELECT CASE WHEN c.relkind = 'S' THEN 'sequence' ELSE 'table' END AS kind,
+         quote_ident(c.relname) AS name,
+         aclexplode(coalesce(c.relacl, acldefault(
+           CASE WHEN c.relkind = 'S' THEN 's' ELSE 'r' END::"char",
+           c.relowner))) AS acl
+  FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+  WHERE n.nspname = 'public' AND c.relkind IN ('r', 'v', 'm', 'f', 'p', 'S')
+  UNION ALL
+  SELECT 'function', p.oid::regprocedure::text,
+         aclexplode(coalesce(p.proacl, acldefault('f', p.proowner)))
+  FROM pg_proc p JOIN pg_namespace n ON n.oid = p.pronamespace
+  WHERE n.nspname = 'public'
+) x LEFT JOIN pg_roles r ON r.oid = (x.acl).grantee"""
+
+
+def get_privileges(db):
+    """Returns a dictionary mapping (kind, name) for each object to a
+    dictionary mapping role name to the set of privileges it holds"""
+    db.execute(privileges_query)
+    ret = {}
+    for kind, name, role, privilege in db.fetchall():
+        ret.setdefault((kind, name), {}).setdefault(role, set()).add(privilege)
+    return ret
+
+
+def desired_privileges(user, kind, name):
     if user.permissions == 'all':
-        grant_all(db, user)
+        privileges = set(all_privileges[kind])
     elif user.permissions == 'readonly':
-        grant_readonly(db, user)
-    elif user.permissions == 'pass':
-        pass
+        privileges = {"SELECT"} if kind == "table" else set()
     else:
         template = "Unhandled permission type '{permissions}' for user '{name}'"
         raise Exception(
             template.format(name=user.name, permissions=user.permissions))
+    if kind == "table" and name in protected_tables:
+        privileges -= protected_privileges
+    return privileges
+
+
+def permission_changes(current, users):
+    """Compare the privileges that users currently hold against the ones
+    they should have, and return a dictionary mapping (user, action,
+    kind, privileges) to the list of objects the change applies to,
+    where action is GRANT or REVOKE"""
+    changes = {}
+    for (kind, name), held in sorted(current.items()):
+        public = held.get("PUBLIC", set())
+        for user in users:
+            if user.permissions == 'pass':
+                continue
+            want = desired_privileges(user, kind, name)
+            explicit = held.get(user.name, set())
+            # Privileges granted to PUBLIC cannot be revoked from a
+            # single user, and do not need granting to one either.
+            grant = frozenset(want - explicit - public)
+            revoke = frozenset(explicit - want)
+            if grant:
+                changes.setdefault((user.name, "GRANT", kind, grant),
+                                   []).append(name)
+            if revoke:
+                changes.setdefault((user.name, "REVOKE", kind, revoke),
+                                   []).append(name)
+    return changes
+
+
+def permission_statements(changes):
+    template = "{action} {privileges} ON {kind} {names} {direction} {user}"
+    for (user, action, kind, privileges), names in sorted(changes.items()):
+        yield template.format(action=action,
+                              privileges=", ".join(sorted(privileges)),
+                              kind=kind.upper(),
+                              names=", ".join(names),
+                              direction="TO" if action == "GRANT" else "FROM",
+                              user=user)
+
+
+def reconcile_permissions(root_password, users):
+    """Bring every user's privileges into line with its UserConfig,
+    reading the current state with a single query and applying only the
+    differences, all in one transaction"""
+    with connect(root_user, root_password) as conn:
+        with conn.cursor() as db:
+            changes = permission_changes(get_privileges(db), users)
+            for statement in permission_statements(changes):
+                db.execute(statement)
+        conn.commit()
+    if not changes:
+        events.info("  - Permissions are already up to date")
+    for (user, action, kind, privileges), names in sorted(changes.items()):
+        events.info("  - {user}: {action} {privileges} on {n} {kind}(s)".format(
+            user=user, action=action, privileges=", ".join(sorted(privileges)),
+            n=len(names), kind=kind))
+    return changes
 
 
 def migrate_schema_core(service, root_password):
     network_name = service.network_name
-    print("- migrating schema")
-    image = "vimc/{name}:{version}".format(name="montagu-migrate",
-                                           version=versions.db)
+    events.info("- migrating schema")
+    image = migrate_image()
     pull(image)
     cmd = ["docker", "run", "--rm", "--network=" + network_name, image] + \
           ["-user=vimc", "-password=" + root_password, "migrate"]
     run(cmd, check=True)
 
 
+def migrate_image():
+    return image_name("montagu-migrate", versions.db)
+
+
 def setup_user(db, user):
-    print(" - " + user.name)
+    events.info(" - " + user.name)
     create_user(db, user)
     set_password(db, user)
-    set_permissions(db, user)
 
 
 def for_each_user(root_password, users, operation):
@@ -213,44 +286,43 @@ def for_each_user(root_password, users, operation):
 
 
 def setup(service):
-    print("Waiting for the database to accept connections")
-    exec_safely(service.db, ["montagu-wait.sh", "3600"], check=True)
+    events.info("Waiting for the database to accept connections")
+    wait_until_ready(database_probe(service))
     password_group = service.settings["password_group"]
-    print("Setting up database users")
-    print("- Scrambling root password")
+    events.info("Setting up database users")
+    events.info("- Scrambling root password")
     if password_group is not None:
         root_password = GeneratePassword().get()
     else:
         root_password = 'changeme'
     set_root_password(service, root_password)
 
-    print("- Getting user configurations")
+    events.info("- Getting user configurations")
     users = user_configs(password_group)
 
-    print("- Getting user passwords")
+    events.info("- Getting user passwords")
     passwords = {}
     for user in users:
-        print(" - {name}: {source}".format(name=user.name,
-                                           source=user.password_source))
+        events.info(" - {name}: {source}".format(name=user.name,
+                                                 source=user.password_source))
         passwords[user.name] = user.password
 
     # NOTE: As I work through this - why not set up users *after* the
     # schema migration?  This is because the migration user needs to
     # exist, though in practice we don't use them so this could be
     # reordered later.
-    print("- Updating database users")
+    events.info("- Updating database users")
     for_each_user(root_password, users, setup_user)
 
-    print("- Migrating database schema")
-    migrate_schema_core(service, root_password)
+    events.info("- Migrating database schema")
+    with timing.span("database.migrate"):
+        migrate_schema_core(service, root_password)
 
-    print("- Refreshing permissions")
-    # The migrations may have added new tables, so we should set the permissions
-    # again, in case users need to have permissions on these new tables
-    for_each_user(root_password, users, set_permissions)
-
-    # Revoke specific permissions now that all tables have been created.
-    for_each_user(root_password, users, revoke_write_on_protected_tables)
+    # Permissions are set once all tables have been created, so that
+    # users get permissions on any new tables too
+    events.info("- Refreshing permissions")
+    with timing.span("database.permissions"):
+        reconcile_permissions(root_password, users)
 
     setup_streaming_replication(root_password, service)
 
@@ -267,7 +339,7 @@ def setup(service):
 # VIMC-1560) because that is likely to affect how we deal with users
 def setup_streaming_replication(root_password, service):
     if service.settings['enable_db_replication']:
-        print("Setting up streaming replication")
+        events.info("Setting up streaming replication")
         password_group = service.settings['password_group']
         barman = UserConfig.create("barman", "pass",
                                    password_group, "superuser")
@@ -285,7 +357,7 @@ def setup_streaming_replication(root_password, service):
 
 
 def prepare_db_for_import(service):
-    print("Preparing databse for import")
+    events.info("Preparing database for import")
     ## NOTE: this could otherwise be done by connecting using the
     ## connection function, but that that requires further changes to
     ## the connect function to allow connection to the postgres
@@ -293,10 +365,18 @@ def prepare_db_for_import(service):
     ## allows us to avoid working out what the root password will be
     ## because we're interating without passwords over exec.
     db = service.db
-    print("- deleting and recreating database")
-    db.exec_run(["dropdb", "-U", "vimc", "--if-exists", "montagu"])
-    db.exec_run(["createdb", "-U", "vimc", "montagu"])
-    print("- configuring users")
+    events.info("- deleting and recreating database")
+    exec_safely(db, ["dropdb", "-U", "vimc", "--if-exists", "montagu"],
+                check=True)
+    exec_safely(db, ["createdb", "-U", "vimc", "montagu"], check=True)
+    events.info("- configuring users")
+    # Roles belong to the cluster, so survive the database being dropped
     users = user_configs(service.settings["password_group"])
-    for user in users:
-        db.exec_run(["createuser", "-U", "vimc", user.name])
+    sql = "\n".join("""IF NOT EXISTS (SELECT FROM pg_catalog.pg_roles
+                       WHERE rolname = '{name}') THEN
+      CREATE ROLE {name} LOGIN;
+   END IF;""".format(name=user.name) for user in users)
+    exec_safely(db, ["psql", "-U", "vimc", "-d", "postgres",
+                     "-v", "ON_ERROR_STOP=1", "-c",
+                     "DO $body$ BEGIN {} END $body$".format(sql)],
+                check=True)
@@ -0,0 +1,395 @@
+import os
+import tarfile
+from datetime import datetime, timezone
+from os.path import abspath, isdir, join
+
+import docker
+
+import events
+import paths
+import versions
+from database import VaultPassword, root_user
+from docker_helpers import exec_safely, image_name, pull
+from readiness import Probe, wait_until_ready, database_probe
+
+# Online backups, built on the replication users that
+# database.setup_streaming_replication creates, so Montagu never needs
+# to be stopped to take one:
+#
+# * WAL is archived continuously by pg_receivewal, running in the
+#   wal_archiver container alongside Montagu and streaming into
+#   paths.db_backups/wal through a replication slot, so no WAL is lost
+#   while it, or the database, restarts.  Both are left alone by a
+#   deploy, which only starts the archiver if it isn't running (or
+#   runs an old image), and only takes a new base backup when the slot
+#   has gone (with the database, say) and has to be created again, as
+#   the archive has a gap from then on.  The slot is only dropped once
+#   db_backup is turned off, so that postgres never keeps WAL for an
+#   archiver that isn't coming back.
+# * Base backups are taken with pg_basebackup into
+#   paths.db_backups/base/<UTC time>.
+# * A restore extracts the newest suitable base backup into a volume and
+#   sets postgres up to replay the archived WAL from it, optionally up to
+#   a point in time, so recovery only has to replay the WAL written
+#   since that base backup.  Once postgres has finished recovering, the
+#   recovery settings are removed again (see finish_recovery), so they
+#   are never applied to a later restart.
+# * verify() restores into a scratch volume and starts a scratch db
+#   container (with no ports, off the Montagu network) to check that the
+#   backup is usable, while the live stack carries on.
+#
+# All the postgres tools come from the montagu-db image.  The target is
+# a local directory, standing in for remote storage.
+
+replication_user = "streaming_barman"
+slot_name = "montagu_backup"
+keep_base_backups = 2
+base_backup_format = "%Y%m%dT%H%M%SZ"
+verify_timeout = 3600
+
+path_base = join(paths.db_backups, "base")
+path_wal = join(paths.db_backups, "wal")
+
+
+# Arguments: base backup directory name, recovery target time (or "")
+restore_script = r"""
+set -e
+base=/backup/base/$1
+find /pgdata -mindepth 1 -maxdepth 1 -exec rm -rf {} +
+tar -xzf "$base/base.tar.gz" -C /pgdata
+mkdir -p /pgdata/pg_wal /pgdata/restore_wal
+tar -xzf "$base/pg_wal.tar.gz" -C /pgdata/pg_wal
+start=$(sed -n 's/^START WAL LOCATION: .*(file \([0-9A-F]*\))$/\1/p' \
+  /pgdata/backup_label)
+ls /backup/wal | awk -v s="$start" \
+  '{ n = $0; sub(/\.partial$/, "", n); if (n >= s) print $0 }' |
+  while read -r f; do
+    cp "/backup/wal/$f" "/pgdata/restore_wal/${f%.partial}"
+  done
+if [ "$(cut -d. -f1 /pgdata/PG_VERSION)" -ge 12 ]; then
+  conf=/pgdata/postgresql.auto.conf
+  touch /pgdata/recovery.signal
+else
+  conf=/pgdata/recovery.conf
+fi
+echo "restore_command = 'cp /pgdata/restore_wal/%f %p'" >> "$conf"
+if [ -n "$2" ]; then
+  echo "recovery_target_time = '$2'" >> "$conf"
+fi
+echo "recovery_target_action = 'promote'" >> "$conf"
+chown -R postgres:postgres /pgdata
+chmod 700 /pgdata
+"""
+
+
+def db_image():
+    image = image_name("montagu-db", versions.db)
+    pull(image)
+    return image
+
+
+def replication_password(service):
+    return VaultPassword(service.settings["password_group"],
+                         replication_user).get()
+
+
+def host_user():
+    return "{}:{}".format(os.getuid(), os.getgid())
+
+
+def psql(container, sql, database="postgres"):
+    result = exec_safely(container, ["psql", "-U", root_user, "-d", database,
+                                     "-Atc", sql])
+    if result["ExitCode"] != 0:
+        raise Exception(result["Output"].decode("UTF-8").strip())
+    return result["Output"].decode("UTF-8").strip()
+
+
+def enabled(settings):
+    # The WAL archiver connects as the replication user
+    return settings["db_backup"] and settings["enable_db_replication"]
+
+
+def slot_query(active=None):
+    sql = "SELECT count(*) FROM pg_replication_slots " \
+          "WHERE slot_name = '{}'".format(slot_name)
+    return sql + " AND active" if active else sql
+
+
+def create_slot_sql():
+    # Reserve WAL from now, rather than from the archiver's first
+    # connection, so that the base backup is certainly covered
+    return "SELECT pg_create_physical_replication_slot('{}', true)".format(
+        slot_name)
+
+
+def drop_slot_sql():
+    return "SELECT pg_drop_replication_slot('{}')".format(slot_name)
+
+
+def has_slot(db):
+    return psql(db, slot_query()) != "0"
+
+
+def archiver_name(service):
+    # Not a compose service, so not part of MontaguService.status: it
+    # carries on while Montagu is stopped for a deploy
+    return "{}_wal_archiver_1".format(service.project)
+
+
+def archiver(service):
+    try:
+        return service.client.containers.get(archiver_name(service))
+    except docker.errors.NotFound:
+        return None
+
+
+def archiver_command(db_host):
+    """pg_receivewal's arguments.  It never creates the slot (see
+    configure), and exits when it loses the database, to be restarted by
+    docker, rather than retrying by itself"""
+    return ["-h", db_host, "-U", replication_user, "--slot", slot_name,
+            "-D", "/backup/wal", "--no-loop"]
+
+
+def archiver_is_current(service, image):
+    container = archiver(service)
+    return container is not None and container.status == "running" and \
+        container.attrs["Config"]["Image"] == image
+
+
+def start_archiving(service, image):
+    container = archiver(service)
+    if container is not None:
+        container.remove(force=True)
+    events.info("Starting WAL archiver")
+    os.makedirs(path_wal, exist_ok=True)
+    service.client.containers.run(
+        image,
+        entrypoint=["pg_receivewal"],
+        command=archiver_command(service.container_name("db")),
+        environment={"PGPASSWORD": replication_password(service)},
+        volumes={abspath(path_wal): {"bind": "/backup/wal", "mode": "rw"}},
+        user=host_user(),
+        network=service.shared_network_name,
+        name=archiver_name(service),
+        restart_policy={"Name": "always"},
+        detach=True)
+
+
+def stop_archiving(service):
+    """Remove the archiver.  Its slot is kept, so when it is started
+    again it carries on where it stopped"""
+    container = archiver(service)
+    if container is not None:
+        events.info("Stopping WAL archiver")
+        container.remove(force=True)
+
+
+def drop_slot(db):
+    """The database must be running for the slot to be dropped"""
+    if db is None or db.status != "running" or not has_slot(db):
+        return
+
+    # The slot can't be dropped until postgres notices that the
+    # archiver has gone
+    def released():
+        return psql(db, slot_query(active=True)) == "0"
+
+    wait_until_ready(Probe("Replication slot release", released, 60))
+    events.info("Dropping replication slot {}".format(slot_name))
+    psql(db, drop_slot_sql())
+
+
+def base_backup(service):
+    name = datetime.now(timezone.utc).strftime(base_backup_format)
+    events.info("Taking base backup {}".format(name))
+    os.makedirs(path_base, exist_ok=True)
+    client = service.client
+    client.containers.run(
+        db_image(),
+        entrypoint=["pg_basebackup"],
+        command=["-h", service.container_name("db"), "-U", replication_user,
+                 "-D", "/backup/base/" + name, "-Ft", "-z", "-X", "stream",
+                 "-c", "fast"],
+        environment={"PGPASSWORD": replication_password(service)},
+        volumes={abspath(path_base): {"bind": "/backup/base",
+                                      "mode": "rw"}},
+        user=host_user(),
+        network=service.shared_network_name,
+        remove=True)
+    prune()
+    return name
+
+
+def list_base_backups():
+    if not isdir(path_base):
+        return []
+    return sorted(x for x in os.listdir(path_base)
+                  if os.path.isfile(join(path_base, x, "base.tar.gz")))
+
+
+def start_wal_file(name):
+    with tarfile.open(join(path_base, name, "base.tar.gz")) as tar:
+        label = tar.extractfile("backup_label").read().decode("utf-8")
+    for line in label.splitlines():
+        if line.startswith("START WAL LOCATION"):
+            return line.split("(file ")[1].rstrip(")")
+    raise Exception("No start WAL location in base backup " + name)
+
+
+def prune():
+    """Remove all but the newest keep_base_backups base backups, and the
+    WAL that only older base backups needed"""
+    backups = list_base_backups()
+    for old in backups[:-keep_base_backups]:
+        events.info("- Removing old base backup {}".format(old))
+        paths.delete_safely(join(path_base, old))
+    kept = backups[-keep_base_backups:]
+    if not kept or not isdir(path_wal):
+        return
+    oldest = start_wal_file(kept[0])
+    for f in os.listdir(path_wal):
+        segment = f.split(".")[0]
+        if len(segment) == 24 and segment < oldest:
+            os.remove(join(path_wal, f))
+
+
+def choose_base_backup(target_time=None):
+    """The newest base backup taken before target_time (a UTC datetime),
+    or the newest of all"""
+    backups = list_base_backups()
+    if target_time is not None:
+        target = target_time.strftime(base_backup_format)
+        backups = [x for x in backups if x <= target]
+    if not backups:
+        raise Exception("There is no base backup to restore from")
+    return backups[-1]
+
+
+def restore_into_volume(service, volume, target_time=None):
+    base = choose_base_backup(target_time)
+    target = target_time.strftime("%Y-%m-%d %H:%M:%S+00") \
+        if target_time else ""
+    events.info("Restoring base backup {} into {} (recovering to {})".format(
+        base, volume, target or "the end of the archived WAL"))
+    service.client.containers.run(
+        db_image(),
+        entrypoint=["sh", "-c", restore_script, "restore"],
+        command=[base, target],
+        volumes={volume: {"bind": "/pgdata", "mode": "rw"},
+                 abspath(paths.db_backups): {"bind": "/backup",
+                                             "mode": "ro"}},
+        remove=True)
+    return base
+
+
+def start_scratch_db(service, volume):
+    # Not prefixed like our other containers, so that it never looks
+    # like part of the running service (see MontaguService.status)
+    name = "{}-db-verify".format(service.project)
+    return service.client.containers.run(
+        db_image(),
+        command="/etc/montagu/postgresql.conf",
+        volumes={volume: {"bind": "/pgdata", "mode": "rw"}},
+        shm_size="512M",
+        name=name,
+        detach=True)
+
+
+def finish_recovery(container):
+    """Wait for postgres to replay the archived WAL, then remove what
+    restore_script set up for it; postgres itself renames recovery.conf
+    (before version 12) or removes recovery.signal"""
+    def recovered():
+        return psql(container, "SELECT pg_is_in_recovery()") == "f"
+
+    wait_until_ready(Probe("Restored database", recovered, verify_timeout))
+    if int(psql(container, "SHOW server_version_num")) >= 120000:
+        for setting in ["restore_command", "recovery_target_time",
+                        "recovery_target_action"]:
+            psql(container, "ALTER SYSTEM RESET " + setting)
+        psql(container, "SELECT pg_reload_conf()")
+    exec_safely(container, ["rm", "-rf", "/pgdata/restore_wal",
+                            "/pgdata/recovery.done"], check=True)
+
+
+def restore(service, target_time=None, volume=None):
+    """Point-in-time restore.  Into a fresh volume (by default named for
+    the restore time) while Montagu carries on; or, with
+    volume=service.volume_name("db"), over the live database, which is
+    stopped only for as long as the restore and WAL replay take."""
+    live = service.volume_name("db")
+    if volume is None:
+        volume = "{}_restore_{}".format(
+            live, datetime.now(timezone.utc).strftime(base_backup_format))
+        service.client.volumes.create(volume)
+    if volume != live:
+        restore_into_volume(service, volume, target_time)
+        container = start_scratch_db(service, volume)
+        try:
+            finish_recovery(container)
+            container.stop()
+        finally:
+            container.remove(force=True)
+        return volume
+    db = service.db
+    stop_archiving(service)
+    drop_slot(db)
+    db.stop()
+    try:
+        restore_into_volume(service, volume, target_time)
+    finally:
+        db.start()
+    wait_until_ready(database_probe(service))
+    finish_recovery(db)
+    # The restored database has none of the archiver's replication slot
+    configure(service)
+    return volume
+
+
+def verify(service, target_time=None):
+    """Restore the backup into a scratch volume and check that postgres
+    can recover from it and serve the montagu database"""
+    volume = "{}_verify".format(service.volume_name("db"))
+    service.client.volumes.create(volume)
+    container = None
+    try:
+        restore_into_volume(service, volume, target_time)
+        container = start_scratch_db(service, volume)
+        finish_recovery(container)
+        tables = int(psql(container,
+                          "SELECT count(*) FROM information_schema.tables "
+                          "WHERE table_schema = 'public'", "montagu"))
+        if tables == 0:
+            raise Exception("The restored database has no tables")
+        events.info("Backup verified: {} tables restored".format(tables))
+        return tables
+    finally:
+        if container:
+            container.remove(force=True)
+        service.client.volumes.get(volume).remove(force=True)
+
+
+def configure(service):
+    """Called on deploy: make sure WAL is being archived, and that there
+    is a base backup to replay it onto"""
+    db = service.db
+    # Created here rather than by the archiver, so that it is certainly
+    # in place before the base backup starts
+    new_slot = not has_slot(db)
+    if new_slot:
+        events.info("Creating replication slot {}".format(slot_name))
+        psql(db, create_slot_sql())
+    image = db_image()
+    if new_slot or not archiver_is_current(service, image):
+        start_archiving(service, image)
+    if new_slot or not list_base_backups():
+        base_backup(service)
+
+
+def disable(service):
+    """Called on deploy when db_backup is off but an earlier deploy left
+    an archiver: remove it, and drop its slot.  The backups are kept."""
+    stop_archiving(service)
+    drop_slot(service.db)
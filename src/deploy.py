@@ -1,43 +1,85 @@
 #!/usr/bin/env python3
+"""
+Deploy Montagu
+
+Usage:
+  deploy.py [--plan | --resume]
+
+Options:
+  --plan    Print what would be redeployed, compared with the last deploy,
+            and then exit without changing anything
+  --resume  Carry on with a deploy that failed, skipping what it finished
+"""
 import webbrowser
-from os import chdir, geteuid
+from os import chdir, environ, geteuid
 from os.path import abspath, dirname
 from time import sleep
 
+from docopt import docopt
+
 import bb8_backup
+import bb8_snapshot
+import blue_green
 import data_import
 import database
+import db_backup
+import deploy_journal
+import deploy_plan
+import events
 import paths
 import orderlyweb_cli
+import readiness
+import timing
 from ascii_art import print_ascii_art
+from cert_tool import cert_tool_image
 from certificates import get_ssl_certificate
-from cli import add_test_users, add_user
+from cli import montagu_cli_image
+from docker_helpers import volume_copy_image
 from git import git_check
 from service import MontaguService
 from service_config import configure_api, configure_proxy, \
-    configure_contrib_portal, configure_static_server, configure_task_queue
-from service_config.api_config import get_token_keypair
-from settings import get_settings, get_secret
+    configure_contrib_portal, configure_static_server, configure_task_queue, \
+    api_db_user
+from service_config.api_config import get_token_keypair, \
+    generate_api_config_file
+from service_config.task_queue_config import read_config_template, \
+    generate_task_queue_config
+from service_config.static_server_config import static_git_image
+from settings import get_settings, get_secret, prefetch_secrets
+from setting_definitions import vault_required
 from last_deploy import last_deploy_update
 from notify import Notifier
+from provisioning import MontaguUser, OrderlyWebUser, add_test_users, provision
+from step_graph import Step, run_steps, select_steps
 
 
-def _deploy():
+def _deploy(plan_only=False, resume=False):
     print_ascii_art()
-    print("Beginning Montagu deploy")
+    events.info("Beginning Montagu deploy")
 
     settings = get_settings()
+    # A plan doesn't need any secrets, so don't wait for them
+    if vault_required(settings) and not plan_only:
+        events.info("Reading secrets from the vault")
+        with timing.span("secrets"):
+            prefetch_secrets(get_deploy_secrets(settings))
     service = MontaguService(settings)
     status = service.status
     volume_present = service.db_volume_present
     is_first_time = (status is None) and (not volume_present)
     if is_first_time:
-        print("Montagu not detected: Beginning new deployment")
+        events.info("Montagu not detected: Beginning new deployment")
     else:
-        print("Montagu status: {}. "
-              "Data volume present: {}".format(status, volume_present))
+        events.info("Montagu status: {}. "
+                    "Data volume present: {}".format(status, volume_present))
 
-    notifier = Notifier(settings['notify_channel'])
+    inputs = deploy_plan.get_inputs(settings)
+    plan = deploy_plan.make_plan(settings, status, inputs)
+    plan.print()
+    if plan_only:
+        return
+
+    events.subscribe(Notifier(settings['notify_channel']).handle)
 
     # Check that the deployment environment is clean enough
     version = git_check(settings)
@@ -46,132 +88,371 @@ def _deploy():
         version['tag'] or "(untagged)", version['sha'][:7],
         settings['instance_name'])
 
-    notifier.post("*Starting* deploy of " + deploy_str)
+    journal = deploy_journal.start(
+        deploy_journal.fingerprint(version, settings, inputs), resume)
+    if journal.resumed and journal.state:
+        # Montagu is now part way through this deploy, so go on with
+        # what was decided when it was first looked at
+        status = journal.state["status"]
+        is_first_time = journal.state["is_first_time"]
+        plan = deploy_plan.DeployPlan(**journal.state["plan"])
+        plan.print()
+        if journal.state.get("colour", service.colour) != service.colour:
+            service = MontaguService(settings, journal.state["colour"])
+    else:
+        journal.set_state(status=status, is_first_time=is_first_time,
+                          plan=vars(plan), colour=service.colour)
+
+    events.emit("deploy_started", deploy=deploy_str,
+                instance=settings['instance_name'])
 
     # Pull images
-    service.pull()
+    with timing.span("pull"):
+        journal.run("pull",
+                    lambda: service.pull(get_deploy_images(settings)))
 
     # If Montagu is running, back it up before tampering with it
     if status == "running":
         if settings["bb8_backup"]:
-            bb8_backup.backup()
-
-    # Stop Montagu if it is running
-    # (and delete data volume if persist_data is False)
-    if not is_first_time:
-        notifier.post("*Stopping* previous montagu "
-                      "on `{}` :hand:".format(settings['instance_name']))
-        service.stop()
+            with timing.span("backup"):
+                journal.run("backup", bb8_backup.backup)
 
     # Schedule backups
     if settings["bb8_backup"]:
         bb8_backup.schedule()
 
-    # BB8 restore
-    data_exists = (not is_first_time) and service.settings["persist_data"]
-    if settings["initial_data_source"] == "bb8_restore":
-        data_update = service.settings["update_on_deploy"] and \
-                      not service.settings["bb8_backup"]
-        if data_exists and not data_update:
-            print("Skipping bb8 restore: 'persist_data' is set, "
-                  "and this is not a first-time deployment")
-        else:
-            print("Running bb8 restore (while service is stopped)")
-            bb8_backup.restore()
+    data_exists = (not plan.full) or \
+        ((not is_first_time) and settings["persist_data"])
 
-    # Start Montagu again
-    service.start()
     try:
-        print("Configuring Montagu")
-        configure_montagu(service, data_exists)
-
-        print("Starting Montagu metrics")
-        service.start_metrics()
-
-        print("Montagu metrics started")
+        # Everything the new containers need is got ready while the
+        # old ones carry on serving
+        events.info("Preparing configuration")
+        with timing.span("prepare"):
+            prepared = prepare(service, data_exists, journal.resumed)
+        if plan.full and blue_green.can_deploy(
+                settings, status, data_exists,
+                bb8_restore_due(settings, data_exists)):
+            redeploy_blue_green(service, prepared, journal)
+        elif plan.full:
+            redeploy_full(service, is_first_time, data_exists, prepared,
+                          journal)
+        else:
+            redeploy_incremental(service, plan, prepared, journal)
     except Exception as e:
-        print("An error occurred before deployment could be completed:")
-        print(e)
-        print("\nYou may need to call ./stop.py before redeploying.")
-        try:
-            notifier.post("*Failed* deploy of " + deploy_str + " :bomb:")
-        except:
-            pass
+        events.info("An error occurred before deployment could be completed:")
+        events.info(e)
+        events.info("\nRun ./deploy.py --resume to carry on from where "
+                    "this deploy stopped, or call ./stop.py before "
+                    "redeploying from scratch.")
+        events.emit("deploy_failed", deploy=deploy_str,
+                    instance=settings['instance_name'], error=str(e))
         raise
 
     if settings["add_test_user"] is True:
-        print("Adding tests users")
-        add_test_users()
+        events.info("Adding tests users")
+        with timing.span("add_test_users"):
+            journal.run("add_test_users", lambda: add_test_users(service))
 
-    last_deploy_update(version)
-    notifier.post("*Completed* deploy of " + deploy_str + " :shipit:")
+    last_deploy_update(version, inputs, timing.as_dict())
+    deploy_journal.finish()
+    events.emit("deploy_finished", deploy=deploy_str,
+                instance=settings['instance_name'])
 
-    print("Finished deploying Montagu")
+    events.info("Finished deploying Montagu")
     if settings["open_browser"]:
         sleep(1)
         webbrowser.open("https://localhost:{}/".format(settings["port"]))
 
 
-def configure_montagu(service, data_exists):
-    # Do things to the database
-    if data_exists:
-        print("Skipping data import: 'persist_data' is set, "
-              "and this is not a first-time deployment")
-    else:
-        data_import.do(service)
-
-    passwords = database.setup(service)
+def redeploy_full(service, is_first_time, data_exists, prepared, journal):
+    settings = service.settings
+    # Stop Montagu if it is running
+    # (and delete data volume if persist_data is False)
+    if not is_first_time:
+        def stop():
+            events.emit("deploy_stopping",
+                        instance=settings['instance_name'])
+            service.stop()
+        with timing.span("stop"):
+            journal.run("stop", stop)
 
-    # Push secrets into containers
-    cert_paths = get_ssl_certificate(service.settings["certificate"])
-    token_keypair_paths = get_token_keypair()
+    # BB8 restore
+    if settings["initial_data_source"] == "bb8_restore":
+        if not bb8_restore_due(settings, data_exists):
+            events.info("Skipping bb8 restore: 'persist_data' is set, "
+                        "and this is not a first-time deployment")
+        else:
+            events.info("Running bb8 restore (while service is stopped)")
+            with timing.span("restore"):
+                if settings["bb8_snapshot"]:
+                    journal.run("restore",
+                                lambda: bb8_snapshot.restore(service))
+                else:
+                    journal.run("restore", bb8_backup.restore)
+
+    # Start Montagu again (this does nothing to containers that a
+    # resumed deploy already started)
+    with timing.span("start"):
+        service.start()
+
+    events.info("Configuring Montagu")
+    configure_montagu(service, data_exists, prepared, journal)
+
+    events.info("Starting Montagu metrics")
+    with timing.span("start_metrics"):
+        journal.run("start_metrics", service.start_metrics)
+
+    events.info("Montagu metrics started")
+
+
+def redeploy_blue_green(service, prepared, journal):
+    # Montagu keeps running, and the new version replaces it only once
+    # it is ready (see blue_green)
+    def configure(target):
+        events.info("Configuring Montagu ({})".format(target.colour))
+        configure_montagu(target, True, prepared, journal)
+    blue_green.deploy(service, configure, journal)
+
+
+def bb8_restore_due(settings, data_exists):
+    if settings["initial_data_source"] != "bb8_restore":
+        return False
+    data_update = settings["update_on_deploy"] and \
+        not settings["bb8_backup"]
+    return not data_exists or data_update
+
+
+def redeploy_incremental(service, plan, prepared, journal):
+    # Montagu keeps running; only containers whose image has changed are
+    # recreated, and only the configuration that they (or changed
+    # inputs) need is pushed again.
+    if plan.services:
+        with timing.span("start"):
+            service.start(plan.services)
+    if plan.steps:
+        events.info("Configuring Montagu")
+        configure_montagu(service, True, prepared, journal, only=plan.steps)
+
+
+def get_deploy_secrets(settings):
+    """Every vault path (under secret/) that the deploy will read"""
+    secrets = database.vault_paths(settings["password_group"],
+                                   settings["enable_db_replication"])
+    if settings["certificate"] in ["production", "support"]:
+        secrets += ["ssl/v2/{}/key".format(settings["certificate"]),
+                    "ssl/v2/{}/dhparam".format(settings["certificate"])]
+    if settings["password_group"] == "production":
+        secrets += ["email/password", "slack/montagu-webhook"]
+    if not settings["fake_smtp"]:
+        secrets.append("email/password")
+    if settings["use_real_diagnostic_reports"]:
+        secrets.append("task-queue-user/{}".format(settings["instance_name"]))
+    if settings["notify_channel"]:
+        secrets.append("slack/deploy-webhook")
+    if settings["initial_data_source"] in ["test_data", "legacy"]:
+        secrets.append("teamcity/deploy")
+    if settings["copy_static_files"]:
+        secrets += ["vimc-robot/id_rsa", "vimc-robot/id_rsa.pub"]
+    return secrets
+
+
+def get_deploy_images(settings):
+    """Images that are run outside of docker compose during the deploy,
+    so that they can be pulled up front along with everything else"""
+    images = [cert_tool_image(), montagu_cli_image(),
+              database.migrate_image(), orderlyweb_cli.orderlyweb_cli_image()]
+    if settings["include_guidance_reports"] or settings["copy_static_files"]:
+        images.append(volume_copy_image)
+    if settings["copy_static_files"]:
+        images.append(static_git_image)
+    return images
+
+
+task_queue_email = "montagu-task@imperial.ac.uk"
+
+
+def prepare(service, data_exists, resumed=False):
+    """Everything that the configuration steps will put into the new
+    containers, made without touching the running Montagu: certificate,
+    token keypair, the rendered API and task queue config, and the dump
+    to import (if there is going to be an import).  A resumed deploy
+    uses the token keypair of the deploy that it is resuming."""
+    settings = service.settings
+    is_prod = settings["password_group"] == 'production'
+
+    def api_config(results):
+        password = database.VaultPassword(settings["password_group"],
+                                          api_db_user).get()
+        return generate_api_config_file(password, settings["hostname"],
+                                        is_prod,
+                                        settings["orderly_web_api_url"])
+
+    def task_queue_config(results):
+        return generate_task_queue_config(
+            service, results["task_queue_template"], task_queue_email,
+            results["task_queue_password"], settings["orderly_web_api_url"],
+            settings["use_real_diagnostic_reports"], settings["fake_smtp"])
+
+    steps = [
+        Step("ssl_certificate",
+             lambda results: get_ssl_certificate(settings["certificate"])),
+        Step("token_keypair", lambda results: get_token_keypair(resumed)),
+        Step("api_config", api_config),
+        Step("task_queue_password",
+             lambda results: get_task_queue_password(settings)),
+        Step("task_queue_template",
+             lambda results: read_config_template(service)),
+        Step("task_queue_config", task_queue_config,
+             depends_on=["task_queue_password", "task_queue_template"])
+    ]
+    if not data_exists:
+        steps.append(Step("dump",
+                          lambda results: data_import.get_dump(settings)))
+    return run_steps(steps)
+
+
+def configure_montagu(service, data_exists, prepared, journal, only=None):
+    """prepared is the result of prepare(), and journal the
+    deploy_journal.Journal that records which steps have finished.  If
+    only is given, it is a list of the names of the steps to run (along
+    with the steps that they depend on)"""
+    settings = service.settings
+
+    def import_data(results):
+        # Do things to the database
+        if data_exists:
+            events.info("Skipping data import: 'persist_data' is set, "
+                        "and this is not a first-time deployment")
+        else:
+            data_import.do(service, prepared.get("dump"))
+
+    # Each step lists the steps whose results (or side effects) it
+    # needs; everything else is free to run at the same time.
+    steps = [
+        Step("data_import", import_data),
+        Step("database.setup", lambda results: database.setup(service),
+             depends_on=["data_import"]),
+        # The API connects to the database as soon as it has its config
+        Step("configure_api",
+             lambda results: configure_api(service, prepared["api_config"],
+                                           prepared["token_keypair"]),
+             depends_on=["database.setup"]),
+        Step("task_queue_user",
+             lambda results: configure_task_queue_user(
+                 service, prepared["task_queue_password"]),
+             depends_on=["database.setup"]),
+        Step("ready.task_queue",
+             lambda results: readiness.wait_for([
+                 readiness.mq_probe(service),
+                 readiness.task_queue_probe(service)])),
+        Step("configure_task_queue",
+             lambda results: configure_task_queue(
+                 service, prepared["task_queue_config"]),
+             depends_on=["task_queue_user", "ready.task_queue"]),
+        Step("configure_proxy",
+             lambda results: configure_proxy(service,
+                                             prepared["ssl_certificate"])),
+        # Fail fast (and with a clear reason) if what we have just
+        # configured does not come up
+        Step("ready.proxy",
+             lambda results: readiness.wait_until_ready(
+                 readiness.proxy_probe(service)),
+             depends_on=["configure_proxy"]),
+        Step("ready.api",
+             lambda results: readiness.wait_until_ready(
+                 readiness.api_probe(service)),
+             depends_on=["configure_api", "configure_proxy"])
+    ]
+
+    if settings["include_guidance_reports"]:
+        steps.append(Step("configure_contrib_portal",
+                          lambda results: configure_contrib_portal(service)))
+
+    if settings["copy_static_files"]:
+        steps.append(Step("configure_static_server",
+                          lambda results: configure_static_server(
+                              service, prepared["token_keypair"])))
+
+    # With db_backup off there is nothing to do, unless an earlier
+    # deploy left an archiver (and its replication slot) behind
+    if db_backup.enabled(settings):
+        steps.append(Step("db_backup",
+                          lambda results: db_backup.configure(service),
+                          depends_on=["database.setup"]))
+    elif db_backup.archiver(service) is not None:
+        steps.append(Step("db_backup",
+                          lambda results: db_backup.disable(service),
+                          depends_on=["database.setup"]))
+
+    # A resumed deploy skips the steps that have already been done,
+    # unless what they would put into Montagu has changed since
+    keypair = deploy_plan.hash_files(paths.token_keypair)
+    step_inputs = {
+        "data_import": prepared.get("dump"),
+        "configure_api": [prepared["api_config"], keypair],
+        "task_queue_user": prepared["task_queue_password"],
+        "configure_task_queue": prepared["task_queue_config"],
+        "configure_proxy": deploy_plan.hash_files(paths.ssl),
+        "configure_static_server": keypair
+    }
+    # Checking readiness is cheap, and should be done again anyway
+    steps = [s if s.name.startswith("ready.")
+             else journal.wrap(s, step_inputs.get(s.name)) for s in steps]
+
+    if only is not None:
+        steps = select_steps(steps, only)
+    with timing.span("configure"):
+        run_steps(steps)
+
+
+def get_task_queue_password(settings):
+    if settings["use_real_diagnostic_reports"]:
+        return get_secret("task-queue-user/{}".format(settings["instance_name"]), "password")
+    else:
+        return "password"
 
-    is_prod = service.settings["password_group"] == 'production'
-    configure_api(service, passwords['api'], token_keypair_paths,
-                  service.settings["hostname"], is_prod,
-                  service.settings["orderly_web_api_url"])
 
+def configure_task_queue_user(service, task_queue_password):
     task_queue_user = "MONTAGU_TASK_QUEUE"
-    task_queue_email = "montagu-task@imperial.ac.uk"
-    if service.settings["use_real_diagnostic_reports"]:
-        task_queue_password = get_secret("task-queue-user/{}".format(service.settings["instance_name"]), "password")
-    else:
-        task_queue_password = "password"
-
-    print("Configuring task queue user")
-    add_user(task_queue_user, task_queue_user, task_queue_email,
-             task_queue_password)
-    orderlyweb_cli.add_user(task_queue_email)
+    events.info("Configuring task queue user")
+    user = MontaguUser(task_queue_user, task_queue_user, task_queue_email,
+                       task_queue_password, roles=["user"])
     perms = ["*/reports.read", "*/reports.review", "*/reports.run"]
-    orderlyweb_cli.grant_permissions(task_queue_email, perms)
-
-    configure_task_queue(service, task_queue_email, task_queue_password,
-                         service.settings["orderly_web_api_url"],
-                         service.settings["use_real_diagnostic_reports"],
-                         service.settings["fake_smtp"])
-
-    configure_proxy(service, cert_paths)
+    provision(service, users=[user],
+              orderlyweb_users=[OrderlyWebUser(task_queue_email, perms)])
 
-    if service.settings["include_guidance_reports"]:
-        configure_contrib_portal(service)
 
-    if service.settings["copy_static_files"]:
-        configure_static_server(service, token_keypair_paths)
-
-
-def deploy():
+def deploy(plan_only=False, resume=False):
+    if not plan_only:
+        events.write_json_lines(events_path())
+    finished = False
     try:
-        _deploy()
+        with timing.span("deploy"):
+            _deploy(plan_only, resume)
+        finished = True
     finally:
+        if not plan_only:
+            timing.print_summary()
+            timing.save_chrome_trace()
         paths.delete_safely(paths.ssl)
-        paths.delete_safely(paths.token_keypair)
+        # A failed deploy keeps its token keypair, so that if it is
+        # resumed the API and static server go on using the same one
+        if finished and not plan_only:
+            paths.delete_safely(paths.token_keypair)
         paths.delete_safely(paths.config)
         paths.delete_safely(paths.static)
 
 
+# Where to write deploy events, as JSON lines: a file, or tcp://host:port
+def events_path():
+    return environ.get("MONTAGU_DEPLOY_EVENTS", "deploy_events.jsonl")
+
+
 if __name__ == "__main__":
     if geteuid() == 0:
         raise Exception("Please do not run deploy as root user")
     abspath = abspath(__file__)
     chdir(dirname(abspath))
-    deploy()
+    args = docopt(__doc__)
+    deploy(args["--plan"], args["--resume"])
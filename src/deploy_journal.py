@@ -0,0 +1,122 @@
+import datetime
+import hashlib
+import json
+import os
+import threading
+
+import events
+from step_graph import Step
+
+# A deploy records each phase (and configuration step) that it finishes
+# in a journal, along with a hash of that phase's inputs, so that after
+# a failure
+#
+#     ./deploy.py --resume
+#
+# can skip what was already done and carry on from the step that
+# failed, rather than pulling, backing up, stopping and restoring all
+# over again.  The journal belongs to one deploy: one of a different
+# commit, settings or inputs (see deploy_plan.get_inputs) starts a new
+# journal, as does a deploy without --resume.  Phases whose inputs have
+# changed since (e.g. a freshly generated token keypair) run again.  The
+# journal is removed once the deploy finishes.
+
+path_journal = 'deploy_journal.json'
+
+
+def fingerprint(*values):
+    data = json.dumps(values, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class Journal:
+    def __init__(self, key, data=None):
+        self.key = key
+        self.resumed = data is not None
+        self.data = data or {
+            "key": key,
+            "started": str(datetime.datetime.now()),
+            "state": {},
+            "phases": {}
+        }
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        """Decisions made at the start of the deploy (which plan to
+        follow, whether this is a first deploy), which a resumed deploy
+        must not make again from the half-deployed Montagu"""
+        return self.data["state"]
+
+    def set_state(self, **values):
+        with self.lock:
+            self.data["state"].update(values)
+            self._save()
+
+    def is_done(self, name, inputs=None):
+        entry = self.data["phases"].get(name)
+        return entry is not None and entry["inputs"] == fingerprint(inputs)
+
+    def done(self, name, inputs=None):
+        with self.lock:
+            self.data["phases"][name] = {
+                "inputs": fingerprint(inputs),
+                "time": str(datetime.datetime.now())
+            }
+            self._save()
+
+    def run(self, name, action, inputs=None):
+        """Call action, unless the deploy being resumed already finished
+        this phase with the same inputs"""
+        if self.is_done(name, inputs):
+            events.info("Skipping {}: finished by the deploy being "
+                        "resumed".format(name))
+            events.emit("phase_skipped", phase=name)
+            return None
+        result = action()
+        self.done(name, inputs)
+        return result
+
+    def wrap(self, step, inputs=None):
+        """A copy of a step_graph Step that is journalled like a phase.
+        A step also runs again if any step that it depends on ran again."""
+        def action(results):
+            upstream = [self.data["phases"].get(d, {}).get("time")
+                        for d in step.depends_on]
+            return self.run(step.name, lambda: step.action(results),
+                            [inputs, upstream])
+        return Step(step.name, action, step.depends_on)
+
+    def _save(self):
+        tmp = path_journal + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump(self.data, f, indent=4)
+        os.replace(tmp, path_journal)
+
+
+def read():
+    if not os.path.exists(path_journal):
+        return None
+    with open(path_journal, 'r') as f:
+        return json.load(f)
+
+
+def start(key, resume=False):
+    """The journal for the deploy identified by key; with resume, the
+    one left by an earlier attempt at the same deploy, if there is one"""
+    if resume:
+        previous = read()
+        if previous is not None and previous["key"] == key:
+            events.info("Resuming the deploy started at {}".format(
+                previous["started"]))
+            return Journal(key, previous)
+        events.info("No unfinished deploy of this version and settings to "
+                    "resume; deploying from the start")
+    journal = Journal(key)
+    journal._save()
+    return journal
+
+
+def finish():
+    if os.path.exists(path_journal):
+        os.remove(path_journal)
@@ -0,0 +1,139 @@
+import hashlib
+import os
+from os.path import join
+
+import events
+import paths
+import versions
+from last_deploy import last_deploy_read
+from service_config.static_server_config import montagu_root
+from settings import load_settings
+
+# Map from submodule (as in versions) to the docker compose service
+# that runs its image.  cert-tool is only used during the deploy.
+submodule_services = {
+    "db": "db",
+    "api": "api",
+    "contrib-portal": "contrib",
+    "admin-portal": "admin",
+    "proxy": "proxy",
+    "static": "static",
+    "task-queue": "task-queue"
+}
+
+# Configuration steps (see deploy.configure_montagu) that have to be
+# re-run when a compose service's container is recreated, because the
+# new container has lost whatever we injected into the old one.
+service_steps = {
+    "db": ["database.setup"],
+    "api": ["configure_api"],
+    "proxy": ["configure_proxy"],
+    "static": ["configure_static_server"],
+    "task-queue": ["configure_task_queue"]
+}
+
+# Configuration steps that depend on files in this repository
+input_steps = {
+    "certificate": ["configure_proxy"],
+    "static_files": ["configure_static_server"],
+    "guidance_reports": ["configure_contrib_portal"],
+    "task_queue_config": ["configure_task_queue"]
+}
+
+# The API signs tokens with a keypair that is generated afresh on every
+# deploy, and the static server checks them against the public key, so
+# these two always have to be configured together.
+keypair_steps = ["configure_api", "configure_static_server"]
+
+
+class DeployPlan:
+    def __init__(self, full, reason, services=None, steps=None):
+        self.full = full
+        self.reason = reason
+        self.services = sorted(services or [])
+        self.steps = sorted(steps or [])
+
+    def print(self):
+        if self.full:
+            events.info("Deploy plan: full deploy ({})".format(self.reason))
+        elif not self.services and not self.steps:
+            events.info("Deploy plan: nothing has changed since the last deploy")
+        else:
+            events.info("Deploy plan: incremental deploy ({})".format(self.reason))
+            events.info("- Restart services: {}".format(
+                ", ".join(self.services) or "(none)"))
+            events.info("- Configuration steps: {}".format(
+                ", ".join(self.steps) or "(none)"))
+
+
+def hash_files(path):
+    """Hash of the names and contents of every file under path"""
+    h = hashlib.sha256()
+    for dirpath, dirnames, filenames in sorted(os.walk(path)):
+        dirnames.sort()
+        for f in sorted(filenames):
+            full = join(dirpath, f)
+            h.update(os.path.relpath(full, path).encode("utf-8"))
+            with open(full, "rb") as contents:
+                h.update(contents.read())
+    return h.hexdigest()
+
+
+def hash_file(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def certificate_fingerprint(certificate_type):
+    # The production and support keys live in the vault, but change
+    # along with the certificates that are kept in the repository.
+    if certificate_type == "self_signed_fresh":
+        return None
+    return hash_files(join(paths.certs, certificate_type))
+
+
+def get_inputs(settings):
+    submodules = versions.as_dict()
+    submodules["static"] = versions.static
+    return {
+        "versions": submodules,
+        "certificate": certificate_fingerprint(settings["certificate"]),
+        "static_files": hash_files(join(montagu_root, "static")),
+        "guidance_reports": hash_file("guidance_report_versions"),
+        "task_queue_config": hash_files(join(paths.container_config,
+                                             "task_queue"))
+    }
+
+
+def make_plan(settings, status, inputs):
+    if status != "running":
+        return DeployPlan(True, "Montagu is not running")
+    if not settings["persist_data"]:
+        return DeployPlan(True, "'persist_data' is not set, so data is "
+                                "replaced on every deploy")
+    last = last_deploy_read()
+    if last is None or not last.get("inputs"):
+        return DeployPlan(True, "no record of the inputs to the last deploy")
+    if last["settings"] != load_settings():
+        return DeployPlan(True, "settings have changed")
+    if settings["initial_data_source"] == "bb8_restore" and \
+            settings["update_on_deploy"] and not settings["bb8_backup"]:
+        return DeployPlan(True, "data is updated from bb8 on every deploy")
+
+    previous = last["inputs"]
+    services = set()
+    steps = set()
+    for submodule, service in submodule_services.items():
+        if inputs["versions"].get(submodule) != \
+                previous["versions"].get(submodule):
+            services.add(service)
+            steps.update(service_steps.get(service, []))
+    for key, affected in input_steps.items():
+        if inputs[key] is None or inputs[key] != previous.get(key):
+            steps.update(affected)
+    if steps.intersection(keypair_steps):
+        steps.update(keypair_steps)
+
+    return DeployPlan(False, "compared with the deploy at {}".format(
+        last["time"]), services, steps)
+
@@ -1,5 +1,14 @@
-from subprocess import check_output, run
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import run
+from threading import Lock, Thread
 import os
+import socket
+import struct
+
+import docker
+
+import events
+import timing
 
 montagu_registry_local = "docker.montagu.dide.ic.ac.uk:5000"
 montagu_registry_hub = "vimc"
@@ -13,38 +22,77 @@ except KeyError:
 
 montagu_registry = montagu_registry_hub if use_docker_hub else montagu_registry_local
 
+# Used to copy files between volumes (see volume_copy)
+volume_copy_image = "alpine"
+
 
 def get_image_name(name, version, local_registry=False):
-    url = montagu_registry_local if local_registry else montagu_registry_hub
-    image = "{url}/{name}:{version}".format(url=url, name=name, version=version)
+    image = image_name(name, version, local_registry)
     pull(image)
     return image
 
 
-def docker_cp(src, container, target_path):
-    full_target = "{container}:{path}".format(container=container, path=target_path)
-    check_output(["docker", "cp", src, full_target])
+def image_name(name, version, local_registry=False):
+    url = montagu_registry_local if local_registry else montagu_registry_hub
+    return "{url}/{name}:{version}".format(url=url, name=name, version=version)
+
 
+# Images that have already been pulled (or found to be up to date) by
+# this process, so that repeated calls to pull() within a deploy are
+# free.  Each image has its own lock, held across the check and the
+# pull, so that threads asking for the same image at once pull it only
+# once, while different images are still pulled in parallel.
+pulled_images = set()
+pull_locks = {}
+pull_locks_lock = Lock()
 
-def docker_cp_from(container, src_path, target):
-    full_src = "{container}:{path}".format(container=container, path=src_path)
-    check_output(["docker", "cp", full_src, target])
+# Client used to check images when the caller doesn't pass its own;
+# created on first use and then shared
+default_client = None
 
 
-def pull(image):
-    run(["docker", "pull", image], check=True)
+def pull(image, client=None):
+    with pull_locks_lock:
+        image_lock = pull_locks.setdefault(image, Lock())
+    with image_lock:
+        if image in pulled_images:
+            return
+        if image_is_current(image, client or get_default_client()):
+            events.info("- {} is up to date".format(image))
+        else:
+            run(["docker", "pull", image], check=True)
+        pulled_images.add(image)
 
 
-def copy_between_volumes(source_volume, destination_volume, path_to_copy, destination_path="."):
-    run(["docker", "run", "--rm", "-i", "-t",
-         "-v", "{}:/from".format(source_volume),
-         "-v", "{}:/to".format(destination_volume),
-         "alpine",
-         "ash",
-         "-c",
-         "cd /to ; mkdir -p {} && find /from/{} -exec cp -a {{}} {} \;".format(destination_path, path_to_copy,
-                                                                               destination_path)
-         ], check=True)
+def pull_images(images, client=None, max_workers=4):
+    images = sorted(set(images))
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        # list() so that any failed pull is raised here
+        list(pool.map(lambda image: pull(image, client), images))
+
+
+def get_default_client():
+    global default_client
+    with pull_locks_lock:
+        if default_client is None:
+            default_client = docker.from_env()
+            timing.watch_docker_client(default_client)
+        return default_client
+
+
+# Compare the digest that the registry currently has for a tag with the
+# digests of the copy we already have locally.  Asking the registry
+# for the manifest digest is a single small request, whereas 'docker
+# pull' has to check every layer.  If anything goes wrong we just
+# report the image as out of date and pull it as usual.
+def image_is_current(image, client):
+    try:
+        local = client.images.get(image)
+        remote = client.images.get_registry_data(image)
+    except docker.errors.APIError:
+        return False
+    digests = [x.split("@", 1)[-1] for x in local.attrs.get("RepoDigests", [])]
+    return remote.id in digests
 
 
 # Somewhat surprisingly, the `container.exec_run` method does not
@@ -77,3 +125,56 @@ def exec_safely(container, cmd, check=False):
         msg = out.decode("UTF-8").strip()
         raise Exception("Exec failed with message '{}'".format(msg))
     return dat
+
+
+# Like exec_safely, but with the contents of the file at local_path
+# sent to the command's stdin as it runs, so large inputs never need to
+# be copied into the container first.  Output is read on a separate
+# thread so that a chatty command cannot stall the upload.
+def exec_with_stdin(container, cmd, local_path, check=False,
+                    chunk_size=1024 * 1024):
+    api = container.client.api
+    exec_id = api.exec_create(container.id, cmd, stdin=True)['Id']
+    sock = api.exec_start(exec_id, socket=True)
+    raw = getattr(sock, "_sock", sock)
+    output = []
+    reader = Thread(target=read_exec_stream, args=(raw, output))
+    reader.start()
+    try:
+        with open(local_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                raw.sendall(chunk)
+        raw.shutdown(socket.SHUT_WR)
+        reader.join()
+    finally:
+        sock.close()
+    out = b"".join(output)
+    dat = api.exec_inspect(exec_id)
+    dat['Output'] = out
+    if check and dat['ExitCode'] != 0:
+        msg = out.decode("UTF-8").strip()
+        raise Exception("Exec failed with message '{}'".format(msg))
+    return dat
+
+
+# Without a tty, docker multiplexes stdout and stderr, with each frame
+# preceded by an 8 byte header whose last 4 bytes are the frame length
+def read_exec_stream(raw, output):
+    def read_exactly(n):
+        data = b""
+        while len(data) < n:
+            chunk = raw.recv(n - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    while True:
+        header = read_exactly(8)
+        if header is None:
+            return
+        length = struct.unpack(">I", header[4:])[0]
+        frame = read_exactly(length)
+        if frame is None:
+            return
+        output.append(frame)
@@ -0,0 +1,103 @@
+import json
+import socket
+import sys
+import threading
+import time
+
+# A small event bus for deploy progress.  Code reports what is happening
+# by emitting typed events:
+#
+#     events.info("Configuring API")
+#     events.emit("container_configured", container="montagu_api_1")
+#
+# and subscribers decide what to do with them.  By default the only
+# subscriber is the human renderer, which prints progress messages to
+# the terminal much as we always have; deploy.py also writes every event
+# as a line of JSON (see write_json_lines) so that deploys on different
+# machines can be compared without scraping their logs.
+#
+# Event types in use:
+#   message              - progress text for humans (info)
+#   phase_started        - a timing.span has started
+#   phase_finished       - a timing.span has finished (with timings)
+#   error                - a phase failed
+#   phase_skipped        - a resumed deploy skipped a finished phase
+#   container_configured - files/commands were sent to a container
+#   secret_fetched       - a secret was read from the vault (path only)
+#   deploy_started, deploy_stopping, deploy_finished, deploy_failed,
+#   restore_finished, restore_failed - milestones (see notify.Notifier)
+
+subscribers = []
+lock = threading.Lock()
+
+
+def subscribe(handler):
+    with lock:
+        subscribers.append(handler)
+    return handler
+
+
+def unsubscribe(handler):
+    with lock:
+        if handler in subscribers:
+            subscribers.remove(handler)
+
+
+def emit(event_type, **fields):
+    event = dict(fields)
+    event["type"] = event_type
+    event["time"] = time.time()
+    with lock:
+        handlers = list(subscribers)
+    for handler in handlers:
+        # A broken subscriber must never break the deploy
+        try:
+            handler(event)
+        except Exception as e:
+            print("Error handling {} event: {}".format(event_type, e),
+                  file=sys.stderr)
+    return event
+
+
+def info(message):
+    emit("message", message=str(message))
+
+
+def render(event):
+    """The human renderer: prints progress messages"""
+    if event["type"] == "message":
+        print(event["message"], flush=True)
+
+
+class JsonLinesWriter:
+    """Writes each event as a line of JSON to a file, or to a TCP socket
+    if target looks like tcp://host:port"""
+    def __init__(self, target):
+        self.lock = threading.Lock()
+        if target.startswith("tcp://"):
+            host, port = target[len("tcp://"):].rsplit(":", 1)
+            self.socket = socket.create_connection((host, int(port)),
+                                                   timeout=5)
+            self.stream = self.socket.makefile("w", encoding="utf-8")
+        else:
+            self.socket = None
+            self.stream = open(target, "a", encoding="utf-8")
+
+    def __call__(self, event):
+        line = json.dumps(event, default=str)
+        with self.lock:
+            self.stream.write(line + "\n")
+            self.stream.flush()
+
+    def close(self):
+        with self.lock:
+            self.stream.close()
+            if self.socket is not None:
+                self.socket.close()
+
+
+def write_json_lines(target):
+    return subscribe(JsonLinesWriter(target))
+
+
+subscribe(render)
@@ -26,7 +26,15 @@ def last_restore_update():
         f.write(timestring() + '\n')
 
 
-def last_deploy_update(montagu_version):
+def last_deploy_read():
+    last = None
+    if os.path.exists(path_last_deploy):
+        with open(path_last_deploy, 'r') as f:
+            last = json.load(f)
+    return last
+
+
+def last_deploy_update(montagu_version, inputs=None, timings=None):
     our_settings = settings.load_settings()
     last_restore = None
     if our_settings['initial_data_source'] == 'restore':
@@ -36,7 +44,9 @@ def last_deploy_update(montagu_version):
         'versions': versions.as_dict(),
         'settings': our_settings,
         'last_restore': last_restore,
-        'montagu': montagu_version
+        'montagu': montagu_version,
+        'inputs': inputs,
+        'timings': timings
     }
     with open(path_last_deploy, 'w') as f:
         json.dump(dat, f, indent = 4)
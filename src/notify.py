@@ -1,20 +1,107 @@
 from settings import get_secret
+from queue import Queue, Empty, Full
+from threading import Thread
+from time import sleep, time
+import atexit
 import requests
 import json
 
+# Slack messages for the deploy events (see events) that we announce
+messages = {
+    "deploy_started": "*Starting* deploy of {deploy}",
+    "deploy_stopping": "*Stopping* previous montagu on `{instance}` :hand:",
+    "deploy_failed": "*Failed* deploy of {deploy} :bomb:",
+    "deploy_finished": "*Completed* deploy of {deploy} :shipit:",
+    "restore_finished": "*Restored* data from backup on `{instance}` "
+                        ":recycle:",
+    "restore_failed": "*Failed* to restore data on `{instance}` :bomb:"
+}
+
+
+# Messages are sent from a background thread so that the deploy never
+# waits on slack.  post() just adds the message to a bounded queue
+# (dropping it if the queue is full); the worker sends everything that
+# has arrived within coalesce_window seconds of the first message as a
+# single slack message.  Each request has a timeout and is retried with
+# backoff, and anything still queued is sent (for up to flush_timeout
+# seconds) when the process exits.
 class Notifier:
-    def __init__(self, channel):
+    queue_size = 50
+    coalesce_window = 1
+    timeout = (5, 10)
+    attempts = 3
+    backoff = 1
+    flush_timeout = 30
+
+    def __init__(self, channel, url=None):
         self.enabled = len(channel) > 0
+        self.worker = None
+        self.queue = Queue(maxsize=self.queue_size)
         if self.enabled:
-            path = get_secret('slack/deploy-webhook')
-            self.url = 'https://hooks.slack.com/services/{}'.format(path)
+            if url is None:
+                path = get_secret('slack/deploy-webhook')
+                url = 'https://hooks.slack.com/services/{}'.format(path)
+            self.url = url
             self.channel = "#" + channel
             self.username = "montagu-bot"
             self.icon = ":robot_face:"
             self.headers = {'Content-Type': 'application/json'}
+            self.session = requests.Session()
+
+    def handle(self, event):
+        """Subscriber for events.subscribe"""
+        if event["type"] in messages:
+            self.post(messages[event["type"]].format(**event))
+
     def post(self, message):
         if not self.enabled:
             return
+        if self.worker is None:
+            self.worker = Thread(target=self._work, daemon=True)
+            self.worker.start()
+            atexit.register(self.flush)
+        try:
+            self.queue.put_nowait(message)
+        except Full:
+            print("Slack notification queue is full; dropping: " + message)
+
+    def flush(self, timeout=None):
+        """Wait until every queued message has been sent (or given up
+        on); returns False if that took longer than timeout seconds"""
+        if timeout is None:
+            timeout = self.flush_timeout
+        end = time() + timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = end - time()
+                if remaining <= 0:
+                    print("Gave up waiting for slack notifications")
+                    return False
+                self.queue.all_tasks_done.wait(remaining)
+        return True
+
+    def _work(self):
+        while True:
+            batch = [self.queue.get()]
+            end = time() + self.coalesce_window
+            while True:
+                try:
+                    batch.append(self.queue.get(timeout=max(end - time(),
+                                                            0)))
+                except Empty:
+                    break
+            # Whatever goes wrong, the worker must carry on, or every
+            # later message (and flush) would wait on it forever
+            try:
+                if self.enabled:
+                    self._send("\n".join(batch))
+            except Exception as e:
+                print("Error sending slack notification: {}".format(e))
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def _send(self, message):
         data = json.dumps({"text": message,
                            "channel": self.channel,
                            "username": self.username,
@@ -28,15 +115,25 @@ class Notifier:
         # the network is down, slack is really down, etc.  In that
         # case requests will Raise and that needs catching.
         #
-        # In either case, as soon as one request fails, don't send
-        # future notifications as they're highly unlikely to work,
-        # and if they're timing out that'll get tedious.
-        try:
-            r = requests.post(self.url, data=data, headers=self.headers)
-            if r.status_code >= 300:
-                print("Problem sending message: " + r.reason)
-                self.enabled = False
-        except Exception as e:
-            print("There was a problem sending the slack message:\n{}".format(
-                str(e)))
-            self.enabled = False
+        # Server errors, rate limiting and network problems may be
+        # temporary, so we retry those a few times.  Once a message
+        # has failed, don't send future notifications as they're
+        # highly unlikely to work, and if they're timing out that'll
+        # get tedious.
+        for attempt in range(self.attempts):
+            if attempt > 0:
+                sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                r = self.session.post(self.url, data=data,
+                                      headers=self.headers,
+                                      timeout=self.timeout)
+                if r.status_code < 300:
+                    return
+                problem = "Problem sending message: " + r.reason
+                if r.status_code != 429 and r.status_code < 500:
+                    break
+            except Exception as e:
+                problem = "There was a problem sending the slack " \
+                          "message:\n{}".format(str(e))
+        print(problem)
+        self.enabled = False
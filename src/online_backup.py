@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Online backups of the Montagu database (see db_backup.py); needs the
+'db_backup' and 'enable_db_replication' settings.  None of these stop
+Montagu, except restore --replace, which stops only the database.
+
+Usage:
+  online_backup.py base
+  online_backup.py restore [--time=<time>] [--replace]
+  online_backup.py verify [--time=<time>]
+
+Options:
+  --time=<time>  Recover to this point in time (UTC, e.g.
+                 2019-03-01T12:00:00), rather than to the end of the
+                 archived WAL
+  --replace      Restore over the live database, rather than into a new
+                 volume
+"""
+from datetime import datetime, timezone
+from os import chdir
+from os.path import abspath, dirname
+
+from docopt import docopt
+
+import db_backup
+from service import MontaguService
+from settings import get_settings
+
+
+def parse_time(value):
+    if value is None:
+        return None
+    return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S").replace(
+        tzinfo=timezone.utc)
+
+
+def online_backup(args):
+    settings = get_settings()
+    if not db_backup.enabled(settings):
+        raise Exception("Online backups need the 'db_backup' and "
+                        "'enable_db_replication' settings")
+    service = MontaguService(settings)
+    target_time = parse_time(args["--time"])
+    if args["base"]:
+        db_backup.base_backup(service)
+    elif args["restore"]:
+        volume = service.volume_name("db") if args["--replace"] else None
+        volume = db_backup.restore(service, target_time, volume)
+        print("Restored into volume {}".format(volume))
+    elif args["verify"]:
+        db_backup.verify(service, target_time)
+
+
+if __name__ == "__main__":
+    args = docopt(__doc__)
+    chdir(dirname(abspath(__file__)))
+    online_backup(args)
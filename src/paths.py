@@ -8,6 +8,10 @@ certs = '../certs'
 config = '../config'
 container_config = '../container_config'
 static = "../static-ssh"
+# Kept between deploys (see bb8_snapshot)
+snapshots = '../snapshots'
+# Kept between deploys (see db_backup)
+db_backups = '../db_backups'
 
 
 def delete_safely(path):
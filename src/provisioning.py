@@ -0,0 +1,131 @@
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import run, PIPE
+
+import cli
+import events
+import orderlyweb_cli
+from docker_helpers import pull
+
+# Declarative provisioning of Montagu and OrderlyWeb users.  Both CLIs
+# are run as a fresh container per command, and starting the container
+# is most of the cost, so the commands for each user are run as one
+# batch, and the batches for different users run at the same time.
+# Commands within a batch run in order, and a batch stops at its first
+# failure.
+#
+#     results = provision(service,
+#                         users=[MontaguUser("test.user", "Test User",
+#                                            "test.user@example.com",
+#                                            "password", roles=["user"])],
+#                         orderlyweb_users=[OrderlyWebUser(
+#                             "test.user@example.com", ["*/reports.read"])])
+
+
+class MontaguUser:
+    def __init__(self, username, name, email, password, roles=None,
+                 groups=None):
+        self.username = username
+        self.name = name
+        self.email = email
+        self.password = password
+        self.roles = list(roles or [])
+        self.groups = list(groups or [])
+
+    def commands(self):
+        return [["add", self.name, self.username, self.email, self.password,
+                 "--if-not-exists"]] + \
+               [["addRole", self.username, r] for r in self.roles] + \
+               [["addUserToGroup", self.username, g] for g in self.groups]
+
+
+class OrderlyWebUser:
+    def __init__(self, email, permissions=None):
+        self.email = email
+        self.permissions = list(permissions or [])
+
+    def commands(self):
+        commands = [["add-users", self.email]]
+        if self.permissions:
+            commands.append(["grant", self.email] + self.permissions)
+        return commands
+
+
+class CommandResult:
+    def __init__(self, tool, args, returncode, stdout, stderr):
+        self.tool = tool
+        self.args = args
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+
+    @property
+    def ok(self):
+        return self.returncode == 0
+
+    def __str__(self):
+        status = "ok" if self.ok else "failed ({})".format(self.returncode)
+        return "{} {}: {}".format(self.tool, self.args[0], status)
+
+
+# Montagu test users (see the add_test_user setting)
+test_users = [
+    MontaguUser("test.admin", "Test Admin", "test.admin@imperial.ac.uk",
+                "password", roles=["user", "touchstone-reviewer", "admin"]),
+    MontaguUser("test.modeller", "Test Modeller",
+                "test.modeller@imperial.ac.uk", "password", roles=["user"],
+                groups=["IC-Garske", "Harvard-Sweet"])
+]
+
+
+def run_batch(tool, docker_cmd, batch):
+    results = []
+    for args in batch:
+        p = run(docker_cmd + args, stdout=PIPE, stderr=PIPE)
+        result = CommandResult(tool, args, p.returncode,
+                               p.stdout.decode("UTF-8").strip(),
+                               p.stderr.decode("UTF-8").strip())
+        results.append(result)
+        if not result.ok:
+            break
+    return results
+
+
+def provision(service, users=(), orderlyweb_users=(), max_workers=4):
+    """Returns a list of CommandResults, for every command that was run.
+    Failures of montagu-cli commands raise an exception (after all the
+    batches have finished); failures of the OrderlyWeb CLI are only
+    reported as warnings, as OrderlyWeb is not part of this deploy."""
+    batches = []
+    if users:
+        image = cli.montagu_cli_image()
+        pull(image)
+        docker_cmd = cli.get_docker_run_cmd(service.network_name)
+        password_group = service.settings["password_group"]
+        if password_group is not None:
+            docker_cmd += cli.add_secure_config(password_group)
+        docker_cmd += [image]
+        batches += [("montagu-cli", docker_cmd, u.commands()) for u in users]
+    if orderlyweb_users:
+        docker_cmd = orderlyweb_cli.get_docker_run_cmd(service)
+        batches += [("orderlyweb-cli", docker_cmd, u.commands())
+                    for u in orderlyweb_users]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        results = [r for rs in pool.map(lambda b: run_batch(*b), batches)
+                   for r in rs]
+
+    for r in results:
+        events.info("- {}".format(r))
+        if not r.ok:
+            events.info("  {}".format(r.stderr or r.stdout))
+    failed = [r for r in results if not r.ok and r.tool == "montagu-cli"]
+    if failed:
+        raise Exception("Failed to provision users: {}".format(
+            ", ".join(" ".join(r.args[:2]) for r in failed)))
+    if any(not r.ok for r in results):
+        events.info("Warning: failed to execute some OrderlyWeb commands")
+    return results
+
+
+def add_test_users(service):
+    return provision(service, users=test_users)
@@ -0,0 +1,150 @@
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep, time
+
+import psycopg2
+import requests
+from requests.packages.urllib3.exceptions import InsecureRequestWarning
+
+import events
+
+
+# Readiness probes for the parts of Montagu.  Rather than sleeping for
+# a fixed time we poll each component, backing off exponentially, until
+# it is ready or its timeout runs out.  A check returns True when the
+# component is ready; anything else (False, or an exception) means
+# "not yet", except for ProbeFailed, which means that waiting longer
+# will not help and stops the wait straight away.
+class ProbeFailed(Exception):
+    pass
+
+
+class Probe:
+    def __init__(self, name, check, timeout):
+        self.name = name
+        self.check = check
+        self.timeout = timeout
+
+
+def wait_until_ready(probe, initial_delay=0.5, max_delay=10):
+    start = time()
+    delay = initial_delay
+    while True:
+        try:
+            if probe.check():
+                events.info("- {} is ready ({:.1f}s)".format(
+                    probe.name, time() - start))
+                return
+            reason = "not ready"
+        except ProbeFailed as e:
+            raise Exception("{} failed to start: {}".format(probe.name, e))
+        except Exception as e:
+            reason = str(e).strip() or type(e).__name__
+        if time() - start + delay > probe.timeout:
+            raise Exception("{} was not ready after {}s. Last reason: {}"
+                            .format(probe.name, probe.timeout, reason))
+        sleep(delay)
+        delay = min(delay * 2, max_delay)
+
+
+def wait_for(probes):
+    """Wait for all the probes at once; raises the first failure"""
+    with ThreadPoolExecutor(max_workers=max(len(probes), 1)) as pool:
+        list(pool.map(wait_until_ready, probes))
+
+
+def containers_probe(service, timeout=60):
+    def check():
+        containers = dict((c.name, c) for c in
+                          service.client.containers.list(all=True))
+        waiting = []
+        for name in sorted(service.container_names):
+            if name == service.container_name("metrics"):
+                continue
+            container = containers.get(name)
+            status = container.status if container else "missing"
+            if status in ["exited", "dead"]:
+                raise ProbeFailed("container {} is {}".format(name, status))
+            if status != "running":
+                waiting.append("{} is {}".format(name, status))
+        if waiting:
+            raise Exception(", ".join(waiting))
+        return True
+    return Probe("Montagu containers", check, timeout)
+
+
+def database_probe(service, timeout=3600):
+    # We may not know the root password yet, and the montagu database
+    # may not exist, but either error means that postgres is up and
+    # answering.
+    not_ready = ["could not connect", "connection refused",
+                 "starting up", "shutting down", "timeout expired",
+                 "closed the connection", "recovery mode"]
+
+    def check():
+        try:
+            psycopg2.connect(host="localhost", port=5432, dbname="montagu",
+                             user="vimc", password="", connect_timeout=5
+                             ).close()
+        except psycopg2.OperationalError as e:
+            message = str(e).strip()
+            if any(x in message.lower() for x in not_ready):
+                raise
+        return True
+    return Probe("Database", check, timeout)
+
+
+def api_probe(service, timeout=300):
+    # The API only starts once it has its go signal, and is reached
+    # through the proxy, so this needs both configured first.  The
+    # proxy doesn't serve a colour that isn't live yet (see blue_green),
+    # so that is checked on its own network instead.
+    requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+
+    def api_url():
+        if service.live:
+            return "https://localhost:{}/api/v1/".format(
+                service.settings["port"])
+        container = service.api
+        container.reload()
+        networks = container.attrs["NetworkSettings"]["Networks"]
+        return "http://{}:8080/v1/".format(
+            networks[service.network_name]["IPAddress"])
+
+    def check():
+        url = api_url()
+        r = requests.get(url, verify=False, timeout=5)
+        if r.status_code != 200:
+            raise Exception("{} returned {}".format(url, r.status_code))
+        return True
+    return Probe("API", check, timeout)
+
+
+def proxy_probe(service, timeout=120):
+    url = "http://localhost/basic_status"
+
+    def check():
+        r = requests.get(url, timeout=5)
+        if r.status_code != 200:
+            raise Exception("{} returned {}".format(url, r.status_code))
+        return True
+    return Probe("Reverse proxy", check, timeout)
+
+
+def mq_probe(service, timeout=120):
+    def check():
+        socket.create_connection(("localhost", 5672), timeout=5).close()
+        return True
+    return Probe("RabbitMQ", check, timeout)
+
+
+def task_queue_probe(service, timeout=120):
+    def check():
+        container = service.task_queue
+        if container is None:
+            raise ProbeFailed("container is missing")
+        container.reload()
+        if container.status in ["exited", "dead"]:
+            raise ProbeFailed("container is " + container.status)
+        return container.status == "running"
+    return Probe("Task queue worker", check, timeout)
@@ -1,35 +1,36 @@
 #!/usr/bin/env python3
 
 import database
+import events
 from notify import Notifier
 from service import MontaguService
 from settings import get_settings
 from os.path import abspath, dirname
 from os import chdir
-from cli import add_test_user
+from provisioning import add_test_users
 import bb8_backup
+import bb8_snapshot
 
 def restore_db():
     settings = get_settings()
     service = MontaguService(settings)
-    notifier = Notifier(settings['notify_channel'])
+    events.subscribe(Notifier(settings['notify_channel']).handle)
     try:
         ok = service.status == 'running' and service.db_volume_present
         if not ok:
             raise Exception('montagu not in a state we can restore')
-        bb8_backup.restore(service)
+        if settings["bb8_snapshot"]:
+            bb8_snapshot.restore(service)
+        else:
+            bb8_backup.restore()
         database.setup(service)
         if settings["add_test_user"] is True:
-            add_test_users()
-        notifier.post("*Restored* data from backup on `{}` :recycle:".format(
-            settings['instance_name']))
+            add_test_users(service)
+        events.emit("restore_finished", instance=settings['instance_name'])
     except Exception as e:
         print(e)
-        try:
-            notifier.post("*Failed* to restore data on `{}` :bomb:",
-                          settings['instance_name'])
-        except:
-            raise
+        events.emit("restore_failed", instance=settings['instance_name'],
+                    error=str(e))
 
 
 if __name__ == "__main__":
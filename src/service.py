@@ -1,8 +1,13 @@
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor
 
 import docker
 
 import compose
+import db_backup
+import events
+import timing
+from docker_helpers import pull_images
+from readiness import wait_until_ready, containers_probe
 
 # These values must line up with the docker-compose file
 components = {
@@ -21,6 +26,8 @@ components = {
     "volumes": {
         "static_logs": "static_logs",
         "static": "static_volume",
+        # Bare mirror of montagu-static-files (see static_server_config)
+        "static_mirror": "static_mirror",
         "db": "db_volume",
         # NOTE: even though we've dropped orderly from the deploy we
         # might depend on this volume for copying guidance reports
@@ -32,13 +39,53 @@ components = {
     "network": "default"
 }
 
+# A blue/green deploy (see blue_green) brings up a second set of the
+# containers below alongside the live ones.  Blue's containers belong to
+# the main docker compose project (named docker_prefix), and green's to
+# a second project, <docker_prefix>-green.  These components are not
+# doubled: they stay in the main project and serve whichever colour is
+# live, so the database (and its volume), message queue and host ports
+# are only ever used by one container each.
+shared_components = ["db", "mq", "proxy", "metrics", "fake_smtp_server"]
+colours = ["blue", "green"]
+
+metrics_image = 'nginx/nginx-prometheus-exporter:0.4.1'
+
+
+def colour_prefix(docker_prefix, colour):
+    return docker_prefix if colour == "blue" else docker_prefix + "-green"
+
+
+def live_colour(client, docker_prefix):
+    """Green is live for as long as the proxy is attached to its network"""
+    try:
+        proxy = client.containers.get("{}_proxy_1".format(docker_prefix))
+    except docker.errors.NotFound:
+        return "blue"
+    green = "{}_default".format(colour_prefix(docker_prefix, "green"))
+    networks = proxy.attrs["NetworkSettings"]["Networks"] or {}
+    return "green" if green in networks else "blue"
+
+
 class MontaguService:
-    def __init__(self, settings):
-        self.client = docker.from_env()
+    def __init__(self, settings, colour=None, client=None):
+        """colour is the colour (see blue_green) whose containers this
+        addresses; by default, the live one"""
+        if client is None:
+            client = docker.from_env()
+            timing.watch_docker_client(client)
+        self.client = client
         self.settings = dict(settings)
-        ## TODO: This will eventually be lifted up to be a setting
-        self.docker_prefix = "montagu"
-        self.settings['docker_prefix'] = self.docker_prefix
+        # The main docker compose project, which holds the volumes and
+        # the shared components
+        self.project = settings["docker_prefix"]
+        self.colour = colour or live_colour(self.client, self.project)
+        # Prefix used by docker compose for this colour's containers and
+        # network
+        self.docker_prefix = colour_prefix(self.project, self.colour)
+        # False while this colour is being brought up alongside the
+        # live one, so not yet reachable through the proxy
+        self.live = True
         # Our components:
         self.containers = components['containers'].copy()
         if settings["fake_smtp"]:
@@ -55,8 +102,15 @@ class MontaguService:
     def status(self):
         expected = self.container_names
         actual = dict((c.name, c) for c in self.client.containers.list(all=True))
-        unexpected = list(x for x in actual.keys() - expected
-                          if x.startswith(self.docker_prefix + "_"))
+        # The other colour's containers are left over from a blue/green
+        # deploy that did not finish, and are dealt with by that
+        other = self.other_colour().container_names
+        # The WAL archiver is left running while Montagu is stopped (see
+        # db_backup), so isn't part of its status
+        other.add(db_backup.archiver_name(self))
+        unexpected = list(x for x in actual.keys() - expected - other
+                          if x.startswith(self.project + "_") or
+                          x.startswith(self.docker_prefix + "_"))
         if any(unexpected):
             raise Exception("There are unexpected Montagu-related containers running: {}".format(unexpected))
 
@@ -73,25 +127,39 @@ class MontaguService:
                             "Manual intervention is required.\nStatus: {}".format(status_map))
 
     def container_name(self, name):
-        return "{}_{}_1".format(self.docker_prefix, self.containers[name])
+        prefix = self.project if name in shared_components \
+            else self.docker_prefix
+        return "{}_{}_1".format(prefix, self.containers[name])
 
     def volume_name(self, name):
-        return "{}_{}".format(self.docker_prefix, self.volumes[name])
+        return "{}_{}".format(self.project, self.volumes[name])
+
+    def compose_services(self, shared):
+        """The docker compose services that are shared between the
+        colours, or that belong to each colour"""
+        return [v for k, v in self.containers.items()
+                if k != "metrics" and
+                (k in shared_components) == shared]
+
+    def other_colour(self):
+        other = colours[1 - colours.index(self.colour)]
+        return MontaguService(self.settings, other, self.client)
 
     def start_metrics(self):
         # Metrics container has to be started last, after proxy has its SSL cert and is able to serve basic_status
-        self.client.containers.run('nginx/nginx-prometheus-exporter:0.4.1',
+        self.client.containers.run(metrics_image,
                                     restart_policy = {"Name": "always"},
                                     ports = {'9113/tcp': 9113},
-                                    command = '-nginx.scrape-uri "http://montagu_proxy_1/basic_status"',
-                                    network = 'montagu_default',
+                                    command = '-nginx.scrape-uri "http://{}/basic_status"'.format(
+                                        self.container_name("proxy")),
+                                    network = self.shared_network_name,
                                     name = self.container_name("metrics"),
                                     detach = True)
 
     def stop_metrics(self):
         # Since we now start the metrics container outside of compose, we need to tear it down separately too
         container_name = self.container_name("metrics")
-        print ("Stopping Montagu metrics container {}".format(container_name))
+        events.info("Stopping Montagu metrics container {}".format(container_name))
         metrics_container = self.client.containers.get(container_name)
         metrics_container.remove(force=True)
 
@@ -135,6 +203,12 @@ class MontaguService:
     def network_name(self):
         return "{}_{}".format(self.docker_prefix, self.network)
 
+    @property
+    def shared_network_name(self):
+        """The main project's network, which the shared components are
+        always attached to"""
+        return "{}_{}".format(self.project, self.network)
+
     def _get(self, name):
         try:
             return self.client.containers.get(self.container_name(name))
@@ -145,24 +219,21 @@ class MontaguService:
         try:
             self.stop_metrics()
         except Exception as e:
-            print("Error when stopping Metrics container: {}".format(str(e)))
+            events.info("Error when stopping Metrics container: {}".format(str(e)))
 
-        print("Stopping Montagu...({}: {})".format(
-            self.settings["instance_name"], self.settings["docker_prefix"]),
-              flush=True)
+        events.info("Stopping Montagu...({}: {})".format(
+            self.settings["instance_name"], self.docker_prefix))
         # always remove the static container
         if self.static:
             try:
                 self.static.remove(force=True)
             except docker.errors.NotFound:
                 pass
+        # Green's project, live or left over from an unfinished deploy
+        green = self if self.colour == "green" else self.other_colour()
+        if green.exists:
+            green.remove_colour()
         compose.stop(self.settings)
-        print("Wiping static file volume")
-        try:
-            static_volume = self.client.volumes.get(self.volume_name("static"))
-            static_volume.remove(force=True)
-        except docker.errors.NotFound:
-            return None
         if not self.settings["persist_data"]:
             for v in self.volumes:
                 name = self.volume_name(v)
@@ -171,16 +242,92 @@ class MontaguService:
                 except docker.errors.NotFound:
                     pass
 
-    def pull(self):
-        print("Pulling images for Montagu", flush=True)
-        compose.pull(self.settings)
-
-    def start(self):
-        print("Starting Montagu...", flush=True)
-        compose.start(self.settings)
-        print("- Checking Montagu has started successfully")
-        sleep(2)
-        if self.status != "running":
-            raise Exception("Failed to start Montagu. Service status is {}".format(self.status))
+    def own_containers(self):
+        """This colour's containers, other than the shared components"""
+        names = set(self.container_name(x) for x in self.containers
+                    if x not in shared_components)
+        return [c for c in self.client.containers.list(all=True)
+                if c.name in names]
+
+    @property
+    def exists(self):
+        return any(self.own_containers())
+
+    def attach_shared(self):
+        """Attach the shared components (other than the proxy, which
+        blue_green.switch moves) to this colour's network, under their
+        usual names, so that this colour's containers can reach them"""
+        if self.colour == "blue":
+            return
+        network = self.client.networks.get(self.network_name)
+        for name in ["db", "mq", "fake_smtp_server"]:
+            container = self._get(name) if name in self.containers else None
+            if container is None:
+                continue
+            container.reload()
+            if self.network_name not in \
+                    container.attrs["NetworkSettings"]["Networks"]:
+                network.connect(container, aliases=[self.containers[name]])
+
+    def remove_colour(self):
+        """Remove this colour's own containers, leaving the shared
+        components running"""
+        events.info("Removing the {} containers".format(self.colour))
+        if self.colour == "blue":
+            compose.remove(self.settings, self.compose_services(False))
+            return
+        # The shared components have to leave the network before
+        # docker compose can remove it
+        try:
+            network = self.client.networks.get(self.network_name)
+        except docker.errors.NotFound:
+            network = None
+        if network is not None:
+            for name in ["db", "mq", "fake_smtp_server", "proxy"]:
+                container = self._get(name) if name in self.containers \
+                    else None
+                if container is None:
+                    continue
+                container.reload()
+                if self.network_name in \
+                        container.attrs["NetworkSettings"]["Networks"]:
+                    network.disconnect(container)
+        compose.down(self.settings, self.docker_prefix)
+
+    def pull(self, extra_images=()):
+        """Pull the images in the compose file, along with any other
+        images that the deploy will run, all at the same time"""
+        events.info("Pulling images for Montagu")
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            compose_pull = pool.submit(compose.pull, self.settings)
+            pull_images(list(extra_images) + [metrics_image], self.client)
+            compose_pull.result()
+
+    def start(self, services=None):
+        if services:
+            events.info("Restarting Montagu services: {}".format(
+                ", ".join(services)))
+        else:
+            events.info("Starting Montagu...")
+        if self.colour == "blue":
+            compose.start(self.settings, services)
+        else:
+            # The shared components are in the main project, and the
+            # rest in green's own
+            shared = self.compose_services(True)
+            own = self.compose_services(False)
+            if services:
+                shared = [x for x in shared if x in services]
+                own = [x for x in own if x in services]
+            if shared:
+                compose.start(self.settings, shared)
+            if own:
+                # Created first, so that the shared components are on
+                # the network before anything starts and looks for them
+                compose.create(self.settings, own, self.docker_prefix)
+                self.attach_shared()
+                compose.start(self.settings, own, self.docker_prefix)
+        events.info("- Checking Montagu has started successfully")
+        wait_until_ready(containers_probe(self))
 
 __all__ = ["MontaguService"]
@@ -1,70 +1,63 @@
-from os import makedirs
+from io import StringIO
 from os.path import join, isfile
 
+import events
 import paths
 from cert_tool import run_cert_tool
-from docker_helpers import docker_cp
+from container_session import ContainerSession
 from settings import get_secret
 
 api_db_user = "api"
 
 
-def configure_api(service, db_password: str, keypair_paths, hostname, is_prod: bool,
-                  orderly_web_api_url):
+def configure_api(service, config, keypair_paths):
+    """config is the text of config.properties, made beforehand with
+    generate_api_config_file"""
     config_path = "/etc/montagu/api/"
-    container = service.api
-    print("Configuring API")
-    service.api.exec_run("mkdir -p " + config_path)
+    events.info("Configuring API")
+    with ContainerSession(service.api) as session:
+        events.info("- Injecting token signing keypair into container")
+        session.add_local_file(keypair_paths['private'], join(config_path, "token_key/private_key.der"))
+        session.add_local_file(keypair_paths['public'], join(config_path, "token_key/public_key.der"))
 
-    print("- Injecting token signing keypair into container")
-    service.api.exec_run("mkdir -p " + join(config_path, "token_key"))
-    docker_cp(keypair_paths['private'], container.name, join(config_path, "token_key/private_key.der"))
-    docker_cp(keypair_paths['public'], container.name, join(config_path, "token_key/public_key.der"))
+        events.info("- Injecting settings into container")
+        session.add_file(join(config_path, "config.properties"), config)
 
-    print("- Injecting settings into container")
-    generate_api_config_file(service, config_path, db_password, hostname,
-                             is_prod, orderly_web_api_url)
+        events.info("- Sending go signal to API")
+        session.run("touch {}/go_signal".format(config_path))
 
-    print("- Sending go signal to API")
-    service.api.exec_run("touch {}/go_signal".format(config_path))
 
-
-def add_property(container, config_path, key, value):
-    path = "{}/config.properties".format(config_path)
-    container.exec_run("touch {}".format(path))
-    container.exec_run('echo "{key}={value}" >> {path}'.format(key=key, value=value, path=path))
-
-
-def get_token_keypair():
-    print("Generating token signing keypair")
-    run_cert_tool("gen-keypair", paths.token_keypair, args=['/working'])
+def get_token_keypair(reuse=False):
+    """With reuse, a keypair left by an earlier deploy is used if there
+    is one"""
     result = {
         "private": join(paths.token_keypair, "private_key.der"),
         "public": join(paths.token_keypair, "public_key.der"),
         "public_pem": join(paths.token_keypair, "public_key.pem")
     }
+    if reuse and all(isfile(x) for x in result.values()):
+        events.info("Using existing token signing keypair")
+        return result
+    events.info("Generating token signing keypair")
+    run_cert_tool("gen-keypair", paths.token_keypair, args=['/working'])
     if (not isfile(result['private'])) or (not isfile(result['public'])):
         raise Exception("Obtaining token keypair failed: Missing file(s) in " + paths.token_keypair)
     return result
 
 
-def generate_api_config_file(service, config_path, db_password: str, hostname: str, is_prod: bool,
+def generate_api_config_file(db_password: str, hostname: str, is_prod: bool,
                              orderly_web_api_url: str):
-    makedirs(paths.config, exist_ok=True)
-    config_file_path = join(paths.config, "config.properties")
     public_url = "https://{}/api".format(hostname)
-    print(" - Public URL: " + public_url)
-    api_name = service.container_name("api")
+    events.info(" - Public URL: " + public_url)
 
-    with open(config_file_path, "w") as file:
+    with StringIO() as file:
         print("allow.localhost=false", file=file)
         print("db.username={}".format(api_db_user), file=file)
         print("db.password={}".format(db_password), file=file)
         print("app.url={}".format(public_url), file=file)
         print("orderlyweb.api.url={}".format(orderly_web_api_url), file=file)
         configure_email(file, is_prod)
-
-    docker_cp(config_file_path, api_name, join(config_path, "config.properties"))
+        return file.getvalue()
 
 
 def configure_email(file, is_prod: bool):
@@ -1,19 +1,20 @@
-from docker_helpers import copy_between_volumes
 from os.path import join
 
+import events
+from volume_copy import copy_manifest
+
 
 def configure_contrib_portal(service):
     guidance_paths = get_report_versions("guidance_report_versions")
-    print("Configuring contrib portal")
-    for p in guidance_paths:
-        if len(p) > 0:
-            path_to_artefacts = join("archive", p, "*.html")
-            add_reports_to_contrib_portal(service, path_to_artefacts, "guidance")
+    events.info("Configuring contrib portal")
+    paths_to_reports = [join("archive", p, "*.html") for p in guidance_paths if len(p) > 0]
+    add_reports_to_contrib_portal(service, paths_to_reports, "guidance")
 
 
-def add_reports_to_contrib_portal(service, path_to_reports, volume_name):
-    print("- Copying {} reports from orderly to contrib portal".format(volume_name))
-    copy_between_volumes(service.volume_name("orderly"), service.volume_name(volume_name), path_to_reports)
+def add_reports_to_contrib_portal(service, paths_to_reports, volume_name):
+    events.info("- Copying {} reports from orderly to contrib portal".format(volume_name))
+    manifest = [(p, ".") for p in paths_to_reports]
+    copy_manifest(service.volume_name("orderly"), service.volume_name(volume_name), manifest)
 
 
 def get_report_versions(path):
@@ -1,22 +1,22 @@
-import shutil
 from os.path import join
 from typing import Dict
 
-from docker_helpers import docker_cp
+import events
+from container_session import ContainerSession
 
 
 def configure_proxy(service, cert_paths: Dict[str, str]):
-    print("Configuring reverse proxy")
+    events.info("Configuring reverse proxy")
     add_certificate_to_proxy(service, cert_paths)
 
 
 def add_certificate_to_proxy(service, cert_paths: Dict[str, str]):
-    print("- Adding certificate to reverse-proxy container")
+    events.info("- Adding certificate to reverse-proxy container")
     add_certificate(service.proxy, cert_paths, "/etc/montagu/proxy")
 
 
 def add_certificate(container, cert_paths, path):
-    container.exec_run("mkdir -p {}".format(path))
-    docker_cp(cert_paths['certificate'], container.name, join(path, "certificate.pem"))
-    docker_cp(cert_paths['key'], container.name, join(path, "ssl_key.pem"))
-    docker_cp(cert_paths['dhparam'], container.name, join(path, "dhparam.pem"))
+    with ContainerSession(container) as session:
+        session.add_local_file(cert_paths['certificate'], join(path, "certificate.pem"))
+        session.add_local_file(cert_paths['key'], join(path, "ssl_key.pem"))
+        session.add_local_file(cert_paths['dhparam'], join(path, "dhparam.pem"))
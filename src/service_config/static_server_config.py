@@ -1,45 +1,106 @@
-from docker_helpers import docker_cp
-from docker_helpers import copy_between_volumes
+from container_session import ContainerSession
+from docker_helpers import exec_safely, volume_copy_image
+import events
 from os.path import join
 import os
+import time
 from pathlib import Path
 import paths
 from settings import save_secret_to_file
 from subprocess import run
+from volume_copy import copy_manifest
 
 montagu_root = str(Path(__file__).parent.parent.parent)
+static_git_image = "alpine/git"
+static_files_repo = "git@github.com:vimc/montagu-static-files.git"
+
+# The static volume holds complete releases of the site, each in
+# /static/releases/<release>, and a single 'current' link to the one
+# that is served; the static server's /www is a link to
+# /static/current.  A deploy builds a new release from the static files
+# repository (of which we keep a bare mirror in its own volume, so each
+# sync only fetches what has changed) and the artefacts copied in from
+# orderly, and only then switches 'current' to it, with a rename, so
+# the static server never sees a half-built site.  The previous release
+# is kept, and any older ones removed.
+static_build_script = r"""
+set -e
+repo=/mirror/montagu-static-files.git
+if [ -d "$repo" ]; then
+  git --git-dir="$repo" fetch --prune --quiet origin
+else
+  git clone --mirror --quiet "$1" "$repo"
+fi
+release="/static/releases/$2"
+rm -rf "$release" "$release.tmp" && mkdir -p "$release.tmp"
+# Not piped, so that a failed archive stops the sync
+git --git-dir="$repo" archive -o "$release.tar" HEAD www
+tar -x -C "$release.tmp" -f "$release.tar"
+mv "$release.tmp/www" "$release"
+rm -rf "$release.tar" "$release.tmp"
+echo "- Static files are at $(git --git-dir="$repo" rev-parse HEAD)"
+"""
+
+static_activate_script = r"""
+set -e
+cd /static
+test -d "releases/$1"
+ln -sfn "releases/$1" current.next
+mv -Tf current.next current
+# Anything else at the top of the volume is from before releases
+for old in $(ls -A); do
+  case "$old" in
+    releases|current) ;;
+    *) rm -rf "$old" ;;
+  esac
+done
+ls -1 releases | sort -r | tail -n +3 | while read -r old; do
+  if [ "$old" != "$1" ]; then
+    rm -rf "releases/$old"
+  fi
+done
+"""
+
+# Run in the static server, which serves /www
+static_link_script = r"""
+if [ "$(readlink /www)" != /static/current ]; then
+  rm -rf /www && ln -s /static/current /www
+fi
+"""
 
 
 def configure_static_server(service, keypair_paths):
-    container = service.static
-    print("Configuring static file server")
-    docker_cp(keypair_paths['public_pem'], container.name, "/public_key.pem")
+    events.info("Configuring static file server")
+    with ContainerSession(service.static) as session:
+        session.add_local_file(keypair_paths['public_pem'], "/public_key.pem")
     configure_static_files(service)
 
 
 def configure_static_files(service):
-    initialise_static_volume_from_github(service)
-    copy_static_files_from_orderly(service)
+    exec_safely(service.static, ["sh", "-c", static_link_script], check=True)
+    release = time.strftime("%Y%m%d-%H%M%S")
+    build_static_release(service, release)
+    copy_static_files_from_orderly(service, release)
+    activate_static_release(service, release)
 
 
-def copy_static_files_from_orderly(service):
+def copy_static_files_from_orderly(service, release):
     static_file_configs = get_static_file_configs(join(montagu_root, "static"))
+    manifest = []
     for config in static_file_configs:
-        print("Found static file config at {}".format(config["file_path"]))
+        events.info("Found static file config at {}".format(config["file_path"]))
         artefacts = get_artefacts(config["file_path"])
-        for a in artefacts:
-            if len(a) > 0:
-                add_artefact_to_static_volume(service, a, config["path_prefix"])
+        manifest += [artefact_copy(a, join("releases", release, config["path_prefix"]))
+                     for a in artefacts if len(a) > 0]
+    events.info("- Copying {} artefacts from orderly to static server".format(len(manifest)))
+    copy_manifest(service.volume_name("orderly"), service.volume_name("static"), manifest)
 
 
-def add_artefact_to_static_volume(service, artefact, path_prefix):
+def artefact_copy(artefact, path_prefix):
     artefact = artefact.split(",")
     path_to_artefacts = join("archive", artefact[0])
     destination = join(path_prefix, artefact[1])
-    print("- Copying artefacts from orderly at {path_to_artefacts} to static server at {destination}"
-          .format(path_to_artefacts=path_to_artefacts, destination=destination))
-    copy_between_volumes(service.volume_name("orderly"), service.volume_name("static"), path_to_artefacts,
-                         destination_path=destination)
+    return path_to_artefacts, destination
 
 
 def get_static_file_configs(path):
@@ -64,7 +125,7 @@ def configure_static_ssh(service):
         return
     ssh = paths.static + "/.ssh"
     if not os.path.exists(ssh):
-        print("Preparing static ssh")
+        events.info("Preparing static ssh")
         os.makedirs(ssh)
         save_secret_to_file("vimc-robot/id_rsa.pub", ssh + "/id_rsa.pub")
         save_secret_to_file("vimc-robot/id_rsa", ssh + "/id_rsa")
@@ -74,16 +135,23 @@ def configure_static_ssh(service):
     return os.path.abspath(ssh)
 
 
-def initialise_static_volume_from_github(service):
-    cmd = ["rm -rf /www/*",
-           "git clone --depth=1 git@github.com:vimc/montagu-static-files.git",
-           "mv montagu-static-files/www/* /www"]
+def build_static_release(service, release):
+    events.info("- Building static release {} from github".format(release))
     ssh_path = configure_static_ssh(service)
     run(["docker", "run", "--rm", "-i", "-t",
          "-v", "{}:/root/.ssh:ro".format(ssh_path),
-         "-v", "{}:/www".format(service.volume_name("static")),
+         "-v", "{}:/mirror".format(service.volume_name("static_mirror")),
+         "-v", "{}:/static".format(service.volume_name("static")),
          "--entrypoint", "ash",
-         "alpine/git",
-         "-c",
-         " && ".join(cmd)
+         static_git_image,
+         "-c", static_build_script, "build", static_files_repo, release
+         ], check=True)
+
+
+def activate_static_release(service, release):
+    events.info("- Serving static release {}".format(release))
+    run(["docker", "run", "--rm",
+         "-v", "{}:/static".format(service.volume_name("static")),
+         volume_copy_image,
+         "ash", "-c", static_activate_script, "activate", release
          ], check=True)
@@ -1,31 +1,52 @@
 import yaml
+import events
 import paths
-from os.path import join
-from docker_helpers import docker_cp, docker_cp_from
+import versions
+from os.path import isfile, join
+from container_session import ContainerSession
 from settings import get_secret
 
+container_config_file = "/home/worker/config/config.yml"
+# If present, this is used as the basis of the task queue's config;
+# otherwise the one that ships in the task queue image is used
+local_config_template = join(paths.container_config, "task_queue",
+                             "config.yml")
 
-def configure_task_queue(service, montagu_email, montagu_password,
-                         orderly_web_url, use_real_diagnostic_reports,  fake_smtp):
-    container = service.task_queue
 
-    print("Configuring Task Queue")
-    print("- reading config from container")
-    local_config_file = join(paths.config, "task_queue_config.yml")
-    container_config_file = "home/worker/config/config.yml"
-    docker_cp_from(container.name, container_config_file, local_config_file)
-    with open(local_config_file, "r") as ymlfile:
-        config = yaml.load(ymlfile, Loader=yaml.FullLoader)
+def task_queue_image():
+    return "vimc/task-queue-worker:{}".format(versions.task_queue)
 
-    print("- reading diagnostic reports")
+
+def read_config_template(service):
+    """The config to start from, read without needing a task queue
+    container to be running, so that it can be done before the deploy
+    stops Montagu"""
+    if isfile(local_config_template):
+        events.info("- reading config template " + local_config_template)
+        with open(local_config_template, "r") as f:
+            return f.read()
+    events.info("- reading config template from " + task_queue_image())
+    container = service.client.containers.create(task_queue_image())
+    try:
+        return ContainerSession(container).read_file(container_config_file)
+    finally:
+        container.remove(force=True)
+
+
+def generate_task_queue_config(service, template, montagu_email,
+                               montagu_password, orderly_web_url,
+                               use_real_diagnostic_reports, fake_smtp):
+    config = yaml.load(template, Loader=yaml.FullLoader)
+
+    events.info("- reading diagnostic reports")
     reports_cfg_filename = "real_diagnostic_reports.yml" if use_real_diagnostic_reports else "test_diagnostic_reports.yml"
     local_reports_cfg_file = join(paths.container_config, "task_queue", reports_cfg_filename)
     with open(local_reports_cfg_file, "r") as ymlfile:
         diag_reports = yaml.load(ymlfile, Loader=yaml.FullLoader)
 
-    print("- adding settings to config")
+    events.info("- adding settings to config")
     montagu = config["servers"]["montagu"]
-    montagu["url"] = "http://montagu_api_1:8080"
+    montagu["url"] = "http://{}:8080".format(service.container_name("api"))
     montagu["user"] = montagu_email
     montagu["password"] = montagu_password
 
@@ -38,14 +59,20 @@ def configure_task_queue(service, montagu_email, montagu_password,
     smtp = config["servers"]["smtp"]
     smtp["from"] = "montagu-help@imperial.ac.uk"
     if fake_smtp:
-        smtp["host"] = "montagu_fake_smtp_server_1"
+        smtp["host"] = service.container_name("fake_smtp_server")
     else:
         smtp["host"] = "smtp.cc.ic.ac.uk"
         smtp["port"] = 587
         smtp["user"] = "montagu"
         smtp["password"] = get_secret("email/password")
 
-    print("- writing config to container")
-    with open(local_config_file, "w") as file:
-        yaml.dump(config, file)
-    docker_cp(local_config_file, container.name, container_config_file)
+    return yaml.dump(config)
+
+
+def configure_task_queue(service, config):
+    """config is the text of the task queue's config, made beforehand
+    with generate_task_queue_config"""
+    events.info("Configuring Task Queue")
+    events.info("- writing config to container")
+    with ContainerSession(service.task_queue) as session:
+        session.add_file(container_config_file, config)
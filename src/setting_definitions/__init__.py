@@ -48,6 +48,13 @@ definitions = [
                              "'bb8_backup' is false and "
                              "'initial_data_source' is 'bb8_restore'",
                              default_value=False),
+    BooleanSettingDefinition("bb8_snapshot",
+                             "Should bb8 restores be kept as a local snapshot?",
+                             "Only has an effect if 'initial_data_source' is "
+                             "'bb8_restore'.  Restoring the same backup again "
+                             "is then much faster, at the cost of the disk "
+                             "space for a compressed copy of the data.",
+                             default_value=False),
     BooleanSettingDefinition("open_browser",
                              "Open the browser after deployment?",
                              "If you answer yes, Montagu will be opened after deployment",
@@ -109,6 +116,12 @@ definitions = [
     SettingDefinition("instance_name",
                       "What is the name of this instance?",
                       default_value="(unknown)"),
+    SettingDefinition("docker_prefix",
+                      "What prefix should the docker containers, volumes and network use?",
+                      "This is passed to docker compose as the project name (blue/green deploys also use "
+                      "'<prefix>-green'). Unless you are running more than one Montagu on the same machine, "
+                      "just use the default",
+                      default_value="montagu"),
 
     BooleanSettingDefinition("require_clean_git",
                              "Should we require a clean git state?",
@@ -124,6 +137,21 @@ definitions = [
                              "Should we add a test user with access to all modelling groups?",
                              "This must set to False on production!",
                              default_value=False),
+    BooleanSettingDefinition("db_backup",
+                             "Should the database be backed up continuously?",
+                             "Archives the database's WAL as it is written, "
+                             "with periodic base backups, so that it can be "
+                             "restored to any point in time without stopping "
+                             "Montagu (see src/online_backup.py).  Needs "
+                             "'enable_db_replication'.",
+                             default_value=False),
+    BooleanSettingDefinition("blue_green",
+                             "Should deploys bring the new version up alongside the old one?",
+                             "A full deploy of a running Montagu then starts the new containers "
+                             "next to the live ones, configures and checks them, and switches "
+                             "the proxy over to them, rather than stopping Montagu (see "
+                             "src/blue_green.py).  Deploys that restore or import data still stop it.",
+                             default_value=False),
     BooleanSettingDefinition("include_guidance_reports",
                              "Should we copy guidance reports from "
                              "orderly into the contrib portal container?",
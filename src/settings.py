@@ -4,6 +4,7 @@ from getpass import getpass
 from os.path import abspath
 from subprocess import check_output, run
 
+import vault
 from setting_definitions import definitions, vault_required
 
 default_path = 'montagu-deploy.json'
@@ -104,13 +105,20 @@ def save_settings(settings, path=default_path):
 
 def get_secret(secret_path, field="value"):
     secret_path = "secret/{}".format(secret_path)
-    return check_output(["vault", "read", "-field=" + field, secret_path]).decode('utf-8')
+    return vault.client.read(secret_path, field)
+
+
+def prefetch_secrets(secret_paths):
+    """Read all of these secrets from the vault at once, so that later
+    calls to get_secret for them return immediately"""
+    vault.client.prefetch("secret/{}".format(p) for p in secret_paths)
 
 
 def set_secret(secret_path, value, field="value"):
     secret_path = "secret/{}".format(secret_path)
     pair = "{field}={value}".format(field = field, value = value)
     check_output(["vault", "write", secret_path, pair])
+    vault.client.forget(secret_path)
 
 
 def list_secrets(secret_path):
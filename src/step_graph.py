@@ -0,0 +1,118 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import events
+import timing
+
+# The default number of steps that may be run at the same time.  Most
+# of our steps are waiting on docker or on the network, so a handful
+# of threads is plenty.
+default_max_workers = 4
+
+
+class Step:
+    def __init__(self, name, action, depends_on=None):
+        """action is a callback (function) that takes a dictionary mapping
+        the names of completed steps to their return values; depends_on is
+        a list of names of steps that must finish before this one starts"""
+        self.name = name
+        self.action = action
+        self.depends_on = list(depends_on or [])
+
+
+def check_steps(steps):
+    names = [s.name for s in steps]
+    duplicated = set(x for x in names if names.count(x) > 1)
+    if duplicated:
+        raise Exception("Duplicated step names: {}".format(sorted(duplicated)))
+    for s in steps:
+        unknown = [d for d in s.depends_on if d not in names]
+        if unknown:
+            raise Exception("Step '{}' depends on unknown steps: {}".format(
+                s.name, unknown))
+    # Kahn's algorithm; anything left over is part of a cycle
+    remaining = dict((s.name, set(s.depends_on)) for s in steps)
+    while remaining:
+        ready = [k for k, v in remaining.items() if not v]
+        if not ready:
+            raise Exception("Steps have circular dependencies: {}".format(
+                sorted(remaining.keys())))
+        for k in ready:
+            del remaining[k]
+        for v in remaining.values():
+            v.difference_update(ready)
+
+
+def select_steps(steps, names):
+    """The steps with the given names, along with every step that they
+    depend on; names that do not match any step are ignored"""
+    by_name = dict((s.name, s) for s in steps)
+    wanted = set()
+    todo = [x for x in names if x in by_name]
+    while todo:
+        current = todo.pop()
+        if current not in wanted:
+            wanted.add(current)
+            todo += by_name[current].depends_on
+    return [s for s in steps if s.name in wanted]
+
+
+def downstream_of(steps, name):
+    found = set()
+    todo = [name]
+    while todo:
+        current = todo.pop()
+        for s in steps:
+            if current in s.depends_on and s.name not in found:
+                found.add(s.name)
+                todo.append(s.name)
+    return found
+
+
+def run_step(step, results, parent):
+    with timing.span(step.name, parent):
+        return step.action(results)
+
+
+def run_steps(steps, max_workers=default_max_workers, keep_going=False):
+    """Run each step as soon as all the steps it depends on have
+    finished, with at most max_workers steps running at once.  Returns a
+    dictionary of the return values of every step.  If a step fails, no
+    further steps are started (or, with keep_going, only the steps that
+    depend on the failed one are skipped), the steps that are already
+    running are allowed to finish, and the first error is re-raised."""
+    check_steps(steps)
+    by_name = dict((s.name, s) for s in steps)
+    results = {}
+    pending = [s.name for s in steps]
+    running = {}
+    failed = None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while pending or running:
+            if failed is None or keep_going:
+                for name in list(pending):
+                    step = by_name[name]
+                    if all(d in results for d in step.depends_on):
+                        pending.remove(name)
+                        future = pool.submit(run_step, step, dict(results),
+                                             timing.current_span())
+                        running[future] = name
+            if not running:
+                break
+            done, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    events.info("Step '{}' failed: {}".format(name, e))
+                    skipped = downstream_of(steps, name)
+                    if skipped and (failed is None or keep_going):
+                        events.info("- Cancelling dependent steps: {}".format(
+                            ", ".join(sorted(skipped))))
+                    if failed is None:
+                        failed = e
+
+    if failed is not None:
+        raise failed
+    return results
@@ -0,0 +1,92 @@
+from threading import Lock
+from time import time
+from xml.etree import ElementTree
+
+import traceback
+
+import timing
+from step_graph import Step, run_steps
+
+# Running integration test suites (see test.py) concurrently, and
+# reporting their results as JUnit XML.
+#
+# Once OrderlyWeb is up the suites are independent of each other, except
+# where they share mutable state; each suite lists the shared resources
+# it uses and suites that share a resource never run at the same time.
+class Suite:
+    def __init__(self, name, work, depends_on=None, resources=None):
+        self.name = name
+        self.work = work
+        self.depends_on = list(depends_on or [])
+        self.resources = sorted(resources or [])
+
+
+class SuiteResult:
+    def __init__(self, name, status, seconds=0, message=None, details=None):
+        self.name = name
+        self.status = status
+        self.seconds = seconds
+        self.message = message
+        self.details = details
+
+
+def run_suites(suites, workers):
+    locks = dict((r, Lock()) for s in suites for r in s.resources)
+    results = {}
+
+    def run_suite(suite):
+        held = [locks[r] for r in suite.resources]
+        for lock in held:
+            lock.acquire()
+        start = time()
+        try:
+            suite.work()
+            status, message, details = "passed", None, None
+        except Exception as e:
+            status, message = "failed", str(e) or type(e).__name__
+            details = traceback.format_exc()
+            raise
+        finally:
+            for lock in reversed(held):
+                lock.release()
+            results[suite.name] = SuiteResult(
+                suite.name, status, time() - start, message,
+                details)
+
+    steps = [Step(s.name, lambda _, s=s: run_suite(s), s.depends_on)
+             for s in suites]
+    try:
+        with timing.span("tests"):
+            run_steps(steps, max_workers=workers, keep_going=True)
+    except Exception:
+        # Already reported, and recorded in results
+        pass
+    return [results.get(s.name, SuiteResult(s.name, "skipped"))
+            for s in suites]
+
+
+def write_junit(results, path):
+    failures = sum(1 for r in results if r.status == "failed")
+    skipped = sum(1 for r in results if r.status == "skipped")
+    root = ElementTree.Element("testsuite", {
+        "name": "montagu-integration-tests",
+        "tests": str(len(results)),
+        "failures": str(failures),
+        "skipped": str(skipped),
+        "time": "{:.3f}".format(sum(r.seconds for r in results))
+    })
+    for r in results:
+        case = ElementTree.SubElement(root, "testcase", {
+            "classname": "montagu",
+            "name": r.name,
+            "time": "{:.3f}".format(r.seconds)
+        })
+        if r.status == "failed":
+            failure = ElementTree.SubElement(case, "failure",
+                                             {"message": r.message})
+            failure.text = r.details
+        elif r.status == "skipped":
+            ElementTree.SubElement(case, "skipped",
+                                   {"message": "a suite it needs failed"})
+    ElementTree.ElementTree(root).write(path, encoding="utf-8",
+                                        xml_declaration=True)
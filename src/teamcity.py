@@ -1,12 +1,16 @@
-from getpass import getpass
+import hashlib
+import os
+import shutil
 from os import makedirs
-from os.path import join
+from os.path import join, isfile, getsize, getmtime
 from xml.etree import ElementTree
 
 import requests
 from requests.auth import HTTPBasicAuth
 
+import events
 import paths
+import vault
 from settings import get_secret
 
 
@@ -15,25 +19,45 @@ class TeamCityCredentialsException(Exception):
 
 
 class AuthProvider:
+    secret_path = "teamcity/deploy"
+
     def __init__(self):
         self.auth = None
 
     def get(self):
         if self.auth is None:
-            password = get_secret("teamcity/deploy", field="password")
+            password = get_secret(self.secret_path, field="password")
             self.auth = HTTPBasicAuth("deploy", password)
         return self.auth
 
     def clear(self):
+        """Drop the credentials, including the vault's cached copy, so
+        that they are read again"""
         self.auth = None
+        vault.client.forget("secret/" + self.secret_path)
+
+
+def get_with_auth(url, **kwargs):
+    """requests.get with the TeamCity credentials.  On a 401 the
+    credentials are read from the vault again and the request retried,
+    once; if they are still rejected, give up"""
+    r = requests.get(url, auth=auth.get(), **kwargs)
+    if r.status_code != 401:
+        return r
+    r.close()
+    events.info("- Bad credentials; reading them from the vault again")
+    auth.clear()
+    r = requests.get(url, auth=auth.get(), **kwargs)
+    if r.status_code == 401:
+        r.close()
+        raise TeamCityCredentialsException(
+            "TeamCity rejected the credentials in the vault at "
+            "secret/{} for {}".format(AuthProvider.secret_path, url))
+    return r
 
 
 def get_safely(url, as_text=True):
-    r = requests.get(url, auth=auth.get())
-    if r.status_code == 401:
-        print("- Bad credentials")
-        auth.clear()
-        return get_safely(url, as_text=as_text)
+    r = get_with_auth(url)
     if r.status_code != 200:
         raise Exception("Failed to retrieve artifact from TeamCity using url {url}\n".format(url=url) +
                         "Returned status code {code}.\n".format(code=r.status_code) +
@@ -45,28 +69,26 @@ def get_safely(url, as_text=True):
 
 
 def save_artifact(build_type: str, artifact_path: str, name: str, commit_hash=None):
-    makedirs(paths.artifacts, exist_ok=True)
-    local_path = join(paths.artifacts, name)
-    with open(local_path, 'wb') as f:
-        if commit_hash:
-            data = get_artifact(build_type, artifact_path, commit_hash)
-        else:
-            data = get_latest_artifact(build_type, artifact_path)
-        f.write(data)
-    return local_path
+    if commit_hash:
+        build_url = get_build_url(build_type, commit_hash)
+    else:
+        build_url = get_latest_build_url(build_type)
+    return cached_download(build_type, build_url, artifact_path, name)
 
 
 def get_locator(build_type):
     return "buildType:(id:{build_type}),status:SUCCESS,branch:default:any".format(build_type=build_type)
 
 
-def get_latest_artifact(build_type, artifact_path):
+def get_latest_build_url(build_type):
+    # Resolve 'latest' to a specific build so that it can be cached
     template = "{root_url}/builds/{locator}"
-    build_url = template.format(root_url=teamcity_api_url, locator=get_locator(build_type))
-    return download_artifact(build_url, artifact_path)
+    url = template.format(root_url=teamcity_api_url, locator=get_locator(build_type))
+    xml = ElementTree.fromstring(get_safely(url))
+    return teamcity_url + xml.get("href")
 
 
-def get_artifact(build_type, artifact_path, commit_hash):
+def get_build_url(build_type, commit_hash):
     fields = "build(id,href,revisions(revision))"
     locator = get_locator(build_type)
     template = "{root_url}/builds/?locator={locator}&fields={fields}"
@@ -76,14 +98,141 @@ def get_artifact(build_type, artifact_path, commit_hash):
     if build_url is None:
         raise Exception("Unable to find build of type '{build_type}' with commit hash '{hash}'"
                         .format(build_type=build_type, hash=commit_hash))
-    build_url = teamcity_url + build_url
-    return download_artifact(build_url, artifact_path)
+    return teamcity_url + build_url
+
+
+# Downloaded artifacts are kept in paths.artifacts/cache/<build
+# type>/<build id>/, along with a sha256 checksum of each, so that
+# redeploying the same build does not download them again.  When the
+# cache grows beyond cache_size_limit bytes the least recently used
+# builds are removed.
+cache_size_limit = 20 * 1024 ** 3
+download_attempts = 3
+# Seconds to wait for TeamCity to accept the connection or send more data
+download_timeout = 60
+
+
+def cached_download(build_type, build_url, artifact_path, name):
+    build_id = build_url.rstrip("/").split("/")[-1].replace(":", "_")
+    entry = join(paths.artifacts, "cache", build_type, build_id)
+    local_path = join(entry, name)
+    checksum_path = local_path + ".sha256"
+
+    if isfile(local_path) and isfile(checksum_path):
+        with open(checksum_path, 'r') as f:
+            expected = f.read().strip()
+        if sha256_file(local_path) == expected:
+            events.info("- Using cached copy of {} from build {}".format(artifact_path, build_id))
+            os.utime(entry)
+            return local_path
+        events.info("- Cached copy of {} is corrupt; downloading again".format(artifact_path))
+        os.remove(local_path)
+
+    makedirs(entry, exist_ok=True)
+    url = "{build_url}/artifacts/content/{artifact_path}".format(
+        build_url=build_url, artifact_path=artifact_path)
+    partial_path = local_path + ".part"
+    for attempt in range(1, download_attempts + 1):
+        try:
+            total = download_safely(url, partial_path)
+            check_size(partial_path, total)
+            break
+        except (requests.exceptions.RequestException, IncompleteDownloadException) as e:
+            if attempt == download_attempts:
+                raise
+            events.info("- Download interrupted ({}); resuming".format(e))
+
+    checksum = sha256_file(partial_path)
+    os.replace(partial_path, local_path)
+    with open(checksum_path, 'w') as f:
+        f.write(checksum + "\n")
+    os.utime(entry)
+    prune_cache(keep=entry)
+    return local_path
+
+
+class IncompleteDownloadException(Exception):
+    pass
+
+
+def download_safely(url, path, chunk_size=1024 * 1024):
+    """Stream url into path, resuming from whatever is already in path.
+    Returns the size of the whole artifact, if TeamCity said what it
+    is"""
+    existing = getsize(path) if isfile(path) else 0
+    headers = {"Range": "bytes={}-".format(existing)} if existing else {}
+    with get_with_auth(url, headers=headers, stream=True,
+                       timeout=download_timeout) as r:
+        if r.status_code == 416:
+            # Nothing left to fetch, if what we have is the whole thing
+            total = content_range_total(r.headers.get("Content-Range"))
+            if total == existing:
+                return total
+            os.remove(path)
+            return download_safely(url, path, chunk_size)
+        if r.status_code == 206:
+            mode = 'ab'
+            total = content_range_total(r.headers.get("Content-Range"))
+        elif r.status_code == 200:
+            # The server ignored our range, so start again
+            mode = 'wb'
+            length = r.headers.get("Content-Length")
+            total = int(length) if length else None
+        else:
+            raise Exception("Failed to retrieve artifact from TeamCity using url {url}\n".format(url=url) +
+                            "Returned status code {code}.\n".format(code=r.status_code) +
+                            "Full response text: " + r.text)
+        with open(path, mode) as f:
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                f.write(chunk)
+    return total
+
+
+def check_size(path, total):
+    """Fail unless path holds all total bytes; a download that is short
+    (or has grown past the end) must not be put in the cache"""
+    actual = getsize(path)
+    if total is not None and actual != total:
+        if actual > total:
+            os.remove(path)
+        raise IncompleteDownloadException(
+            "received {} of {} bytes".format(actual, total))
+
+
+def content_range_total(header):
+    # e.g. "bytes 100-199/200" or "bytes */200"
+    if header and "/" in header:
+        total = header.rsplit("/", 1)[1]
+        if total.isdigit():
+            return int(total)
+    return None
 
 
-def download_artifact(build_url, artifact_path):
-    template = "{build_url}/artifacts/content/{artifact_path}"
-    url = template.format(build_url=build_url, artifact_path=artifact_path)
-    return get_safely(url, as_text=False)
+def sha256_file(path, chunk_size=1024 * 1024):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def prune_cache(keep, limit=None):
+    limit = cache_size_limit if limit is None else limit
+    root = join(paths.artifacts, "cache")
+    entries = []
+    for build_type in os.listdir(root):
+        for build_id in os.listdir(join(root, build_type)):
+            entry = join(root, build_type, build_id)
+            size = sum(getsize(join(entry, f)) for f in os.listdir(entry))
+            entries.append((getmtime(entry), entry, size))
+    total = sum(size for _, _, size in entries)
+    for _, entry, size in sorted(entries):
+        if total <= limit:
+            break
+        if entry != keep:
+            events.info("- Removing cached artifacts in " + entry)
+            shutil.rmtree(entry)
+            total -= size
 
 
 def find_url_of_matching_build(xml_text, branch_or_hash):
@@ -4,15 +4,20 @@
 Run integration tests on a deployed Montagu instance
 
 Usage:
-  test.py --run-tests [--simulate-restart]
+  test.py --run-tests [--simulate-restart] [--workers=<n>] [--junit=<path>]
 
 Options:
   --run-tests         Required. This is included to prevent accidentally
                       running the tests in a live environment.
   --simulate-restart  Restart the Docker daemon before running the tests,
                       to simulate recovery from a system reboot.
+  --workers=<n>       Number of test suites to run at once [default: 4]
+  --junit=<path>      Where to write JUnit XML results
+                      [default: test-results.xml]
 """
 
+from functools import lru_cache
+from os.path import abspath, dirname, join
 from subprocess import run
 from docopt import docopt
 
@@ -21,76 +26,86 @@ import os
 import celery
 import requests
 
+import events
+import timing
 import versions
 from docker_helpers import get_image_name, pull
+from settings import default_path, load_settings
+from suites import Suite, run_suites, write_junit
 
 
-def run_in_teamcity_block(name, work):
-    print("##teamcity[blockOpened name='{name}']".format(name=name))
-    try:
-        work()
-    finally:
-        print("##teamcity[blockClosed name='{name}']".format(name=name))
+@lru_cache()
+def docker_prefix():
+    """The prefix that the deploy gave Montagu's containers, volumes and
+    network (see MontaguService)"""
+    path = join(dirname(abspath(__file__)), default_path)
+    return load_settings(path).get("docker_prefix", "montagu")
 
 
-def api_blackbox_tests():
-    def work():
-        image = get_image_name("montagu-api-blackbox-tests", versions.api)
-        pull(image)
-        run([
-            "docker", "run",
-            "--rm",
-            "--network", "montagu_default",
-            "-v", "montagu_emails:/tmp/montagu_emails",
-            image
-        ], check=True)
-
-    run_in_teamcity_block("api_blackbox_tests", work)
+def docker_name(name):
+    return "{}_{}".format(docker_prefix(), name)
 
 
-def webapp_integration_tests():
-    def run_suite(portal, version):
-        image = "vimc/montagu-portal-integration-tests:{version}".format(
-            version=version)
-        pull(image)
-        run([
-            "docker", "run",
-            "--rm",
-            "--network", "montagu_default",
-            "-v",
-            "/opt/teamcity-agent/.docker/config.json:/root/.docker/config.json",
-            "-v", "/var/run/docker.sock:/var/run/docker.sock",
-            image,
-            portal.title()
-            # Tests expect capitalized first letter, e.g. "Admin"
-        ], check=True)
+def teamcity_blocks(event):
+    """Subscriber (see events) that wraps each suite in a TeamCity block;
+    flowId lets TeamCity untangle blocks from suites running at once"""
+    if event.get("parent") != "tests":
+        return
+    if event["type"] == "phase_started":
+        message = "blockOpened"
+    elif event["type"] == "phase_finished":
+        message = "blockClosed"
+    else:
+        return
+    print("##teamcity[{message} name='{name}' flowId='{name}']".format(
+        message=message, name=event["phase"]), flush=True)
 
-    def work():
-        run_suite("admin", versions.admin_portal)
-        run_suite("contrib", versions.contrib_portal)
 
-    run_in_teamcity_block("webapp_integration_tests", work)
+def api_blackbox_tests():
+    image = get_image_name("montagu-api-blackbox-tests", versions.api)
+    pull(image)
+    run([
+        "docker", "run",
+        "--rm",
+        "--network", docker_name("default"),
+        "-v", docker_name("emails") + ":/tmp/montagu_emails",
+        image
+    ], check=True)
+
+
+def webapp_integration_tests(portal, version):
+    image = "vimc/montagu-portal-integration-tests:{version}".format(
+        version=version)
+    pull(image)
+    run([
+        "docker", "run",
+        "--rm",
+        "--network", docker_name("default"),
+        "-v",
+        "/opt/teamcity-agent/.docker/config.json:/root/.docker/config.json",
+        "-v", "/var/run/docker.sock:/var/run/docker.sock",
+        image,
+        portal.title()
+        # Tests expect capitalized first letter, e.g. "Admin"
+    ], check=True)
 
 
 def task_queue_integration_tests():
-    def work():
-        print("Running task queue integration tests")
-        app = celery.Celery(broker="pyamqp://guest@localhost//",
-                            backend="rpc://")
-        sig = "run-diagnostic-reports"
-        args = ["testGroup", "testDisease", "testTouchstone"]
-        signature = app.signature(sig, args)
-        versions = signature.delay().get()
-        assert len(versions) == 1
-        # check expected notification email was sent to fake smtp server
-        emails = requests.get("http://localhost:1080/api/emails").json()
-        assert len(emails) == 1
-        s = "VIMC diagnostic report: testTouchstone - testGroup - testDisease"
-        assert emails[0]["subject"] == s
-        assert emails[0]["to"]["value"][0][
-                   "address"] == "minimal_modeller@example.com"
-
-    run_in_teamcity_block("task_queue_integration_tests", work)
+    print("Running task queue integration tests")
+    app = celery.Celery(broker="pyamqp://guest@localhost//",
+                        backend="rpc://")
+    sig = "run-diagnostic-reports"
+    args = ["testGroup", "testDisease", "testTouchstone"]
+    signature = app.signature(sig, args)
+    versions = signature.delay().get()
+    assert len(versions) == 1
+    # check expected notification email was sent to fake smtp server
+    emails = requests.get("http://localhost:1080/api/emails").json()
+    assert len(emails) == 1
+    s = "VIMC diagnostic report: testTouchstone - testGroup - testDisease"
+    assert emails[0]["subject"] == s
+    assert emails[0]["to"]["value"][0][
+               "address"] == "minimal_modeller@example.com"
 
 
 def start_orderly_web():
@@ -104,76 +119,105 @@ def start_orderly_web():
         run(["docker", "run", "-v", "orderly_volume:/orderly",
              image, "grant", email] + permissions, check=True)
 
-    def work():
-        cwd = os.getcwd()
-
-        run(["docker", "volume", "create", "orderly_volume"], check=True)
-
-        orderly_image = get_image_name("orderly.server", "master")
-        pull(orderly_image)
-        run([
-            "docker", "run", "-d",
-            "-p", "8321:8321",
-            "--network", "montagu_default",
-            "-v", "orderly_volume:/orderly",
-            "-w", "/orderly",
-            "--name", "montagu_orderly_orderly_1",
-            orderly_image,
-            "--port", "8321", "--go-signal", "/go_signal", "/orderly"
-        ], check=True)
-
-        run(["docker", "exec", "montagu_orderly_orderly_1", "Rscript", "-e",
-             "orderly:::create_orderly_demo('/orderly')"], check=True)
-
-        run(["docker", "exec", "montagu_orderly_orderly_1", "orderly",
-             "rebuild", "--if-schema-changed"], check=True)
-
-        run(["docker", "exec", "montagu_orderly_orderly_1", "touch",
-             "/go_signal"],
-            check=True)
-
-        ow_image = get_image_name("orderly-web", "master")
-        pull(ow_image)
-        run([
-            "docker", "run", "-d",
-            "-p", "8888:8888",
-            "--network", "montagu_default",
-            "-v", "orderly_volume:/orderly",
-            "-v", cwd + "/container_config/orderlyweb:/etc/orderly/web",
-            "--name", "montagu_orderly_web_1",
-            ow_image
-        ], check=True)
-
-        run(["docker", "exec", "montagu_orderly_web_1", "touch",
-             "/etc/orderly/web/go_signal"],
-            check=True)
-
-        ow_migrate_image = get_image_name("orderlyweb-migrate", "master")
-        pull(ow_migrate_image)
-        run([
-            "docker", "run", "--rm",
-            "-v", "orderly_volume:/orderly",
-            ow_migrate_image
-        ], check=True)
-
-        ow_cli_image = get_image_name("orderly-web-user-cli", "master")
-        pull(ow_cli_image)
-
-        # user for api blackbox tests
-        add_user("user@test.com", ow_cli_image)
-        grant_permissions("user@test.com", ow_cli_image, ["*/users.manage"])
-
-        # add task q user
-        add_user("montagu-task@imperial.ac.uk", ow_cli_image)
-        grant_permissions("montagu-task@imperial.ac.uk", ow_cli_image,
-                          ["*/reports.run", "*/reports.review", "*/reports.read"])
-
-        # user for webapp tests
-        add_user("test.user@example.com", ow_cli_image)
-        grant_permissions("test.user@example.com", ow_cli_image, ["*/users.manage"])
-
-
-    run_in_teamcity_block("start_orderly_web", work)
+    cwd = os.getcwd()
+    # Named for the project, but container_config/orderlyweb and the
+    # orderly_web_api_url setting address them by their original names,
+    # which are kept as aliases on the project's own network
+    orderly_container = docker_name("orderly_orderly_1")
+    orderly_web_container = docker_name("orderly_web_1")
+
+    run(["docker", "volume", "create", "orderly_volume"], check=True)
+
+    orderly_image = get_image_name("orderly.server", "master")
+    pull(orderly_image)
+    run([
+        "docker", "run", "-d",
+        "-p", "8321:8321",
+        "--network", docker_name("default"),
+        "-v", "orderly_volume:/orderly",
+        "-w", "/orderly",
+        "--name", orderly_container,
+        "--network-alias", "montagu_orderly_orderly_1",
+        orderly_image,
+        "--port", "8321", "--go-signal", "/go_signal", "/orderly"
+    ], check=True)
+
+    run(["docker", "exec", orderly_container, "Rscript", "-e",
+         "orderly:::create_orderly_demo('/orderly')"], check=True)
+
+    run(["docker", "exec", orderly_container, "orderly",
+         "rebuild", "--if-schema-changed"], check=True)
+
+    run(["docker", "exec", orderly_container, "touch",
+         "/go_signal"],
+        check=True)
+
+    ow_image = get_image_name("orderly-web", "master")
+    pull(ow_image)
+    run([
+        "docker", "run", "-d",
+        "-p", "8888:8888",
+        "--network", docker_name("default"),
+        "-v", "orderly_volume:/orderly",
+        "-v", cwd + "/container_config/orderlyweb:/etc/orderly/web",
+        "--name", orderly_web_container,
+        "--network-alias", "montagu_orderly_web_1",
+        ow_image
+    ], check=True)
+
+    run(["docker", "exec", orderly_web_container, "touch",
+         "/etc/orderly/web/go_signal"],
+        check=True)
+
+    ow_migrate_image = get_image_name("orderlyweb-migrate", "master")
+    pull(ow_migrate_image)
+    run([
+        "docker", "run", "--rm",
+        "-v", "orderly_volume:/orderly",
+        ow_migrate_image
+    ], check=True)
+
+    ow_cli_image = get_image_name("orderly-web-user-cli", "master")
+    pull(ow_cli_image)
+
+    # user for api blackbox tests
+    add_user("user@test.com", ow_cli_image)
+    grant_permissions("user@test.com", ow_cli_image, ["*/users.manage"])
+
+    # add task q user
+    add_user("montagu-task@imperial.ac.uk", ow_cli_image)
+    grant_permissions("montagu-task@imperial.ac.uk", ow_cli_image,
+                      ["*/reports.run", "*/reports.review", "*/reports.read"])
+
+    # user for webapp tests
+    add_user("test.user@example.com", ow_cli_image)
+    grant_permissions("test.user@example.com", ow_cli_image, ["*/users.manage"])
+
+
+def get_suites():
+    orderly_web = ["start_orderly_web"]
+    # Shared resources; every suite that reads or writes one lists it:
+    # * montagu_emails - the API writes its emails (e.g. password resets)
+    #   to this volume, and the blackbox tests read them back
+    # * fake_smtp - the task queue's mailbox, which the task queue tests
+    #   expect to hold exactly one email; uploading burden estimates
+    #   (blackbox and contrib tests) also runs diagnostic reports, which
+    #   send email there
+    return [
+        Suite("start_orderly_web", start_orderly_web),
+        Suite("api_blackbox_tests", api_blackbox_tests, orderly_web,
+              ["montagu_emails", "fake_smtp"]),
+        Suite("admin_integration_tests",
+              lambda: webapp_integration_tests("admin",
+                                               versions.admin_portal),
+              orderly_web, ["montagu_emails"]),
+        Suite("contrib_integration_tests",
+              lambda: webapp_integration_tests("contrib",
+                                               versions.contrib_portal),
+              orderly_web, ["montagu_emails", "fake_smtp"]),
+        Suite("task_queue_integration_tests", task_queue_integration_tests,
+              orderly_web, ["fake_smtp"])
+    ]
 
 
 if __name__ == "__main__":
@@ -183,10 +227,14 @@ if __name__ == "__main__":
             # Imitate a reboot of the system
             print("Restarting Docker", flush=True)
             run(["sudo", "/bin/systemctl", "restart", "docker"], check=True)
-        start_orderly_web()
-        api_blackbox_tests()
-        webapp_integration_tests()
-        task_queue_integration_tests()
+        events.subscribe(teamcity_blocks)
+        results = run_suites(get_suites(), int(args["--workers"]))
+        write_junit(results, args["--junit"])
+        print("##teamcity[importData type='junit' path='{}']".format(
+            args["--junit"]))
+        timing.print_summary()
+        if any(r.status != "passed" for r in results):
+            exit(1)
     else:
         print(
             "Warning - these tests should not be run in a real environment. They will destroy or change data.")
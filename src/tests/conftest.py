@@ -0,0 +1,8 @@
+import sys
+from os.path import abspath, dirname, join
+
+# The deploy modules are imported as top level modules, as they are when
+# run from src/, and so are the release scripts, from scripts/release/
+src = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, src)
+sys.path.insert(1, join(dirname(src), "scripts", "release"))
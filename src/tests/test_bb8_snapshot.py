@@ -0,0 +1,47 @@
+import bb8_snapshot
+
+status = """
+orderly
+  Last backup: 2019-03-01 02:00:05
+  Previous backup: 2019-02-28 02:00:04
+main_db_restore
+  Last backup: 2019-03-01T02:10:41.123
+"""
+
+
+def test_generation_is_the_latest_backup_of_each_target():
+    assert bb8_snapshot.parse_generation(status) == \
+        "main_db_restore=2019-03-01T02:10:41.123,orderly=2019-03-01T02:00:05"
+
+
+def test_generation_changes_with_a_new_backup():
+    newer = status.replace("2019-03-01T02:10:41.123", "2019-03-02T02:10:39")
+    assert bb8_snapshot.parse_generation(newer) != \
+        bb8_snapshot.parse_generation(status)
+
+
+def test_no_generation_unless_every_target_has_a_backup():
+    assert bb8_snapshot.parse_generation("") is None
+    assert bb8_snapshot.parse_generation(
+        "orderly\n  Last backup: 2019-03-01 02:00:05\n") is None
+    assert bb8_snapshot.parse_generation(
+        "orderly: ok\nmain_db_restore: ok\n") is None
+
+
+def test_remote_generation_sets_up_bb8_first(monkeypatch):
+    calls = []
+    monkeypatch.setattr(bb8_snapshot.bb8_backup, "finished_setup", False)
+    monkeypatch.setattr(bb8_snapshot.bb8_backup, "setup",
+                        lambda: calls.append("setup"))
+
+    class Result:
+        returncode = 0
+        stdout = status
+
+    def run(args, **kwargs):
+        calls.append(args)
+        return Result()
+
+    monkeypatch.setattr(bb8_snapshot, "run", run)
+    assert bb8_snapshot.remote_generation() is not None
+    assert calls == ["setup", ["bb8", "status"]]
@@ -0,0 +1,148 @@
+import blue_green
+
+settings = {"blue_green": True}
+
+
+def test_blue_green_only_when_running_with_data_to_keep():
+    assert blue_green.can_deploy(settings, "running", True, False)
+    assert not blue_green.can_deploy({"blue_green": False}, "running",
+                                     True, False)
+    assert not blue_green.can_deploy(settings, "stopped", True, False)
+    assert not blue_green.can_deploy(settings, "running", False, False)
+    assert not blue_green.can_deploy(settings, "running", True, True)
+
+
+class FakeContainer:
+    def __init__(self, name, networks):
+        self.name = name
+        self.attrs = {"NetworkSettings": {
+            "Networks": dict((n, {}) for n in networks)}}
+
+    def reload(self):
+        pass
+
+
+class FakeNetwork:
+    def __init__(self, name, log):
+        self.name = name
+        self.log = log
+
+    def connect(self, container):
+        self.log.append(("connect", self.name, container.name))
+        container.attrs["NetworkSettings"]["Networks"][self.name] = {}
+
+    def disconnect(self, container):
+        self.log.append(("disconnect", self.name, container.name))
+        del container.attrs["NetworkSettings"]["Networks"][self.name]
+
+
+class FakeNetworks:
+    def __init__(self, log):
+        self.log = log
+
+    def get(self, name):
+        return FakeNetwork(name, self.log)
+
+
+class FakeClient:
+    def __init__(self, log):
+        self.networks = FakeNetworks(log)
+
+
+class FakeService:
+    def __init__(self, colour, client, proxy, own):
+        self.colour = colour
+        self.client = client
+        self.proxy = proxy
+        self.network_name = "montagu_default" if colour == "blue" \
+            else "montagu-green_default"
+        self.own = own
+
+    def own_containers(self):
+        return self.own
+
+
+def fake_services(proxy_networks):
+    log = []
+    client = FakeClient(log)
+    proxy = FakeContainer("montagu_proxy_1", proxy_networks)
+    blue = FakeService("blue", client, proxy, [
+        FakeContainer("montagu_api_1", ["montagu_default"])])
+    green = FakeService("green", client, proxy, [
+        FakeContainer("montagu-green_api_1", ["montagu-green_default"])])
+    return log, proxy, blue, green
+
+
+def record_reloads(monkeypatch, log):
+    def exec_safely(container, cmd, check=False):
+        log.append(("exec", container.name, " ".join(cmd)))
+    monkeypatch.setattr(blue_green, "exec_safely", exec_safely)
+
+
+def test_switch_to_green_hides_blue_from_the_proxy(monkeypatch):
+    log, proxy, blue, green = fake_services(["montagu_default"])
+    record_reloads(monkeypatch, log)
+    blue_green.switch(blue, green)
+    assert log == [
+        ("connect", "montagu-green_default", "montagu_proxy_1"),
+        ("disconnect", "montagu_default", "montagu_api_1"),
+        ("exec", "montagu_proxy_1", "nginx -s reload")]
+    # The proxy keeps its own network, for the shared components
+    assert set(proxy.attrs["NetworkSettings"]["Networks"]) == \
+        {"montagu_default", "montagu-green_default"}
+
+
+def test_switch_to_blue_takes_the_proxy_off_green(monkeypatch):
+    log, proxy, blue, green = fake_services(
+        ["montagu_default", "montagu-green_default"])
+    record_reloads(monkeypatch, log)
+    blue_green.switch(green, blue)
+    assert log == [
+        ("disconnect", "montagu-green_default", "montagu_proxy_1"),
+        ("exec", "montagu_proxy_1", "nginx -s reload")]
+
+
+def test_switch_can_be_run_again(monkeypatch):
+    log, proxy, blue, green = fake_services(["montagu_default"])
+    record_reloads(monkeypatch, log)
+    blue_green.switch(blue, green)
+    del log[:]
+    blue_green.switch(blue, green)
+    assert log == [("exec", "montagu_proxy_1", "nginx -s reload")]
+
+
+class FakeJournal:
+    def run(self, name, action, inputs=None):
+        return action()
+
+
+def test_deploy_switches_only_once_the_new_colour_is_configured(monkeypatch):
+    log = []
+
+    class Colour:
+        def __init__(self, colour):
+            self.colour = colour
+            self.live = True
+
+        def other_colour(self):
+            return target
+
+        def start(self):
+            log.append(("start", self.colour, self.live))
+
+        def remove_colour(self):
+            log.append(("remove", self.colour))
+
+    live, target = Colour("blue"), Colour("green")
+    monkeypatch.setattr(blue_green, "switch", lambda old, new: log.append(
+        ("switch", old.colour, new.colour)))
+
+    def configure(service):
+        log.append(("configure", service.colour, service.live))
+
+    result = blue_green.deploy(live, configure, FakeJournal())
+    assert result is target and target.live
+    assert log == [("start", "green", False),
+                   ("configure", "green", False),
+                   ("switch", "blue", "green"),
+                   ("remove", "blue")]
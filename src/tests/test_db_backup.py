@@ -0,0 +1,138 @@
+import docker
+import pytest
+
+import db_backup
+
+
+class FakeContainer:
+    def __init__(self, name, status="running", image="montagu-db:new"):
+        self.name = name
+        self.status = status
+        self.attrs = {"Config": {"Image": image}}
+        self.removed = False
+
+    def remove(self, force=False):
+        self.removed = True
+
+
+class FakeContainers:
+    def __init__(self, existing):
+        self.existing = dict((c.name, c) for c in existing)
+        self.started = []
+
+    def get(self, name):
+        if name not in self.existing:
+            raise docker.errors.NotFound(name)
+        return self.existing[name]
+
+    def run(self, image, **kwargs):
+        self.started.append(dict(kwargs, image=image))
+
+
+class FakeClient:
+    def __init__(self, existing):
+        self.containers = FakeContainers(existing)
+
+
+class FakeService:
+    project = "montagu"
+    shared_network_name = "montagu_default"
+
+    def __init__(self, existing=()):
+        self.client = FakeClient(existing)
+        self.db = FakeContainer("montagu_db_1")
+
+    def container_name(self, name):
+        return "montagu_{}_1".format(name)
+
+
+@pytest.fixture
+def backups(monkeypatch, tmpdir):
+    """Records the SQL run, and the base backups taken, by configure"""
+    log = {"sql": [], "base_backups": 0, "slot": True}
+
+    def psql(container, sql, database="postgres"):
+        log["sql"].append(sql)
+        if sql == db_backup.slot_query():
+            return "1" if log["slot"] else "0"
+        return ""
+
+    def base_backup(service):
+        log["base_backups"] += 1
+
+    monkeypatch.setattr(db_backup, "psql", psql)
+    monkeypatch.setattr(db_backup, "base_backup", base_backup)
+    monkeypatch.setattr(db_backup, "db_image", lambda: "montagu-db:new")
+    monkeypatch.setattr(db_backup, "replication_password", lambda s: "pw")
+    monkeypatch.setattr(db_backup, "list_base_backups", lambda: ["1"])
+    monkeypatch.setattr(db_backup, "path_wal", str(tmpdir.join("wal")))
+    return log
+
+
+def test_archiver_command_uses_the_slot_without_creating_it():
+    assert db_backup.archiver_command("montagu_db_1") == [
+        "-h", "montagu_db_1", "-U", "streaming_barman",
+        "--slot", "montagu_backup", "-D", "/backup/wal", "--no-loop"]
+
+
+def test_slot_sql():
+    assert db_backup.slot_query() == \
+        "SELECT count(*) FROM pg_replication_slots " \
+        "WHERE slot_name = 'montagu_backup'"
+    assert db_backup.slot_query(active=True).endswith(" AND active")
+    assert db_backup.create_slot_sql() == \
+        "SELECT pg_create_physical_replication_slot('montagu_backup', true)"
+    assert db_backup.drop_slot_sql() == \
+        "SELECT pg_drop_replication_slot('montagu_backup')"
+
+
+def test_configure_leaves_a_running_archiver_and_its_slot_alone(backups):
+    archiver = FakeContainer("montagu_wal_archiver_1")
+    service = FakeService([archiver])
+    db_backup.configure(service)
+    assert backups["sql"] == [db_backup.slot_query()]
+    assert not archiver.removed
+    assert service.client.containers.started == []
+    assert backups["base_backups"] == 0
+
+
+def test_configure_restarts_an_archiver_with_an_old_image(backups):
+    archiver = FakeContainer("montagu_wal_archiver_1", image="montagu-db:old")
+    service = FakeService([archiver])
+    db_backup.configure(service)
+    assert archiver.removed
+    started, = service.client.containers.started
+    assert started["image"] == "montagu-db:new"
+    assert started["name"] == "montagu_wal_archiver_1"
+    assert started["entrypoint"] == ["pg_receivewal"]
+    assert started["command"] == db_backup.archiver_command("montagu_db_1")
+    assert started["network"] == "montagu_default"
+    # The slot is still there, so the archive has no gap
+    assert backups["base_backups"] == 0
+
+
+def test_configure_takes_a_base_backup_when_the_slot_is_new(backups):
+    backups["slot"] = False
+    archiver = FakeContainer("montagu_wal_archiver_1", status="restarting")
+    service = FakeService([archiver])
+    db_backup.configure(service)
+    assert backups["sql"] == [db_backup.slot_query(),
+                              db_backup.create_slot_sql()]
+    assert len(service.client.containers.started) == 1
+    assert backups["base_backups"] == 1
+
+
+def test_stop_archiving_keeps_the_slot(backups):
+    archiver = FakeContainer("montagu_wal_archiver_1")
+    db_backup.stop_archiving(FakeService([archiver]))
+    assert archiver.removed
+    assert backups["sql"] == []
+
+
+def test_enabled():
+    assert db_backup.enabled({"db_backup": True,
+                              "enable_db_replication": True})
+    assert not db_backup.enabled({"db_backup": True,
+                                  "enable_db_replication": False})
+    assert not db_backup.enabled({"db_backup": False,
+                                  "enable_db_replication": True})
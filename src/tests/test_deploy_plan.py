@@ -0,0 +1,53 @@
+import deploy_plan
+
+settings = {
+    "persist_data": True,
+    "initial_data_source": "minimal",
+    "update_on_deploy": False,
+    "bb8_backup": False
+}
+inputs = {
+    "versions": {"api": "abc1234", "db": "def5678"},
+    "certificate": "cert",
+    "static_files": "static",
+    "guidance_reports": "guidance",
+    "task_queue_config": "task_queue"
+}
+
+
+def use_last_deploy(monkeypatch, last_inputs, last_settings=None):
+    last_settings = last_settings or {"x": 1}
+    monkeypatch.setattr(deploy_plan, "last_deploy_read", lambda: {
+        "time": "then", "inputs": last_inputs, "settings": last_settings})
+    monkeypatch.setattr(deploy_plan, "load_settings", lambda: {"x": 1})
+
+
+def test_full_deploy_if_not_running(monkeypatch):
+    use_last_deploy(monkeypatch, inputs)
+    plan = deploy_plan.make_plan(settings, "stopped", inputs)
+    assert plan.full
+
+
+def test_nothing_to_do_if_nothing_changed(monkeypatch):
+    use_last_deploy(monkeypatch, inputs)
+    plan = deploy_plan.make_plan(settings, "running", inputs)
+    assert not plan.full
+    assert plan.services == []
+    assert plan.steps == []
+
+
+def test_changed_version_restarts_service(monkeypatch):
+    previous = dict(inputs, versions={"api": "0000000", "db": "def5678"})
+    use_last_deploy(monkeypatch, previous)
+    plan = deploy_plan.make_plan(settings, "running", inputs)
+    assert not plan.full
+    assert plan.services == ["api"]
+    assert plan.steps == ["configure_api", "configure_static_server"]
+
+
+def test_full_deploy_without_persist_data(monkeypatch):
+    use_last_deploy(monkeypatch, inputs)
+    plan = deploy_plan.make_plan(dict(settings, persist_data=False),
+                                 "running", inputs)
+    assert plan.full
+    assert "persist_data" in plan.reason
@@ -0,0 +1,50 @@
+import docker
+
+import docker_helpers
+
+
+class FakeImage:
+    def __init__(self, attrs=None, id=None):
+        self.attrs = attrs or {}
+        self.id = id
+
+
+class FakeImages:
+    def __init__(self, local_digest, remote_digest):
+        self.local_digest = local_digest
+        self.remote_digest = remote_digest
+        self.calls = []
+
+    def get(self, image):
+        self.calls.append(("get", image))
+        if self.local_digest is None:
+            raise docker.errors.ImageNotFound(image)
+        return FakeImage({"RepoDigests": [
+            "vimc/api@" + self.local_digest]})
+
+    def get_registry_data(self, image):
+        self.calls.append(("get_registry_data", image))
+        return FakeImage(id=self.remote_digest)
+
+
+class FakeClient:
+    def __init__(self, local_digest, remote_digest):
+        self.images = FakeImages(local_digest, remote_digest)
+
+
+def test_image_is_current_compares_digests_with_the_given_client():
+    assert docker_helpers.image_is_current(
+        "vimc/api:master", FakeClient("sha256:a", "sha256:a"))
+    assert not docker_helpers.image_is_current(
+        "vimc/api:master", FakeClient("sha256:a", "sha256:b"))
+    assert not docker_helpers.image_is_current(
+        "vimc/api:master", FakeClient(None, "sha256:b"))
+
+
+def test_pull_images_shares_one_client(monkeypatch):
+    client = FakeClient("sha256:a", "sha256:a")
+    monkeypatch.setattr(docker_helpers, "pulled_images", set())
+    docker_helpers.pull_images(["vimc/a:1", "vimc/b:1", "vimc/a:1"], client)
+    assert sorted(client.images.calls) == [
+        ("get", "vimc/a:1"), ("get", "vimc/b:1"),
+        ("get_registry_data", "vimc/a:1"), ("get_registry_data", "vimc/b:1")]
@@ -0,0 +1,119 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+from notify import Notifier
+
+
+class FakeSlack:
+    """A stand-in for a slack webhook, answering with the given status
+    codes in turn (and then 200)"""
+    def __init__(self, statuses=()):
+        self.statuses = list(statuses)
+        self.received = []
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                fake.received.append(json.loads(body.decode("utf-8")))
+                status = fake.statuses.pop(0) if fake.statuses else 200
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:{}/hook".format(
+            self.server.server_address[1])
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+
+    def texts(self):
+        return [x["text"] for x in self.received]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def slack():
+    servers = []
+
+    def make(statuses=()):
+        server = FakeSlack(statuses)
+        servers.append(server)
+        notifier = Notifier("montagu", server.url)
+        notifier.coalesce_window = 0.05
+        notifier.backoff = 0
+        return server, notifier
+
+    yield make
+    for server in servers:
+        server.close()
+
+
+def test_messages_that_arrive_together_are_sent_together(slack):
+    server, notifier = slack()
+    notifier.post("one")
+    notifier.post("two")
+    assert notifier.flush(5)
+    assert server.texts() == ["one\ntwo"]
+    assert server.received[0]["channel"] == "#montagu"
+
+
+def test_server_errors_are_retried(slack):
+    server, notifier = slack([500, 429])
+    notifier.post("deploying")
+    assert notifier.flush(5)
+    assert server.texts() == ["deploying"] * 3
+    assert notifier.enabled
+
+
+def test_gives_up_after_a_client_error(slack):
+    server, notifier = slack([404])
+    notifier.post("deploying")
+    assert notifier.flush(5)
+    assert not notifier.enabled
+    # Later messages are dropped, but still don't hold up a flush
+    notifier.post("finished")
+    assert notifier.flush(5)
+    assert server.texts() == ["deploying"]
+
+
+def test_gives_up_once_the_retries_are_used(slack):
+    server, notifier = slack([500, 500, 500])
+    notifier.post("deploying")
+    assert notifier.flush(5)
+    assert len(server.received) == notifier.attempts
+    assert not notifier.enabled
+
+
+def test_worker_survives_a_failed_send(slack, monkeypatch):
+    server, notifier = slack()
+    send = notifier._send
+    failures = ["boom"]
+
+    def flaky_send(message):
+        if failures:
+            raise Exception(failures.pop())
+        send(message)
+
+    monkeypatch.setattr(notifier, "_send", flaky_send)
+    notifier.post("lost")
+    assert notifier.flush(5)
+    notifier.post("sent")
+    assert notifier.flush(5)
+    assert server.texts() == ["sent"]
+
+
+def test_disabled_without_a_channel():
+    notifier = Notifier("", "http://127.0.0.1:1/unused")
+    notifier.post("ignored")
+    assert notifier.worker is None
+    assert notifier.flush(1)
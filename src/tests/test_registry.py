@@ -0,0 +1,228 @@
+import base64
+import hashlib
+import importlib.util
+import json
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os.path import abspath, dirname, join
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+import registry
+
+# Not importable by name, because of the hyphen
+spec = importlib.util.spec_from_file_location("tag_images", join(
+    dirname(abspath(__file__)), "..", "..", "scripts", "release",
+    "tag-images.py"))
+tag_images = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(tag_images)
+
+
+def digest_of(data):
+    return "sha256:" + hashlib.sha256(data).hexdigest()
+
+
+class FakeRegistry:
+    """A stand-in for a registry's HTTP API: blobs, cross-repository
+    mounts, uploads and manifests, optionally behind basic auth"""
+    def __init__(self, password=None):
+        self.password = password
+        self.blobs = {}
+        self.repos = {}
+        self.manifests = {}
+        self.log = []
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_request(self):
+                fake.handle(self)
+
+            do_GET = do_HEAD = do_PUT = do_POST = do_DELETE = do_request
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:{}".format(self.server.server_port)
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def add_blob(self, repo, data):
+        digest = digest_of(data)
+        self.blobs[digest] = data
+        self.repos.setdefault(repo, set()).add(digest)
+        return digest
+
+    def handle(self, request):
+        url = urlparse(request.path)
+        query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        self.log.append((request.command, url.path, query))
+        if self.password:
+            expected = "Basic " + base64.b64encode(
+                ("user:" + self.password).encode()).decode()
+            if request.headers.get("Authorization") != expected:
+                return self.respond(request, 401, headers={
+                    "WWW-Authenticate": 'Basic realm="fake"'})
+        body = read_body(request)
+        parts = url.path[len("/v2/"):].split("/")
+        if "uploads" in parts:
+            name = "/".join(parts[:parts.index("blobs")])
+            return self.handle_upload(request, name, query, body)
+        kind = parts[-2]
+        name = "/".join(parts[:-2])
+        reference = parts[-1]
+        if kind == "manifests":
+            if request.command == "PUT":
+                self.manifests[(name, reference)] = \
+                    (body, request.headers["Content-Type"])
+                return self.respond(request, 201)
+            if (name, reference) not in self.manifests:
+                return self.respond(request, 404)
+            data, media_type = self.manifests[(name, reference)]
+            return self.respond(request, 200, data, {
+                "Content-Type": media_type,
+                "Docker-Content-Digest": digest_of(data)})
+        if reference in self.repos.get(name, set()):
+            return self.respond(request, 200, self.blobs[reference])
+        return self.respond(request, 404)
+
+    def handle_upload(self, request, name, query, body):
+        if request.command == "POST":
+            mount = query.get("mount")
+            if mount and mount in self.repos.get(query["from"], set()):
+                self.repos.setdefault(name, set()).add(mount)
+                return self.respond(request, 201)
+            location = "/v2/{}/blobs/uploads/{}".format(name, uuid.uuid4())
+            return self.respond(request, 202, headers={"Location": location})
+        if request.command == "DELETE":
+            return self.respond(request, 204)
+        assert digest_of(body) == query["digest"]
+        self.add_blob(name, body)
+        return self.respond(request, 201)
+
+    def respond(self, request, status, data=b"", headers=None):
+        request.send_response(status)
+        for k, v in (headers or {}).items():
+            request.send_header(k, v)
+        request.send_header("Content-Length", str(len(data)))
+        request.end_headers()
+        if request.command != "HEAD":
+            request.wfile.write(data)
+
+    def requests(self, method, part):
+        return [x for x in self.log if x[0] == method and part in x[1]]
+
+
+def read_body(request):
+    if request.headers.get("Transfer-Encoding") != "chunked":
+        return request.rfile.read(
+            int(request.headers.get("Content-Length") or 0))
+    # Blobs are streamed from the other registry as they are uploaded
+    body = b""
+    while True:
+        size = int(request.rfile.readline().strip(), 16)
+        if size == 0:
+            request.rfile.readline()
+            return body
+        body += request.rfile.read(size)
+        request.rfile.readline()
+
+
+@pytest.fixture
+def registries():
+    local, hub = FakeRegistry(), FakeRegistry()
+    yield local, hub
+    local.close()
+    hub.close()
+
+
+def add_image(fake, name, tag, layers):
+    config = fake.add_blob(name, ("config " + name).encode())
+    digests = [fake.add_blob(name, x) for x in layers]
+    fake.manifests[(name, tag)] = (json.dumps({
+        "schemaVersion": 2,
+        "config": {"digest": config},
+        "layers": [{"digest": d} for d in digests]}).encode(),
+        "application/vnd.docker.distribution.manifest.v2+json")
+    return digests
+
+
+def test_publish_mounts_layers_from_an_image_of_the_same_source(registries):
+    local, hub = registries
+    api_layer = b"api layer" * 100
+    # montagu-api was published by an earlier release; montagu-cli is
+    # built from the same source, so shares its layers
+    hub.add_blob("vimc/montagu-api", api_layer)
+    add_image(local, "montagu-cli", "v1.0.0", [api_layer, b"cli layer"])
+    publisher = tag_images.Publisher(registry.Registry(local.url),
+                                     registry.Registry(hub.url))
+    publisher.publish_image("montagu-cli", ["v1.0.0"])
+
+    mounts = [x[2] for x in hub.requests("POST", "/blobs/uploads/")]
+    assert {"mount": digest_of(api_layer), "from": "vimc/montagu-api"} \
+        in mounts
+    uploaded = [x[2]["digest"] for x in hub.requests("PUT", "/blobs/")]
+    assert digest_of(api_layer) not in uploaded
+    assert digest_of(b"cli layer") in uploaded
+    # The upload that a failed mount started is used, not abandoned
+    assert hub.requests("DELETE", "/blobs/uploads/") == []
+    assert ("vimc/montagu-cli", "v1.0.0") in hub.manifests
+
+
+def test_publish_mounts_blobs_copied_earlier_in_the_run(registries):
+    local, hub = registries
+    base = b"base layer" * 100
+    add_image(local, "montagu-static", "v1.0.0", [base])
+    add_image(local, "montagu-db", "v1.0.0", [base])
+    publisher = tag_images.Publisher(registry.Registry(local.url),
+                                     registry.Registry(hub.url))
+    publisher.publish_image("montagu-static", ["v1.0.0"])
+    publisher.publish_image("montagu-db", ["v1.0.0"])
+    uploaded = [x[2]["digest"] for x in hub.requests("PUT", "/blobs/")]
+    assert uploaded.count(digest_of(base)) == 1
+    assert digest_of(base) in hub.repos["vimc/montagu-db"]
+
+
+def test_publishing_again_copies_nothing(registries):
+    local, hub = registries
+    add_image(local, "montagu-static", "v1.0.0", [b"layer"])
+    publisher = tag_images.Publisher(registry.Registry(local.url),
+                                     registry.Registry(hub.url))
+    publisher.publish_image("montagu-static", ["v1.0.0"])
+    hub.log.clear()
+    publisher.publish_image("montagu-static", ["v1.0.0"])
+    assert [x[0] for x in hub.log if x[0] != "HEAD"] == []
+
+
+def test_basic_auth_challenge(monkeypatch):
+    fake = FakeRegistry(password="secret")
+    try:
+        monkeypatch.setenv("DOCKER_USERNAME", "user")
+        monkeypatch.setenv("DOCKER_PASSWORD", "secret")
+        client = registry.Registry(fake.url)
+        fake.add_blob("montagu-api", b"layer")
+        assert client.has_blob("montagu-api", digest_of(b"layer"))
+        # Once challenged, the credentials are sent up front
+        fake.log.clear()
+        assert not client.has_blob("montagu-api", digest_of(b"other"))
+        assert len(fake.log) == 1
+    finally:
+        fake.close()
+
+
+def test_basic_auth_with_wrong_credentials(monkeypatch):
+    fake = FakeRegistry(password="secret")
+    try:
+        monkeypatch.setenv("DOCKER_USERNAME", "user")
+        monkeypatch.setenv("DOCKER_PASSWORD", "wrong")
+        client = registry.Registry(fake.url)
+        with pytest.raises(registry.RegistryException):
+            client.get_manifest("montagu-api", "v1.0.0")
+    finally:
+        fake.close()
@@ -0,0 +1,46 @@
+import threading
+import time
+
+from suites import Suite, run_suites
+
+
+def recorder(log, name):
+    def work():
+        log.append((name, "start", time.time()))
+        time.sleep(0.1)
+        log.append((name, "end", time.time()))
+    return work
+
+
+def interval(log, name):
+    times = dict((event, t) for (n, event, t) in log if n == name)
+    return times["start"], times["end"]
+
+
+def test_suites_sharing_a_resource_do_not_overlap():
+    log = []
+    suites = [Suite("a", recorder(log, "a"), resources=["emails"]),
+              Suite("b", recorder(log, "b"), resources=["emails", "smtp"]),
+              Suite("c", recorder(log, "c"), resources=["smtp"])]
+    results = run_suites(suites, workers=3)
+    assert [r.status for r in results] == ["passed"] * 3
+    for x, y in [("a", "b"), ("b", "c")]:
+        x_start, x_end = interval(log, x)
+        y_start, y_end = interval(log, y)
+        assert x_end <= y_start or y_end <= x_start
+
+
+def test_independent_suites_run_at_once():
+    running = threading.Barrier(2, timeout=5)
+    suites = [Suite("a", running.wait), Suite("b", running.wait)]
+    results = run_suites(suites, workers=2)
+    assert [r.status for r in results] == ["passed", "passed"]
+
+
+def test_dependents_of_a_failed_suite_are_skipped():
+    def fail():
+        raise Exception("failed")
+    suites = [Suite("a", fail), Suite("b", lambda: None, ["a"]),
+              Suite("c", lambda: None)]
+    results = run_suites(suites, workers=2)
+    assert [r.status for r in results] == ["failed", "skipped", "passed"]
@@ -0,0 +1,172 @@
+import base64
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+import teamcity
+
+
+class FakeTeamCity:
+    """A stand-in for TeamCity, serving one artifact"""
+    def __init__(self, content=b"", password="right"):
+        self.content = content
+        self.password = password
+        self.requests = []
+        self.limit = len(content)
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                fake.requests.append(dict(self.headers))
+                fake.handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:{}/artifact".format(
+            self.server.server_address[1])
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+
+    def handle(self, request):
+        expected = "Basic " + base64.b64encode(
+            ("deploy:" + self.password).encode()).decode()
+        if request.headers.get("Authorization") != expected:
+            self.respond(request, 401)
+            return
+        size = len(self.content)
+        range_header = request.headers.get("Range")
+        if not range_header:
+            self.respond(request, 200, self.content)
+            return
+        start = int(range_header[len("bytes="):].rstrip("-"))
+        if start >= size:
+            self.respond(request, 416,
+                         content_range="bytes */{}".format(size))
+            return
+        # Send at most self.limit bytes, as if the connection dropped
+        body = self.content[start:start + self.limit]
+        self.respond(request, 206, body, "bytes {}-{}/{}".format(
+            start, start + len(body) - 1, size))
+
+    def respond(self, request, status, body=b"", content_range=None):
+        request.send_response(status)
+        if content_range:
+            request.send_header("Content-Range", content_range)
+        request.send_header("Content-Length", str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def secrets(monkeypatch):
+    """The passwords that successive reads from the vault return"""
+    values = []
+    forgotten = []
+    monkeypatch.setattr(teamcity, "get_secret",
+                        lambda path, field: values.pop(0))
+    monkeypatch.setattr(teamcity.vault.client, "forget", forgotten.append)
+    monkeypatch.setattr(teamcity, "auth", teamcity.AuthProvider())
+    return values, forgotten
+
+
+def test_stale_credentials_are_read_again(secrets):
+    values, forgotten = secrets
+    values.extend(["stale", "right"])
+    server = FakeTeamCity(b"artifact")
+    try:
+        assert teamcity.get_safely(server.url) == "artifact"
+    finally:
+        server.close()
+    assert len(server.requests) == 2
+    assert forgotten == ["secret/teamcity/deploy"]
+
+
+def test_wrong_credentials_are_retried_only_once(secrets, tmpdir):
+    values, forgotten = secrets
+    values.extend(["wrong", "still wrong"])
+    server = FakeTeamCity(b"artifact")
+    try:
+        with pytest.raises(teamcity.TeamCityCredentialsException):
+            teamcity.download_safely(server.url, str(tmpdir.join("a")))
+    finally:
+        server.close()
+    assert len(server.requests) == 2
+
+
+@pytest.fixture
+def server(secrets, monkeypatch, tmpdir):
+    secrets[0].extend(["right"] * 10)
+    monkeypatch.setattr(teamcity.paths, "artifacts", str(tmpdir))
+    server = FakeTeamCity(b"0123456789")
+    server.build_url = server.url + "/builds/id:1"
+    yield server
+    server.close()
+
+
+def download(server):
+    return teamcity.cached_download("Montagu_Api", server.build_url,
+                                    "api.jar", "api.jar")
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_download_resumes_from_the_partial_file(server):
+    partial = download_path(server) + ".part"
+    with open(partial, 'wb') as f:
+        f.write(b"01234")
+    assert read(download(server)) == b"0123456789"
+    assert server.requests[0]["Range"] == "bytes=5-"
+
+
+def test_partial_file_that_is_already_complete_is_kept(server):
+    partial = download_path(server) + ".part"
+    with open(partial, 'wb') as f:
+        f.write(b"0123456789")
+    assert read(download(server)) == b"0123456789"
+    # TeamCity had nothing more to send
+    assert len(server.requests) == 1
+
+
+def test_short_download_is_resumed_before_it_is_cached(server):
+    server.limit = 4
+    with open(download_path(server) + ".part", 'wb') as f:
+        f.write(b"01")
+    assert read(download(server)) == b"0123456789"
+    assert [r["Range"] for r in server.requests] == \
+        ["bytes=2-", "bytes=6-"]
+
+
+def test_short_download_is_not_cached(server, monkeypatch):
+    server.limit = 2
+    monkeypatch.setattr(teamcity, "download_attempts", 2)
+    path = download_path(server)
+    with open(path + ".part", 'wb') as f:
+        f.write(b"01")
+    with pytest.raises(teamcity.IncompleteDownloadException):
+        download(server)
+    assert not os.path.exists(path)
+
+
+def test_cached_copy_is_used_without_asking_teamcity(server):
+    first = download(server)
+    requests_made = len(server.requests)
+    assert download(server) == first
+    assert len(server.requests) == requests_made
+
+
+def download_path(server):
+    entry = os.path.join(teamcity.paths.artifacts, "cache", "Montagu_Api",
+                         "id_1")
+    os.makedirs(entry, exist_ok=True)
+    return os.path.join(entry, "api.jar")
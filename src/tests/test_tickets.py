@@ -0,0 +1,141 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+import tickets
+
+
+def issue(full_id):
+    return {"id": full_id,
+            "field": [{"name": "summary", "value": "About " + full_id},
+                      {"name": "State", "value": ["Ready to deploy"]}]}
+
+
+class FakeYouTrack:
+    """A stand-in for the YouTrack REST API, holding a few issues"""
+    def __init__(self, ids, batch=True):
+        self.issues = dict((i, issue(i)) for i in ids)
+        # False for a server that refuses the batched query
+        self.batch = batch
+        self.log = []
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                fake.log.append((url.path, query))
+                status, body = fake.get(url.path, query)
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:{}/rest/".format(
+            self.server.server_port)
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+
+    def get(self, path, query):
+        if path == "/rest/issue":
+            if not self.batch:
+                return 400, {}
+            ids = query["filter"][0][len("issue id: "):].split(", ")
+            return 200, {"issue": [self.issues[i.upper()] for i in ids
+                                   if i.upper() in self.issues]}
+        full_id = path.split("/")[-1].upper()
+        if full_id in self.issues:
+            return 200, self.issues[full_id]
+        return 404, {}
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def youtrack(monkeypatch, tmpdir):
+    monkeypatch.setenv("YOUTRACK_TOKEN", "token")
+    monkeypatch.setattr(tickets, "path_cache",
+                        str(tmpdir.join("cache", "tickets.json")))
+    servers = []
+
+    def make(ids, batch=True):
+        server = FakeYouTrack(ids, batch)
+        servers.append(server)
+        return server
+
+    yield make
+    for server in servers:
+        server.close()
+
+
+def found(pairs):
+    return [(branch, ticket if ticket == tickets.NOT_FOUND else ticket.id)
+            for branch, ticket in pairs]
+
+
+branches = ["i1_fix", "VIMC-2-feature", "mrc-1234_lower", "VIMC-99-gone",
+            "random"]
+
+
+def test_tickets_are_found_with_one_query(youtrack):
+    server = youtrack(["VIMC-1", "VIMC-2", "MRC-1234"])
+    yt = tickets.YouTrackHelper(server.url)
+    assert found(yt.get_tickets(branches)) == [
+        ("VIMC-2-feature", "VIMC-2"),
+        ("VIMC-99-gone", tickets.NOT_FOUND),
+        ("i1_fix", "VIMC-1"),
+        ("mrc-1234_lower", "MRC-1234"),
+        ("random", tickets.NOT_FOUND)]
+    paths = [path for path, query in server.log]
+    # One query, then a single lookup of the ticket that it didn't find
+    assert paths == ["/rest/issue", "/rest/issue/VIMC-99"]
+    assert server.log[0][1]["filter"] == \
+        ["issue id: VIMC-1, VIMC-2, VIMC-99, mrc-1234"]
+
+
+def test_tickets_are_looked_up_one_by_one_without_the_query(youtrack):
+    server = youtrack(["VIMC-1", "VIMC-2"], batch=False)
+    yt = tickets.YouTrackHelper(server.url)
+    assert found(yt.get_tickets(["i1_fix", "VIMC-2-feature"])) == [
+        ("VIMC-2-feature", "VIMC-2"), ("i1_fix", "VIMC-1")]
+    assert sorted(path for path, query in server.log) == [
+        "/rest/issue", "/rest/issue/VIMC-1", "/rest/issue/VIMC-2"]
+
+
+def test_cached_tickets_are_not_fetched_again(youtrack):
+    server = youtrack(["VIMC-1", "VIMC-2"])
+    list(tickets.YouTrackHelper(server.url, use_cache=True)
+         .get_tickets(["i1_fix"]))
+    server.log.clear()
+    yt = tickets.YouTrackHelper(server.url, use_cache=True)
+    assert found(yt.get_tickets(["i1_fix", "VIMC-2-feature"])) == [
+        ("VIMC-2-feature", "VIMC-2"), ("i1_fix", "VIMC-1")]
+    assert server.log[0][1]["filter"] == ["issue id: VIMC-2"]
+    assert len(server.log) == 1
+
+
+def test_cache_is_only_used_when_asked_for(youtrack):
+    server = youtrack(["VIMC-1"])
+    list(tickets.YouTrackHelper(server.url, use_cache=True)
+         .get_tickets(["i1_fix"]))
+    server.log.clear()
+    list(tickets.YouTrackHelper(server.url).get_tickets(["i1_fix"]))
+    assert len(server.log) == 1
+
+
+def test_cache_expires(youtrack, monkeypatch):
+    server = youtrack(["VIMC-1"])
+    list(tickets.YouTrackHelper(server.url, use_cache=True)
+         .get_tickets(["i1_fix"]))
+    monkeypatch.setattr(tickets, "cache_lifetime", 0)
+    assert tickets.read_cache() == {}
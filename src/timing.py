@@ -0,0 +1,148 @@
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import events
+
+# Lightweight tracing for deploys.  Wrap each phase in a span:
+#
+#     with timing.span("pull"):
+#         service.pull()
+#
+# Each span records its wall time, and how many subprocesses were
+# started and docker API requests made while it was open (including
+# by spans nested within it, even ones running on other threads - see
+# step_graph.run_steps).  Subprocesses are counted with an audit hook,
+# so need python >= 3.8; docker requests are counted for clients that
+# have been passed to watch_docker_client.  Spans are also reported as
+# phase_started and phase_finished events (see events).
+
+path_trace = 'deploy_trace.json'
+
+spans = []
+lock = threading.Lock()
+local = threading.local()
+
+
+class Span:
+    def __init__(self, name, parent):
+        self.name = name
+        self.parent = parent
+        self.thread = threading.get_ident()
+        self.start = None
+        self.end = None
+        self.subprocesses = 0
+        self.docker_calls = 0
+
+    @property
+    def depth(self):
+        return 0 if self.parent is None else self.parent.depth + 1
+
+    @property
+    def seconds(self):
+        return (self.end or time.time()) - self.start
+
+
+def current_span():
+    return getattr(local, "span", None)
+
+
+@contextmanager
+def span(name, parent=None):
+    """parent defaults to the span that is open on this thread; pass it
+    explicitly when starting work on another thread"""
+    previous = current_span()
+    s = Span(name, parent or previous)
+    local.span = s
+    s.start = time.time()
+    parent_name = s.parent.name if s.parent else None
+    events.emit("phase_started", phase=name, parent=parent_name)
+    error = None
+    try:
+        yield s
+    except Exception as e:
+        error = str(e) or type(e).__name__
+        # Only report the error from the innermost phase it escapes
+        if not getattr(e, "reported_phase", None):
+            e.reported_phase = name
+            events.emit("error", phase=name, parent=parent_name, error=error)
+        raise
+    finally:
+        s.end = time.time()
+        local.span = previous
+        with lock:
+            spans.append(s)
+        events.emit("phase_finished", phase=name, parent=parent_name,
+                    seconds=round(s.seconds, 3), ok=error is None,
+                    subprocesses=s.subprocesses, docker_calls=s.docker_calls)
+
+
+def count(what):
+    s = current_span()
+    with lock:
+        while s is not None:
+            setattr(s, what, getattr(s, what) + 1)
+            s = s.parent
+
+
+def audit_hook(event, args):
+    if event == "subprocess.Popen":
+        count("subprocesses")
+
+
+def watch_docker_client(client):
+    def hook(response, *args, **kwargs):
+        count("docker_calls")
+    client.api.hooks["response"].append(hook)
+
+
+def completed_spans():
+    with lock:
+        return sorted(spans, key=lambda s: s.start)
+
+
+def as_dict():
+    return [{"name": s.name,
+             "depth": s.depth,
+             "seconds": round(s.seconds, 3),
+             "subprocesses": s.subprocesses,
+             "docker_calls": s.docker_calls}
+            for s in completed_spans()]
+
+
+def save_chrome_trace(path=path_trace):
+    """Write the spans in the Chrome trace event format; open the file
+    in chrome://tracing or https://ui.perfetto.dev"""
+    events = [{"name": s.name,
+               "ph": "X",
+               "ts": int(s.start * 1e6),
+               "dur": int(s.seconds * 1e6),
+               "pid": 1,
+               "tid": s.thread,
+               "args": {"subprocesses": s.subprocesses,
+                        "docker_calls": s.docker_calls}}
+              for s in completed_spans()]
+    with open(path, 'w') as f:
+        json.dump({"traceEvents": events}, f)
+
+
+def print_summary():
+    done = completed_spans()
+    if not done:
+        return
+    width = max(len(s.name) + 2 * s.depth for s in done)
+    template = "{name}  {seconds:>9}  {subprocesses:>12}  {docker:>12}"
+    print(template.format(name="Phase".ljust(width), seconds="Time (s)",
+                          subprocesses="Subprocesses", docker="Docker calls"))
+    for s in done:
+        name = "  " * s.depth + s.name
+        print(template.format(name=name.ljust(width),
+                              seconds="{:.1f}".format(s.seconds),
+                              subprocesses=s.subprocesses,
+                              docker=s.docker_calls))
+
+
+if hasattr(sys, "addaudithook"):
+    sys.addaudithook(audit_hook)
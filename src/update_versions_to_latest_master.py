@@ -6,6 +6,7 @@ import versions
 if __name__ == "__main__":
     previous = versions.as_dict()
     run(["git", "submodule", "update", "--remote"], stdout=DEVNULL)
+    versions.refresh()
     new = versions.as_dict()
 
     changed = dict()
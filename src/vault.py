@@ -0,0 +1,119 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from os.path import expanduser, isfile
+from threading import Lock
+
+import requests
+
+import events
+
+
+# Reads secrets over the vault HTTP API, reusing one connection pool and
+# remembering every secret that has been read, so that each path is
+# fetched at most once per run.  Secrets are only ever held in memory.
+#
+# Authentication piggybacks on the vault CLI: we use $VAULT_TOKEN, or
+# the token that 'vault login' (see settings.prepare_for_vault_access)
+# leaves in ~/.vault-token, and otherwise log in with the GitHub token
+# ourselves.
+#
+# Every request has a timeout, so an unreachable vault fails the deploy
+# rather than hanging it.
+timeout = (10, 60)
+
+
+class SecretNotFound(Exception):
+    pass
+
+
+class VaultClient:
+    def __init__(self, address=None):
+        self.address = address
+        self.session = requests.Session()
+        self.token = None
+        self.secrets = {}
+        self.lock = Lock()
+        self.path_locks = {}
+
+    def read(self, path, field="value"):
+        data = self._get(path)
+        if field not in data:
+            raise Exception("No field '{field}' in vault secret {path}".format(
+                field=field, path=path))
+        return data[field]
+
+    def forget(self, path):
+        with self.lock:
+            self.secrets.pop(path, None)
+
+    def prefetch(self, paths, max_workers=8):
+        """Fetch secrets that are likely to be needed.  A missing secret
+        is not an error here; only reading it later is"""
+        def fetch(path):
+            try:
+                self._get(path)
+            except SecretNotFound:
+                pass
+
+        paths = sorted(set(paths))
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            list(pool.map(fetch, paths))
+
+    def _get(self, path):
+        with self.lock:
+            path_lock = self.path_locks.setdefault(path, Lock())
+        with path_lock:
+            if path not in self.secrets:
+                self.secrets[path] = self._fetch(path)
+                events.emit("secret_fetched", path=path)
+        return self.secrets[path]
+
+    def _fetch(self, path):
+        url = "{}/v1/{}".format(self._address(), path)
+        r = self.session.get(url, headers={"X-Vault-Token": self._token()},
+                             verify=self._verify(), timeout=timeout)
+        if r.status_code == 404:
+            raise SecretNotFound("No secret at vault path " + path)
+        if r.status_code != 200:
+            raise Exception("Failed to read {path} from vault. {code}: {text}"
+                            .format(path=path, code=r.status_code,
+                                    text=r.text))
+        return r.json()["data"]
+
+    def _address(self):
+        address = self.address or os.environ.get("VAULT_ADDR")
+        if not address:
+            raise Exception("The vault address has not been set")
+        return address.rstrip("/")
+
+    def _verify(self):
+        if os.environ.get("VAULT_SKIP_VERIFY"):
+            return False
+        return os.environ.get("VAULT_CACERT", True)
+
+    def _token(self):
+        with self.lock:
+            if self.token is None:
+                self.token = self._find_token()
+            return self.token
+
+    def _find_token(self):
+        if "VAULT_TOKEN" in os.environ:
+            return os.environ["VAULT_TOKEN"]
+        token_file = expanduser("~/.vault-token")
+        if isfile(token_file):
+            with open(token_file, 'r') as f:
+                return f.read().strip()
+        github_token = os.environ.get("VAULT_AUTH_GITHUB_TOKEN")
+        if not github_token:
+            raise Exception("Not authenticated with the vault")
+        url = "{}/v1/auth/github/login".format(self._address())
+        r = self.session.post(url, json={"token": github_token},
+                              verify=self._verify(), timeout=timeout)
+        if r.status_code != 200:
+            raise Exception("Failed to log in to the vault. {code}: {text}"
+                            .format(code=r.status_code, text=r.text))
+        return r.json()["auth"]["client_token"]
+
+
+client = VaultClient()
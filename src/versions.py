@@ -1,34 +1,108 @@
-import re
-from os.path import join
+#!/usr/bin/env python3
+import json
+from os.path import isfile, join
 from pathlib import Path
-from subprocess import run, PIPE
+from subprocess import run, PIPE, CalledProcessError
+from threading import Lock
 
 montagu_root = str(Path(__file__).parent.parent)
 
-def get_submodule_version(path):
-    full_path = join(montagu_root, "submodules", path)
-    result = run(["git", "-C", full_path, "rev-parse", "--short=7", "HEAD"],
-                 stdout=PIPE, check=True, universal_newlines=True)
-    return result.stdout.strip()
+# Hosts that deploy from a release tarball rather than a git clone can
+# record the versions here (run this file to write it); it is only used
+# when git can't tell us the versions
+path_versions_file = join(montagu_root, "versions.json")
+
+# Module attribute: submodule
+submodules = {
+    "db": "db",
+    "api": "api",
+    "contrib_portal": "contrib-portal",
+    "admin_portal": "admin-portal",
+    "proxy": "proxy",
+    "cert_tool": "cert-tool",
+    "static": "static",
+    "task_queue": "task-queue"
+}
+
+# The versions are looked up the first time one is used (as
+# versions.api etc.), with a single git call for all the submodules,
+# and then remembered; call refresh() after changing the submodules.
+cache = None
+lock = Lock()
+
+
+def read_versions_from_git():
+    # This reports the commit that each submodule has checked out,
+    # which may not be the one recorded in the superproject
+    result = run(["git", "-C", montagu_root, "submodule", "status",
+                  "submodules/"],
+                 stdout=PIPE, stderr=PIPE, check=True,
+                 universal_newlines=True)
+    found = {}
+    for line in result.stdout.splitlines():
+        sha, path = line[1:].split()[:2]
+        found[path[len("submodules/"):]] = sha[:7]
+    return found
+
+
+def read_versions():
+    """From git where we can, so that a stale versions.json in a clone
+    can never win; versions.json is only for copies without git"""
+    try:
+        found = read_versions_from_git()
+    except (OSError, CalledProcessError):
+        found = None
+    if found:
+        return found
+    if isfile(path_versions_file):
+        with open(path_versions_file, 'r') as f:
+            return json.load(f)
+    raise Exception("Can't find the submodule versions: this is not a git "
+                    "clone and there is no " + path_versions_file)
 
 
-db = get_submodule_version("db")
+def get_all():
+    global cache
+    with lock:
+        if cache is None:
+            cache = read_versions()
+        return cache
 
-api = get_submodule_version("api")
 
-contrib_portal = get_submodule_version("contrib-portal")
-admin_portal = get_submodule_version("admin-portal")
+def refresh():
+    global cache
+    with lock:
+        cache = None
 
-proxy = get_submodule_version("proxy")
-cert_tool = get_submodule_version("cert-tool")
 
-static = get_submodule_version("static")
+def get_submodule_version(path):
+    found = get_all()
+    if path not in found:
+        raise Exception("Unknown submodule '{}'".format(path))
+    return found[path]
+
+
+def __getattr__(name):
+    if name in submodules:
+        return get_submodule_version(submodules[name])
+    raise AttributeError("module 'versions' has no attribute '{}'".format(
+        name))
 
-task_queue = get_submodule_version("task-queue")
 
 def as_dict():
-    submodules = [
+    return dict((k, get_submodule_version(k)) for k in [
         'db', 'api', 'contrib-portal', 'admin-portal',
         'proxy', 'cert-tool', 'task-queue'
-    ]
-    return dict((k, get_submodule_version(k)) for k in submodules)
+    ])
+
+
+def save_versions_file():
+    versions = dict((path, get_submodule_version(path))
+                    for path in submodules.values())
+    with open(path_versions_file, 'w') as f:
+        json.dump(versions, f, indent=4, sort_keys=True)
+    print("Wrote versions to " + path_versions_file)
+
+
+if __name__ == "__main__":
+    save_versions_file()
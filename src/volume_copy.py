@@ -0,0 +1,86 @@
+from subprocess import run
+
+from docker_helpers import volume_copy_image
+
+# Copies many files between two volumes using a single helper container,
+# rather than one container (and one `cp` process per file) for each
+# path.  The manifest is a list of (source, destination) pairs: source
+# is a path, or glob, relative to the root of the source volume, and
+# destination is a directory relative to the root of the destination
+# volume.  Directories are copied recursively.
+#
+# The copy is split between `workers` shell loops running in parallel,
+# and files that are already in place with the same size and
+# modification time are skipped, so re-running a copy is cheap.
+#
+#     copy_manifest(service.volume_name("orderly"),
+#                   service.volume_name("static"),
+#                   [("archive/report/20190101-abc/out.csv", "reports")])
+
+default_workers = 8
+
+# The manifest is read on stdin, one tab-separated pair per line.  It is
+# expanded into a list of individual files, which is dealt out between
+# the workers with awk.
+copy_script = r"""
+set -e
+tab=$(printf '\t')
+cd /from
+while IFS="$tab" read -r pattern dest; do
+  mkdir -p "/to/$dest"
+  for match in $pattern; do
+    if [ ! -e "$match" ]; then
+      echo "Nothing to copy at $pattern" >&2
+      exit 1
+    fi
+    parent=$(dirname "$match")
+    find "$match" -type f | while read -r f; do
+      printf '%s\t%s\n' "$f" "/to/$dest/${f#$parent/}"
+    done
+  done
+done > /tmp/files
+
+awk -v n="$1" '{ print > ("/tmp/part." (NR % n)) }' /tmp/files
+pids=""
+for part in $(ls /tmp/part.* 2> /dev/null); do
+  (
+    while IFS="$tab" read -r f target; do
+      if [ -e "$target" ] && \
+         [ "$(stat -c '%s %Y' "$f")" = "$(stat -c '%s %Y' "$target")" ]; then
+        continue
+      fi
+      mkdir -p "$(dirname "$target")"
+      cp -p "$f" "$target"
+      echo "$target" >> "$part.copied"
+    done < "$part"
+  ) &
+  pids="$pids $!"
+done
+failed=0
+for pid in $pids; do
+  wait "$pid" || failed=1
+done
+total=$(wc -l < /tmp/files)
+copied=$(cat /tmp/part.*.copied 2> /dev/null | wc -l)
+echo "- Copied $copied of $total files ($((total - copied)) already up to date)"
+exit $failed
+"""
+
+
+def copy_manifest(source_volume, destination_volume, manifest,
+                  workers=default_workers):
+    manifest = list(manifest)
+    if not manifest:
+        return
+    for source, destination in manifest:
+        if "\t" in source or "\n" in source or \
+                "\t" in destination or "\n" in destination:
+            raise Exception("Unsupported path in copy manifest: {} -> {}"
+                            .format(source, destination))
+    lines = "".join("{}\t{}\n".format(s, d) for s, d in manifest)
+    run(["docker", "run", "--rm", "-i",
+         "-v", "{}:/from:ro".format(source_volume),
+         "-v", "{}:/to".format(destination_volume),
+         volume_copy_image,
+         "ash", "-c", copy_script, "copy", str(workers)],
+        input=lines.encode("utf-8"), check=True)